@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Replay signed Alipay notifications against the notify endpoint.
+
+A stand-in gateway signs sample notifications with its own key, and the app
+verifies them with that key instead of the Alipay one. Every payment gets
+--repeat deliveries of its notification, like Alipay retrying, and the first
+and the repeated deliveries are timed apart. The orders created are removed
+at the end.
+
+Usage: python benchmarks/bench_alipay_notify.py [--orders 200] [--repeat 5]
+"""
+import base64
+import sys
+import time
+import timeit
+from pathlib import Path
+from uuid import uuid4
+
+import click
+import rsa
+from alipay.aop.api.util.SignatureUtils import fill_public_key_marker
+from sqlalchemy import func
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flaskshop.app import create_app  # noqa: E402
+from flaskshop.constant import OrderStatusKinds, PaymentStatusKinds  # noqa: E402
+from flaskshop.database import db  # noqa: E402
+from flaskshop.order.models import (  # noqa: E402
+    Order,
+    OrderPayment,
+    OrderPaymentNotify,
+)
+from flaskshop.order.payment import zhifubao  # noqa: E402
+from flaskshop.outbox import OutboxMessage  # noqa: E402
+
+NOTIFY_URL = "/orders/alipay/notify"
+
+
+class StandInGateway:
+    """Signs notifications shaped like the ones the Alipay sandbox sends."""
+
+    def __init__(self, bits=2048):
+        self.public_key, self._private_key = rsa.newkeys(bits)
+
+    def notification(self, payment_no, seq):
+        data = {
+            "gmt_create": "2023-03-28 15:09:40",
+            "charset": "utf-8",
+            "gmt_payment": "2023-03-28 15:09:44",
+            "notify_time": "2023-03-28 15:09:46",
+            "subject": f"订单{payment_no}",
+            "buyer_id": "2088102170479214",
+            "body": "支付宝测试",
+            "invoice_amount": "0.02",
+            "version": "1.0",
+            "notify_id": f"bench{seq:012d}",
+            "notify_type": "trade_status_sync",
+            "out_trade_no": payment_no,
+            "total_amount": "0.02",
+            "trade_status": "TRADE_SUCCESS",
+            "trade_no": f"bench{seq:023d}",
+            "auth_app_id": "2016080400161922",
+            "receipt_amount": "0.02",
+            "app_id": "2016080400161922",
+            "buyer_pay_amount": "0.02",
+            "seller_id": "2088102169849330",
+        }
+        signature = rsa.sign(
+            zhifubao.get_sign_message(data), self._private_key, "SHA-256"
+        )
+        data.update(sign=base64.b64encode(signature).decode(), sign_type="RSA2")
+        return data
+
+
+def load_alipay_key():
+    """What every notification paid before the key was cached."""
+    _, alipay_public_key_string = zhifubao.get_alipay_string.__wrapped__()
+    return rsa.PublicKey.load_pkcs1_openssl_pem(
+        fill_public_key_marker(alipay_public_key_string)
+    )
+
+
+def create_payments(count):
+    payments = []
+    for _ in range(count):
+        order = Order.create(
+            token=str(uuid4()),
+            user_id=0,
+            status=OrderStatusKinds.unfulfilled.value,
+            total_net=0,
+            shipping_price_net=0,
+        )
+        payments.append(
+            OrderPayment.create(
+                order_id=order.id,
+                payment_no=f"bench{uuid4().hex[:16]}",
+                status=PaymentStatusKinds.waiting.value,
+                total=0,
+            )
+        )
+    return payments
+
+
+def replay(client, notifications):
+    start = time.perf_counter()
+    for data in notifications:
+        rv = client.post(NOTIFY_URL, data=data)
+        if rv.data != b"SUCCESS":
+            raise click.ClickException(f"notify answered {rv.data!r}")
+    return time.perf_counter() - start
+
+
+def report(name, count, seconds):
+    click.echo(
+        f"{name:<22} {count:>7} requests {seconds / count * 1e3:>8.2f} ms/req "
+        f"{count / seconds:>8.0f} req/s"
+    )
+
+
+@click.command()
+@click.option("--orders", default=200, help="payments to notify")
+@click.option("--repeat", default=5, help="deliveries of each notification")
+def main(orders, repeat):
+    app = create_app()
+    gateway = StandInGateway()
+    zhifubao.get_alipay_public_key = lambda: gateway.public_key
+    with app.app_context():
+        last_outbox_id = db.session.query(func.max(OutboxMessage.id)).scalar() or 0
+        payments = create_payments(orders)
+        notifications = [
+            gateway.notification(payment.payment_no, seq)
+            for seq, payment in enumerate(payments)
+        ]
+        client = app.test_client()
+        try:
+            report("first delivery", orders, replay(client, notifications))
+            if repeat > 1:
+                report(
+                    "repeated deliveries",
+                    orders * (repeat - 1),
+                    replay(client, notifications * (repeat - 1)),
+                )
+            rounds = 200
+            seconds = timeit.timeit(load_alipay_key, number=rounds)
+            click.echo(
+                f"{'key load, now cached':<22} {seconds / rounds * 1e6:>8.1f} us/call"
+            )
+        finally:
+            order_ids = [payment.order_id for payment in payments]
+            OrderPaymentNotify.query.filter(
+                OrderPaymentNotify.payment_no.in_([p.payment_no for p in payments])
+            ).delete()
+            OrderPayment.query.filter(OrderPayment.order_id.in_(order_ids)).delete()
+            Order.query.filter(Order.id.in_(order_ids)).delete()
+            OutboxMessage.query.filter(OutboxMessage.id > last_outbox_id).delete()
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+"""Compare the cache serializers on seeded products.
+
+Usage: python benchmarks/bench_serializer.py [--rounds 1000]
+"""
+import sys
+import timeit
+from pathlib import Path
+
+import click
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from flaskshop.app import create_app  # noqa: E402
+from flaskshop.corelib.serializer import ModelSerializer, PickleSerializer  # noqa: E402
+from flaskshop.product.models import Product, ProductVariant  # noqa: E402
+
+SERIALIZERS = (("pickle", PickleSerializer()), ("model", ModelSerializer()))
+
+
+def bench(name, value, rounds):
+    for serializer_name, serializer in SERIALIZERS:
+        data = serializer.dumps(value)
+        seconds = timeit.timeit(lambda: serializer.loads(data), number=rounds)
+        click.echo(
+            f"{name:<22} {serializer_name:<7} {len(data):>8} bytes "
+            f"{seconds / rounds * 1e6:>10.1f} us/load"
+        )
+
+
+@click.command()
+@click.option("--rounds", default=1000, help="loads per measurement")
+@click.option("--size", default=20, help="length of the list cases")
+def main(rounds, size):
+    app = create_app()
+    with app.app_context():
+        products = Product.query.limit(size).all()
+        variants = ProductVariant.query.limit(size).all()
+        if not products or not variants:
+            raise click.ClickException("no products, run flask seed first")
+        bench("Product", products[0], rounds)
+        bench("ProductVariant", variants[0], rounds)
+        bench(f"[Product] x{len(products)}", products, rounds)
+        bench(f"[ProductVariant] x{len(variants)}", variants, rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,11 @@ from flaskshop.extensions import bcrypt
 
 class User(Model, UserMixin):
     __tablename__ = "account_user"
+    # the dashboard list pages through it by created_at
+    __table_args__ = (
+        db.Index("ix_account_user_created_at", "created_at"),
+        Model.__table_args__,
+    )
     username = Column(db.String(80), unique=True, nullable=False, comment="user`s name")
     email = Column(db.String(80), unique=True, nullable=False)
     #: The hashed password
@@ -12,6 +12,7 @@ from phonenumbers.phonenumberutil import is_possible_number
 from wtforms import ValidationError
 
 from flaskshop.constant import Permission
+from flaskshop.outbox import enqueue, outbox_handler
 
 
 class PhoneNumber(phonenumbers.PhoneNumber):
@@ -167,17 +168,23 @@ def create_email_server():
     return server
 
 
-def send_reset_pwd_email(to_email, new_passwd):
+@outbox_handler("email")
+def send_email(to_email, subject, body):
     mailuser = current_app.config.get("MAIL_USERNAME")
     mailpwd = current_app.config.get("MAIL_PASSWORD")
 
     msg = EmailMessage()
     msg["To"] = email.utils.formataddr(("Recipient", to_email))
     msg["From"] = email.utils.formataddr(("Admin", mailuser))
-    msg["Subject"] = "Reset Password"
-    body = render_template("account/reset_passwd_mail.html", new_passwd=new_passwd)
+    msg["Subject"] = subject
     msg.set_content(body, "html")
 
     with create_email_server() as s:
         s.login(mailuser, mailpwd)
         s.send_message(msg)
+
+
+def send_reset_pwd_email(to_email, new_passwd):
+    # rendered here, the worker has no request to build external urls from
+    body = render_template("account/reset_passwd_mail.html", new_passwd=new_passwd)
+    enqueue("email", to_email=to_email, subject="Reset Password", body=body)
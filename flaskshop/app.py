@@ -5,6 +5,7 @@ import sys
 from flask import Flask, render_template
 
 from flaskshop import commands
+from flaskshop.database import init_identity_map
 from flaskshop.extensions import (
     babel,
     bcrypt,
@@ -27,6 +28,7 @@ def create_app(config_object=Config):
     app.config.from_object(config_object)
     app.pluggy = manager.FlaskshopPluginManager("flaskshop")
     register_extensions(app)
+    init_identity_map(app)
     load_plugins(app)
     register_blueprints(app)
     register_errorhandlers(app)
@@ -86,6 +88,7 @@ def register_commands(app):
     app.cli.add_command(commands.seed)
     app.cli.add_command(commands.flushrdb)
     app.cli.add_command(commands.reindex)
+    app.cli.add_command(commands.outbox)
 
 
 def load_plugins(app):
@@ -1,12 +1,18 @@
 from flask import flash
 from flask_login import current_user
+from sqlalchemy import event, inspect
 
 from flaskshop.corelib.mc import cache, rdb
-from flaskshop.database import Column, Model, db
+from flaskshop.database import Column, Model, db, get_identity_map
 from flaskshop.discount.models import Voucher
-from flaskshop.product.models import ProductVariant
+from flaskshop.product.models import Product, ProductVariant
 
 MC_KEY_CART_BY_USER = "checkout:cart:user_id:{}"
+MC_KEY_CART_SUMMARY_BY_USER = "checkout:cart:summary:user_id:{}"
+CART_SUMMARY_EXPIRE = 300  # prices of the lines may change meanwhile
+CART_SUMMARY_LINES = 5
+# carts whose lines changed in the current flush, resolved to users after it
+PENDING_CART_SUMMARIES = "checkout:pending_cart_summaries"
 
 
 class Cart(Model):
@@ -17,21 +23,25 @@ class Cart(Model):
     shipping_address_id = Column(db.Integer())
     shipping_method_id = Column(db.Integer())
 
+    @property
+    def snapshot(self):
+        return CartSnapshot.get(self)
+
     @property
     def subtotal(self):
-        return sum(line.subtotal for line in self)
+        return self.snapshot.subtotal
 
     @property
     def total(self):
-        return self.subtotal + self.shipping_method_price - self.discount_amount
+        return self.snapshot.total
 
     @property
     def discount_amount(self):
-        return self.voucher.get_vouchered_price(self) if self.voucher_code else 0
+        return self.snapshot.discount_amount
 
     @property
     def lines(self):
-        return CartLine.query.filter(CartLine.cart_id == self.id).all()
+        return list(self.snapshot.lines)
 
     @classmethod
     @cache(MC_KEY_CART_BY_USER.format("{user_id}"))
@@ -46,6 +56,38 @@ class Cart(Model):
             cart = None
         return cart
 
+    @classmethod
+    @cache(MC_KEY_CART_SUMMARY_BY_USER.format("{user_id}"), expire=CART_SUMMARY_EXPIRE)
+    def get_cart_summary_by_user_id(cls, user_id):
+        """What the cart dropdown of every page shows, as plain values."""
+        cart = cls.get_cart_by_user_id(user_id)
+        if cart is None:
+            return None
+        snapshot = cart.snapshot
+        return {
+            "quantity": cart.quantity,
+            "line_count": len(snapshot),
+            "total": snapshot.total,
+            "is_shipping_required": snapshot.is_shipping_required,
+            "lines": [
+                {
+                    "url": line.product.get_absolute_url(),
+                    "image": line.product.first_img,
+                    "title": str(line.product),
+                    "variant": str(line.variant),
+                    "quantity": line.quantity,
+                    "price": line.variant.price,
+                }
+                for line in snapshot.lines[:CART_SUMMARY_LINES]
+            ],
+        }
+
+    @classmethod
+    def get_current_user_cart_summary(cls):
+        if current_user.is_authenticated:
+            return cls.get_cart_summary_by_user_id(current_user.id)
+        return None
+
     @classmethod
     def add_to_currentuser_cart(cls, quantity, variant_id):
         cart = cls.get_current_user_cart()
@@ -67,22 +109,14 @@ class Cart(Model):
             CartLine.create(variant_id=variant_id, quantity=quantity, cart_id=cart.id)
 
     def get_product_price(self, product_id):
-        price = 0
-        for line in self:
-            if line.product.id == product_id:
-                price += line.subtotal
-        return price
+        return self.snapshot.get_product_price(product_id)
 
     def get_category_price(self, category_id):
-        price = 0
-        for line in self:
-            if line.category.id == category_id:
-                price += line.subtotal
-        return price
+        return self.snapshot.get_category_price(category_id)
 
     @property
     def is_shipping_required(self):
-        return any(line.is_shipping_required for line in self)
+        return self.snapshot.is_shipping_required
 
     @property
     def shipping_method(self):
@@ -90,15 +124,11 @@ class Cart(Model):
 
     @property
     def shipping_method_price(self):
-        if self.shipping_method:
-            return self.shipping_method.price
-        return 0
+        return self.snapshot.shipping_method_price
 
     @property
     def voucher(self):
-        if self.voucher_code:
-            return Voucher.get_by_code(self.voucher_code)
-        return None
+        return self.snapshot.voucher
 
     def __repr__(self):
         return f"Cart(quantity={self.quantity})"
@@ -107,7 +137,7 @@ class Cart(Model):
         return iter(self.lines)
 
     def __len__(self):
-        return len(self.lines)
+        return len(self.snapshot)
 
     def update_quantity(self):
         self.quantity = sum(line.quantity for line in self)
@@ -117,19 +147,34 @@ class Cart(Model):
             self.save()
         return self.quantity
 
+    @staticmethod
+    def clear_mc(target):
+        rdb.delete(
+            MC_KEY_CART_BY_USER.format(target.user_id),
+            MC_KEY_CART_SUMMARY_BY_USER.format(target.user_id),
+        )
+
     @classmethod
     def __flush_insert_event__(cls, target):
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        target.clear_mc(target)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
         super().__flush_after_update_event__(target)
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        target.clear_mc(target)
+        state = inspect(target)
+        # quantity is not part of the snapshot, the lines it sums are
+        if any(
+            state.attrs[key].history.has_changes()
+            for key in ("voucher_code", "shipping_method_id")
+        ):
+            CartSnapshot.forget(target.id)
 
     @classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
-        rdb.delete(MC_KEY_CART_BY_USER.format(current_user.id))
+        target.clear_mc(target)
+        CartSnapshot.forget(target.id)
 
 
 class CartLine(Model):
@@ -147,7 +192,17 @@ class CartLine(Model):
 
     @property
     def variant(self):
-        return ProductVariant.get_by_id(self.variant_id)
+        if "_variant" not in self.__dict__:
+            self._variant = ProductVariant.get_by_id(self.variant_id)
+        return self._variant
+
+    @staticmethod
+    def attach_variants(lines):
+        variants = ProductVariant.get_multi_by_ids(line.variant_id for line in lines)
+        for line, variant in zip(lines, variants):
+            line._variant = variant
+        variants = ProductVariant.preload(variants, "product")
+        Product.preload([v.product for v in variants], "images", "discounted_price")
 
     @property
     def product(self):
@@ -161,6 +216,105 @@ class CartLine(Model):
     def subtotal(self):
         return self.variant.price * self.quantity
 
+    @staticmethod
+    def clear_mc(target):
+        db.session.info.setdefault(PENDING_CART_SUMMARIES, set()).add(target.cart_id)
+        CartSnapshot.forget(target.cart_id)
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        super().__flush_after_update_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_delete_event__(cls, target):
+        super().__flush_delete_event__(target)
+        target.clear_mc(target)
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def clear_pending_cart_summaries(session, flush_context):
+    """Clear the summaries of the owners of the carts whose lines changed,
+    which needs a query flush events must not run."""
+    cart_ids = session.info.pop(PENDING_CART_SUMMARIES, None)
+    if not cart_ids:
+        return
+    user_ids = Cart.query.with_entities(Cart.user_id).filter(Cart.id.in_(cart_ids))
+    keys = [MC_KEY_CART_SUMMARY_BY_USER.format(id) for id, in user_ids]
+    if keys:
+        rdb.delete(*keys)
+
+
+class CartSnapshot:
+    """The lines of a cart with their variants, products, categories and
+    discounts, loaded in a few batched queries, and the totals derived from
+    them. Computed once per request, Cart and CartLine changes drop it."""
+
+    def __init__(self, cart):
+        self.lines = CartLine.query.filter(CartLine.cart_id == cart.id).all()
+        CartLine.attach_variants(self.lines)
+        products = [line.product for line in self.lines if line.variant]
+        Product.preload(products, "category", "product_type")
+
+        self.subtotal = sum(line.subtotal for line in self.lines)
+        self.is_shipping_required = any(
+            line.is_shipping_required for line in self.lines
+        )
+        self.shipping_method = (
+            ShippingMethod.get_by_id(cart.shipping_method_id)
+            if cart.shipping_method_id
+            else None
+        )
+        self.shipping_method_price = (
+            self.shipping_method.price if self.shipping_method else 0
+        )
+        self.voucher = (
+            Voucher.get_by_code(cart.voucher_code) if cart.voucher_code else None
+        )
+        self.discount_amount = (
+            self.voucher.get_vouchered_price(self) if self.voucher else 0
+        )
+        self.total = self.subtotal + self.shipping_method_price - self.discount_amount
+
+    @classmethod
+    def get(cls, cart):
+        identity_map = get_identity_map()
+        if identity_map is None:
+            return cls(cart)
+        key = (cls.__name__, cart.id)
+        if key not in identity_map:
+            identity_map[key] = cls(cart)
+        return identity_map[key]
+
+    @classmethod
+    def forget(cls, cart_id):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.pop((cls.__name__, cart_id), None)
+
+    def get_product_price(self, product_id):
+        return sum(
+            line.subtotal for line in self.lines if line.product.id == product_id
+        )
+
+    def get_category_price(self, category_id):
+        return sum(
+            line.subtotal
+            for line in self.lines
+            if line.product.category_id == category_id
+        )
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
 
 class ShippingMethod(Model):
     __tablename__ = "checkout_shippingmethod"
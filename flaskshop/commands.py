@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Click commands."""
+import time
 from itertools import chain
 from pathlib import Path
 from subprocess import call
@@ -11,8 +12,14 @@ from werkzeug.exceptions import MethodNotAllowed, NotFound
 
 from flaskshop.corelib.db import rdb
 from flaskshop.extensions import db
-from flaskshop.product.models import Product
-from flaskshop.public.search import Item
+from flaskshop.outbox import run_worker
+from flaskshop.product.models import iter_product_batches
+from flaskshop.public.search import (
+    Item,
+    LocalItem,
+    Suggestion,
+    iter_suggestion_titles,
+)
 from flaskshop.random_data import (
     create_admin,
     create_collections_by_schema,
@@ -208,10 +215,52 @@ def flushrdb():
 
 
 @click.command()
+@click.option("--batch-size", default=500, help="Products loaded per batch.")
+@click.option("--threads", default=4, help="Threads sending bulk requests.")
+@click.option(
+    "--swap/--in-place",
+    default=True,
+    help="Build a new index and flip the alias to it, or rebuild in place.",
+)
+@with_appcontext
+def reindex(batch_size, threads, swap):
+    """Rebuild the elastic-search indices of products and suggestions, or
+    the local ones while elastic-search is disabled."""
+    if not current_app.config["USE_ES"]:
+        start = time.perf_counter()
+        done, titles = LocalItem.rebuild(batch_size)
+        elapsed = time.perf_counter() - start
+        click.echo(f"{done} docs and {titles} suggestions locally, {elapsed:.2f}s")
+        return
+
+    if swap:
+        index = Item.create_next_index()
+    else:
+        index = Item.recreate_index()
+    click.echo(f"Indexing into {index}")
+
+    done = 0
+    start = time.perf_counter()
+    for batch in iter_product_batches(batch_size):
+        done += Item.bulk_update(
+            batch, op_type="create", index=index, thread_count=threads
+        )
+        elapsed = time.perf_counter() - start
+        click.echo(f"{done} docs, {done / elapsed:.0f} docs/sec")
+
+    if swap:
+        old = Item.swap_alias(index)
+        click.echo(f"{Item._index._name} now points at {index}, dropped {old}")
+
+    titles = Suggestion.rebuild(iter_suggestion_titles())
+    click.echo(f"{titles} suggestions")
+
+
+@click.command()
+@click.option("--workers", default=1, help="Number of worker threads.")
+@click.option("--interval", default=1.0, help="Seconds to wait while idle.")
+@click.option("--once", is_flag=True, help="Exit when no message is due.")
 @with_appcontext
-def reindex():
-    """clear elastic-search items."""
-    Item._index.delete(ignore=404)
-    Item.init()
-    products = Product.query.all()
-    Item.bulk_update(products, op_type="create")
+def outbox(workers, interval, once):
+    """Carry out order events, emails and search index updates."""
+    run_worker(current_app._get_current_object(), workers, interval, once)
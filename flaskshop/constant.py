@@ -6,6 +6,7 @@ ShipStatusKinds = enum.Enum(value="ShipStatus", names="pending delivered receive
 PaymentStatusKinds = enum.Enum(
     value="PaymentStatus", names="waiting preauth confirmed rejected"
 )
+OutboxStatusKinds = enum.Enum(value="OutboxStatus", names="pending failed")
 OrderStatusKinds = enum.Enum(
     value="OrderStatus", names="draft unfulfilled fulfilled canceled completed shipped"
 )
@@ -2,7 +2,9 @@ import copy
 import json
 from datetime import datetime
 
+from flask import current_app
 from redis import Redis
+from redis.exceptions import ResponseError
 
 from flaskshop.corelib.local_cache import lc
 from flaskshop.settings import Config
@@ -29,7 +31,28 @@ if not Config.USE_REDIS:
     rdb.keys = Fake
 
 
+def _is_blob(error):
+    return str(error).startswith("WRONGTYPE")
+
+
+def _dump_props(props):
+    return {k: json.dumps(v) for k, v in props.items()}
+
+
+def _load_props(fields):
+    return {
+        (k.decode() if isinstance(k, bytes) else k): json.loads(v)
+        for k, v in fields.items()
+    }
+
+
 class PropsMixin:
+    """Props of an object are kept in one redis hash, a field per item.
+
+    The whole hash is cached in ``lc`` on the first read, writes touch only
+    their own field and drop that copy.
+    """
+
     @property
     def _props_name(self):
         return f"__{self.get_uuid()}/props_cached"
@@ -41,13 +64,35 @@ class PropsMixin:
     def _get_props(self):
         props = lc.get(self._props_name)
         if props is None:
-            props = rdb.get(self._props_db_key) or ""
-            props = json.loads(props) if props else {}
+            props = self._read_props()
             lc.set(self._props_name, props)
         return props
 
+    def _read_props(self):
+        try:
+            return _load_props(rdb.hgetall(self._props_db_key) or {})
+        except ResponseError as e:
+            # props written as one json blob before they became a hash
+            if not _is_blob(e):
+                raise
+            return self._migrate_props()
+
+    def _migrate_props(self):
+        props = rdb.get(self._props_db_key)
+        props = json.loads(props) if props else {}
+        pipe = rdb.pipeline()
+        pipe.delete(self._props_db_key)
+        if props:
+            pipe.hset(self._props_db_key, mapping=_dump_props(props))
+        pipe.execute()
+        return props
+
     def _set_props(self, props):
-        rdb.set(self._props_db_key, json.dumps(props))
+        pipe = rdb.pipeline()
+        pipe.delete(self._props_db_key)
+        if props:
+            pipe.hset(self._props_db_key, mapping=_dump_props(props))
+        pipe.execute()
         lc.delete(self._props_name)
 
     def _destroy_props(self):
@@ -63,33 +108,55 @@ class PropsMixin:
         return self.props.get(key, default)
 
     def set_props_item(self, key, value):
-        props = self.props
-        props[key] = value
-        self.props = props
+        self.update_props({key: value})
 
     def delete_props_item(self, key):
-        props = self.props
-        props.pop(key, None)
-        self.props = props
+        self._write_props("hdel", key)
 
     def update_props(self, data):
-        props = self.props
-        props.update(data)
-        self.props = props
+        if data:
+            self._write_props("hset", mapping=_dump_props(data))
 
     def incr_props_item(self, key):
-        n = self.get_props_item(key, 0)
-        n += 1
-        self.set_props_item(key, n)
-        return n
+        return self._write_props("hincrby", key, 1)
 
     def decr_props_item(self, key, min_val=0):
-        n = self.get_props_item(key, 0)
-        n -= 1
-        n = n if n > min_val else min_val
-        self.set_props_item(key, n)
+        n = self._write_props("hincrby", key, -1)
+        if n < min_val:
+            # another decr may have raced us below min_val too, both clamp
+            self._write_props("hset", key, min_val)
+            n = min_val
         return n
 
+    def _write_props(self, command, *args, **kwargs):
+        try:
+            rv = getattr(rdb, command)(self._props_db_key, *args, **kwargs)
+        except ResponseError as e:
+            if not _is_blob(e):
+                raise
+            self._migrate_props()
+            rv = getattr(rdb, command)(self._props_db_key, *args, **kwargs)
+        lc.delete(self._props_name)
+        return rv
+
+
+def prefetch_props(objs):
+    """Fill ``lc`` with the props of objs in one pipeline, for list pages."""
+    if not current_app.config["USE_REDIS"]:
+        return
+    objs = [obj for obj in objs if obj is not None]
+    missing = [obj for obj in objs if lc.get(obj._props_name) is None]
+    if not missing:
+        return
+    pipe = rdb.pipeline(transaction=False)
+    for obj in missing:
+        pipe.hgetall(obj._props_db_key)
+    for obj, fields in zip(missing, pipe.execute(raise_on_error=False)):
+        if isinstance(fields, ResponseError):
+            lc.set(obj._props_name, obj._read_props())
+        else:
+            lc.set(obj._props_name, _load_props(fields))
+
 
 class PropsItem:
     def __init__(self, name, default=None, output_filter=None, pre_set=None):
@@ -0,0 +1,289 @@
+"""Small in-process indexes for search without Elasticsearch.
+
+FullTextIndex ranks documents, ids with a few weighted text fields, with
+BM25. PrefixIndex completes the words of titles as they are typed. Both
+live in memory and are saved to a pickle file, so they survive restarts
+and processes reading the same file pick up each other's saves. Writers
+of several processes take turns through a lock file next to it.
+"""
+import heapq
+import math
+import os
+import pickle
+import re
+import threading
+from abc import ABC, abstractmethod
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows, only the threads of a process take turns
+    fcntl = None
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower()) if text else []
+
+
+class PersistentIndex(ABC):
+    """Saving to and reloading from path, for subclasses holding their
+    state in what _dump returns and _load takes."""
+
+    def __init__(self, path=None):
+        self.path = str(path) if path else None
+        self.built = False
+        self._mtime = None
+        self._lock = threading.RLock()
+        self._lock_file = None
+
+    @abstractmethod
+    def _dump(self):
+        """The state to pickle."""
+
+    @abstractmethod
+    def _load(self, state):
+        """Take over the state read back."""
+
+    @contextmanager
+    def locked(self):
+        """Keep other writers, in this process or another, out while the
+        latest save is read, changed and saved again."""
+        with self._lock:
+            if self.path is None or fcntl is None or self._lock_file is not None:
+                yield
+                return
+            with open(f"{self.path}.lock", "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                self._lock_file = f
+                try:
+                    yield
+                finally:
+                    # closing the file releases the lock
+                    self._lock_file = None
+
+    def refresh(self):
+        """Read the file if it was saved by someone else since this index
+        last read or wrote it, return whether the index has been built."""
+        if self.path is None:
+            return self.built
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return self.built
+        if mtime != self._mtime:
+            # a pickle, as the file is only ever written by save
+            with open(self.path, "rb") as f:
+                state = pickle.load(f)
+            with self._lock:
+                self._load(state)
+                self._mtime = mtime
+                self.built = True
+        return self.built
+
+    def save(self):
+        """Write the index to its file, through a temporary one so readers
+        never see half of it."""
+        with self.locked():
+            self.built = True
+            if self.path is None:
+                return
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}"
+            with open(tmp, "wb") as f:
+                pickle.dump(self._dump(), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path)
+            self._mtime = os.stat(self.path).st_mtime_ns
+
+
+class FullTextIndex(PersistentIndex):
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, fields, path=None):
+        """fields maps the field names to their boost, without a path the
+        index is only kept in memory."""
+        super().__init__(path)
+        self.fields = dict(fields)
+        self.docs = {}  # id -> {field: (length, terms)}
+        self.postings = {field: {} for field in self.fields}  # term -> {id: tf}
+        self.total_length = dict.fromkeys(self.fields, 0)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc_id, **texts):
+        """Index the texts of a document, replacing what it had before."""
+        with self._lock:
+            self._remove(doc_id)
+            entry = {}
+            for field in self.fields:
+                terms = Counter(tokenize(texts.get(field)))
+                postings = self.postings[field]
+                for term, tf in terms.items():
+                    postings.setdefault(term, {})[doc_id] = tf
+                length = sum(terms.values())
+                self.total_length[field] += length
+                entry[field] = (length, tuple(terms))
+            self.docs[doc_id] = entry
+
+    def remove(self, doc_id):
+        with self._lock:
+            return self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self.docs.pop(doc_id, None)
+        if entry is None:
+            return False
+        for field, (length, terms) in entry.items():
+            self.total_length[field] -= length
+            postings = self.postings[field]
+            for term in terms:
+                docs = postings[term]
+                del docs[doc_id]
+                if not docs:
+                    del postings[term]
+        return True
+
+    def search(self, query, offset=0, limit=None):
+        """Rank the documents holding any term of query, return how many
+        there are and the ids of limit of them from offset, best first."""
+        terms = set(tokenize(query))
+        scores = defaultdict(float)
+        with self._lock:
+            count = len(self.docs)
+            for field, boost in self.fields.items():
+                postings = self.postings[field]
+                avg_length = self.total_length[field] / count if count else 0
+                for term in terms:
+                    docs = postings.get(term)
+                    if not docs:
+                        continue
+                    idf = math.log(1 + (count - len(docs) + 0.5) / (len(docs) + 0.5))
+                    for doc_id, tf in docs.items():
+                        norm = 1 - self.b
+                        if avg_length:
+                            length = self.docs[doc_id][field][0]
+                            norm += self.b * length / avg_length
+                        scores[doc_id] += (
+                            boost * idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+                        )
+
+        def rank(doc_id):
+            return -scores[doc_id], doc_id
+
+        if limit is None:
+            ranked = sorted(scores, key=rank)
+        else:
+            ranked = heapq.nsmallest(offset + limit, scores, key=rank)
+        return len(scores), ranked[offset:]
+
+    def rebuild(self, docs):
+        """Replace the contents with docs, pairs of an id and a dict of its
+        field texts, and save. Searches see the old contents until then."""
+        fresh = FullTextIndex(self.fields)
+        for doc_id, texts in docs:
+            fresh.add(doc_id, **texts)
+        with self.locked():
+            self.docs = fresh.docs
+            self.postings = fresh.postings
+            self.total_length = fresh.total_length
+            self.save()
+
+    def _dump(self):
+        return self.docs, self.postings, self.total_length
+
+    def _load(self, state):
+        self.docs, self.postings, self.total_length = state
+
+
+class PrefixIndex(PersistentIndex):
+    """A trie over the words of titles, each node holding the keys of the
+    titles with a word starting with its prefix, like an edge-ngram field.
+    Only the titles are saved, the trie is built again when loading."""
+
+    def __init__(self, path=None):
+        super().__init__(path)
+        self.titles = {}  # key -> title
+        self.root = {}
+
+    def __len__(self):
+        return len(self.titles)
+
+    def add(self, key, title):
+        with self._lock:
+            self._remove(key)
+            self.titles[key] = title
+            for word in set(tokenize(title)):
+                node = self.root
+                for char in word:
+                    node = node.setdefault(char, {})
+                    node.setdefault(None, set()).add(key)
+
+    def remove(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        title = self.titles.pop(key, None)
+        if title is None:
+            return False
+        for word in set(tokenize(title)):
+            node = self.root
+            for char in word:
+                parent, node = node, node.get(char)
+                if node is None:
+                    break  # pruned with another word sharing the prefix
+                node[None].discard(key)
+                if not node[None]:
+                    # the nodes below hold a subset of its keys
+                    del parent[char]
+                    break
+        return True
+
+    def suggest(self, text, limit=10, rank=None):
+        """Keys and titles of the titles having a word starting with each
+        word of text, limit of them ordered by rank, a function of the key,
+        then by title."""
+        keys = None
+        with self._lock:
+            for word in sorted(set(tokenize(text)), key=len, reverse=True):
+                node = self.root
+                for char in word:
+                    node = node.get(char)
+                    if node is None:
+                        return []
+                keys = set(node[None]) if keys is None else keys & node[None]
+            if not keys:
+                return []
+
+            def order(key):
+                title = self.titles[key]
+                return (rank(key) if rank else 0), len(title), title.lower()
+
+            return [
+                (key, self.titles[key])
+                for key in heapq.nsmallest(limit, keys, key=order)
+            ]
+
+    def rebuild(self, entries):
+        """Replace the contents with entries, pairs of a key and a title,
+        and save."""
+        fresh = PrefixIndex()
+        for key, title in entries:
+            fresh.add(key, title)
+        with self.locked():
+            self.titles = fresh.titles
+            self.root = fresh.root
+            self.save()
+
+    def _dump(self):
+        return self.titles
+
+    def _load(self, state):
+        fresh = PrefixIndex()
+        for key, title in state.items():
+            fresh.add(key, title)
+        self.titles = fresh.titles
+        self.root = fresh.root
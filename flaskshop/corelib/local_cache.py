@@ -1,22 +1,115 @@
-class LocalCache:
-    def __init__(self, size=10000):
-        self.dataset = {}
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_monotonic = time.monotonic
+
+
+def _sizeof(value, depth=3):
+    """Rough deep size in bytes of the plain containers we keep in memory."""
+    size = sys.getsizeof(value)
+    if depth <= 0:
+        return size
+    if isinstance(value, dict):
+        size += sum(
+            _sizeof(k, depth - 1) + _sizeof(v, depth - 1) for k, v in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(_sizeof(v, depth - 1) for v in value)
+    return size
+
+
+class LRUCache:
+    """A bounded in-process store that evicts the least recently used entry
+    and supports a per-entry expire time in seconds.
+
+    size bounds the number of entries, max_bytes optionally bounds their
+    estimated memory as well. All operations are O(1) and thread safe.
+    """
+
+    def __init__(self, size=1000, max_bytes=0):
+        self.dataset = OrderedDict()
         self.size = size
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def __repr__(self):
+        return f"<LRUCache {len(self.dataset)}/{self.size}>"
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self.dataset.get(key)
+            if item is not None:
+                value, expire_at, _ = item
+                if not expire_at or expire_at > _monotonic():
+                    self.dataset.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def set(self, key, value, time=0):
+        expire_at = _monotonic() + time if time else 0
+        nbytes = _sizeof(value) if self.max_bytes else 0
+        with self._lock:
+            self._pop(key)
+            self.dataset[key] = (value, expire_at, nbytes)
+            self.nbytes += nbytes
+            while len(self.dataset) > self.size or (
+                self.max_bytes and self.nbytes > self.max_bytes and self.dataset
+            ):
+                _, (_, _, evicted) = self.dataset.popitem(last=False)
+                self.nbytes -= evicted
+                self.evictions += 1
+        return True
+
+    def _pop(self, key):
+        item = self.dataset.pop(key, None)
+        if item is not None:
+            self.nbytes -= item[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._pop(key)
+        return True
+
+    def keys(self):
+        with self._lock:
+            return list(self.dataset)
 
     def clear(self):
-        self.dataset.clear()
+        with self._lock:
+            self.dataset.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self.dataset),
+            "bytes": self.nbytes,
+        }
+
 
-    def _cache(self, key, value):
-        if len(self.dataset) >= self.size:
-            self.clear()
-        self.dataset[key] = value
+class LocalCache(LRUCache):
+    """Memcache-like facade over LRUCache used for the props cache."""
+
+    def __init__(self, size=10000, max_bytes=0):
+        super().__init__(size, max_bytes)
 
     def __repr__(self):
         return "<LocalCache>"
 
-    def get(self, key):
-        return self.dataset.get(key)
-
     def get_multi(self, keys):
         return dict((k, self.get(k)) for k in keys)
 
@@ -24,25 +117,24 @@ class LocalCache:
         return [self.get(k) for k in keys]
 
     def set(self, key, value, time=0, compress=True):
-        self._cache(key, value)
+        return super().set(key, value, time)
+
+    def delete_multi(self, keys, *args, **kwargs):
+        with self._lock:
+            for k in keys:
+                self._pop(k)
         return True
 
     def __getattr__(self, name):
-        if name in ("add", "replace", "delete", "incr", "decr", "prepend", "append"):
+        if name in ("add", "replace", "incr", "decr", "prepend", "append"):
 
             def func(key, *args, **kwargs):
-                self.dataset.pop(key, None)
+                self.delete(key)
                 return True
 
             return func
-        elif name in ("append_multi", "prepend_multi", "delete_multi"):
-
-            def func2(keys, *args, **kwargs):
-                for k in keys:
-                    self.dataset.pop(k, None)
-                return True
-
-            return func2
+        elif name in ("append_multi", "prepend_multi"):
+            return self.delete_multi
         raise AttributeError(name)
 
 
@@ -1,14 +1,40 @@
 import functools
 import inspect
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from fnmatch import fnmatchcase
 from pickle import UnpicklingError
 
 from flask import current_app
-from sqlalchemy.ext.serializer import dumps, loads
+from redis.exceptions import LockError
 
 from flaskshop.corelib.db import rdb
-from flaskshop.corelib.utils import Empty, empty
+from flaskshop.corelib.local_cache import LRUCache
+from flaskshop.corelib.serializer import default_serializer
+from flaskshop.corelib.utils import Empty, empty, generate_id
 
 BUILTIN_TYPES = (int, bytes, str, float, bool)
+MC_CHANNEL_INVALIDATE = "mc:invalidate"
+# prefixes keep these out of the "product:featured:*" like invalidation patterns
+MC_KEY_LOCK = "lock:{}"
+MC_KEY_STALE = "stale:{}"
+MC_KEY_TAG = "mc:tag:{}"
+MC_KEY_VERSION = "mc:version:{}"
+LOCK_LEASE = 5  # seconds a worker may hold a recompute lock
+LOCK_POLL_INTERVAL = 0.05
+
+# per-process tier in front of redis, only used by cache(..., local_expire=n)
+local_mc = LRUCache(size=2000)
+_local_patterns = set()
+_local_tag_patterns = set()
+_local_tag_keys = defaultdict(set)
+_missing = object()
+_subscriber_lock = threading.Lock()
+_subscriber_pid = None
 
 
 def gen_key_factory(key_pattern, arg_names, defaults):
@@ -34,12 +60,328 @@ def gen_key_factory(key_pattern, arg_names, defaults):
     return gen_key
 
 
-def cache(key_pattern, expire=None):  # noqa: C901
+def dump_value(r, serializer=default_serializer):
+    """Serialize a value the way :func:`cache` stores it in redis."""
+    if r is None:
+        return serializer.dumps(empty)
+    if not isinstance(r, BUILTIN_TYPES):
+        return serializer.dumps(r)
+    return r
+
+
+def load_value(r, serializer=default_serializer):
+    """Reverse of :func:`dump_value`, ``None`` is returned for cached empties."""
+    try:
+        r = serializer.loads(r)
+    except (TypeError, UnpicklingError):
+        pass
+    if isinstance(r, Empty):
+        r = None
+    if isinstance(r, bytes):
+        r = r.decode()
+    return r
+
+
+def cache_multi(
+    key_pattern, ids, fetch_multi, expire=None, serializer=default_serializer
+):
+    """Batched counterpart of :func:`cache` for keys like ``"global:Product:{}"``.
+
+    All keys are read with one MGET, ``fetch_multi(missing_ids)`` must return
+    a ``{id: value}`` dict for the misses, which are written back in one
+    pipeline. Values are returned in the order of ``ids``.
+    """
+    ids = list(ids)
+    if not ids:
+        return []
+    if not current_app.config["USE_REDIS"]:
+        found = fetch_multi(list(dict.fromkeys(ids)))
+        return [found.get(id) for id in ids]
+
+    unique_ids = list(dict.fromkeys(ids))
+    keys = [key_pattern.format(id).replace(" ", "_") for id in unique_ids]
+    values = dict(zip(unique_ids, rdb.mget(keys)))
+    missing = [id for id in unique_ids if values[id] is None]
+    if missing:
+        found = fetch_multi(missing)
+        pipe = rdb.pipeline(transaction=False)
+        for id in missing:
+            values[id] = dump_value(found.get(id), serializer)
+            pipe.set(key_pattern.format(id).replace(" ", "_"), values[id], expire)
+        pipe.execute()
+    loaded = {id: load_value(r, serializer) for id, r in values.items()}
+    return [loaded[id] for id in ids]
+
+
+def _on_invalidate(message):
+    data = json.loads(message["data"])
+    for key in data["keys"]:
+        _drop_local(key)
+    for tag in data["tags"]:
+        _drop_local_tag(tag)
+
+
+def _ensure_subscriber():
+    """Listen for invalidations of other workers, once per process."""
+    global _subscriber_pid
+    pid = os.getpid()
+    if _subscriber_pid == pid:
+        return
+    with _subscriber_lock:
+        if _subscriber_pid == pid:
+            return
+        # a forked worker must not trust what its parent cached
+        local_mc.clear()
+        _local_tag_keys.clear()
+        pubsub = rdb.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{MC_CHANNEL_INVALIDATE: _on_invalidate})
+        pubsub.run_in_thread(sleep_time=1, daemon=True)
+        _subscriber_pid = pid
+
+
+def _drop_local(key):
+    if any(c in key for c in "*?["):
+        for k in local_mc.keys():
+            if fnmatchcase(k, key):
+                local_mc.delete(k)
+    else:
+        local_mc.delete(key)
+
+
+def _drop_local_tag(tag):
+    for key in _local_tag_keys.pop(tag, ()):
+        local_mc.delete(key)
+
+
+def _matches_any(name, patterns):
+    return any(
+        fnmatchcase(name, pattern) or fnmatchcase(pattern, name)
+        for pattern in patterns
+    )
+
+
+def _publish_invalidate(keys=(), tags=()):
+    keys = [k.decode() if isinstance(k, bytes) else k for k in keys]
+    keys = [k for k in keys if _matches_any(k, _local_patterns)]
+    tags = [t for t in tags if _matches_any(t, _local_tag_patterns)]
+    if not keys and not tags:
+        return
+    for key in keys:
+        _drop_local(key)
+    for tag in tags:
+        _drop_local_tag(tag)
+    rdb.publish(MC_CHANNEL_INVALIDATE, json.dumps({"keys": keys, "tags": tags}))
+
+
+def invalidate(*keys):
+    """Delete cached keys from redis and from the local tier of every worker."""
+    if not keys:
+        return
+    rdb.delete(*keys)
+    if current_app.config["USE_REDIS"]:
+        _publish_invalidate(keys=keys)
+
+
+def invalidate_tags(*tags):
+    """Invalidate every key cached with one of these tags.
+
+    Each tag only has a version counter in redis, bumping it is O(1) however
+    many keys carry the tag; values stored under an older version are misses.
+    """
+    if not tags or not current_app.config["USE_REDIS"]:
+        return
+    pipe = rdb.pipeline(transaction=False)
+    for tag in tags:
+        pipe.incr(MC_KEY_TAG.format(tag))
+    pipe.execute()
+    _publish_invalidate(tags=tags)
+
+
+class LocalSnapshot:
+    """A value kept in each process and rebuilt only after :meth:`bump`
+    changed its version counter in redis, which costs one GET per read.
+
+    Without redis a bump only reaches the process making it, so the value
+    is also rebuilt once it is local_expire seconds old.
+
+    Use it for small read-mostly data every page needs; build must return
+    objects detached from the session, they are shared between requests.
+    """
+
+    def __init__(self, name, build, local_expire=60):
+        self.name = name
+        self.key = MC_KEY_VERSION.format(name)
+        self.build = build
+        self.local_expire = local_expire
+        self._lock = threading.Lock()
+
+    def _state(self):
+        # per app, tests and scripts may create several
+        return current_app.extensions.setdefault("local_snapshots", {}).setdefault(
+            self.name,
+            {"version": _missing, "value": None, "local_version": 0, "expires": 0},
+        )
+
+    def _version(self, state):
+        if current_app.config["USE_REDIS"]:
+            return rdb.get(self.key) or b"0"
+        return state["local_version"]
+
+    def _outdated(self, state, version):
+        if state["version"] != version:
+            return True
+        if current_app.config["USE_REDIS"]:
+            return False
+        return time.monotonic() > state["expires"]
+
+    def get(self):
+        state = self._state()
+        version = self._version(state)
+        if self._outdated(state, version):
+            with self._lock:
+                if self._outdated(state, version):
+                    state["value"] = self.build()
+                    state["version"] = version
+                    state["expires"] = time.monotonic() + self.local_expire
+        return state["value"]
+
+    def bump(self):
+        """Make every process rebuild the value on its next read."""
+        self._state()["local_version"] += 1
+        if current_app.config["USE_REDIS"]:
+            rdb.incr(self.key)
+
+
+def _to_bytes(r):
+    if isinstance(r, bytes):
+        return r
+    return str(r).encode()
+
+
+def _wrap(r, versions):
+    """Prefix a dumped value with the tag versions it was computed under."""
+    if versions is None:
+        return r
+    return versions + b"|" + _to_bytes(r)
+
+
+def _unwrap(r, versions=None):
+    """Strip the tag versions of a stored value, None if they are outdated."""
+    if r is None:
+        return None
+    stored_versions, _, r = r.partition(b"|")
+    if versions is not None and stored_versions != versions:
+        return None
+    return r
+
+
+def _read(key, soft_expire=None, tag_keys=()):
+    """Read key, its stale copy and the current versions of its tags at once."""
+    if not soft_expire and not tag_keys:
+        return rdb.get(key), None, None
+    keys = [key, MC_KEY_STALE.format(key)] if soft_expire else [key]
+    values = rdb.mget(keys + list(tag_keys))
+    r, stale = values[0], values[1] if soft_expire else None
+    if not tag_keys:
+        return r, stale, None
+    versions = b",".join(_to_bytes(v or 0) for v in values[len(keys):])
+    fresh = _unwrap(r, versions)
+    if fresh is None and stale is None and soft_expire:
+        # a copy from before the tags were invalidated is still a stale copy
+        stale = r
+    return fresh, _unwrap(stale), versions
+
+
+def _store(
+    key,
+    value,
+    expire=None,
+    soft_expire=None,
+    versions=None,
+    serializer=default_serializer,
+):
+    r = dump_value(value, serializer)
+    stored = _wrap(r, versions)
+    if soft_expire:
+        pipe = rdb.pipeline(transaction=False)
+        pipe.set(key, stored, soft_expire)
+        pipe.set(MC_KEY_STALE.format(key), stored, expire)
+        pipe.execute()
+    else:
+        rdb.set(key, stored, expire)
+    return r
+
+
+def _recompute(
+    key,
+    compute,
+    expire=None,
+    soft_expire=None,
+    stale=None,
+    tag_keys=(),
+    versions=None,
+    serializer=default_serializer,
+):
+    """Let only one worker recompute key, the others serve stale or wait."""
+    lock = rdb.lock(MC_KEY_LOCK.format(key), timeout=LOCK_LEASE)
+    if lock.acquire(blocking=False, token=generate_id()):
+        try:
+            return _store(key, compute(), expire, soft_expire, versions, serializer)
+        finally:
+            try:
+                # compares the token and deletes in one script
+                lock.release()
+            except LockError:
+                pass  # the lease ran out and another worker may hold it now
+    if stale is not None:
+        return stale
+    deadline = time.monotonic() + LOCK_LEASE
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        r, _, _ = _read(key, tag_keys=tag_keys)
+        if r is not None:
+            return r
+    return _store(key, compute(), expire, soft_expire, versions, serializer)
+
+
+def cache(  # noqa: C901
+    key_pattern,
+    expire=None,
+    local_expire=None,
+    lock=False,
+    soft_expire=None,
+    tags=(),
+    serializer=default_serializer,
+):
+    """Cache the result of f in redis.
+
+    With local_expire the loaded value is also kept in this process for at
+    most local_expire seconds, saving the network hop and the unpickle. Use it
+    only for read-mostly values that callers never modify or add to a session;
+    the entry is dropped in every worker when the key goes through
+    :func:`invalidate` or one of its tags through :func:`invalidate_tags`.
+
+    With lock a miss is recomputed by a single worker holding a redis lease,
+    the other workers wait for its result instead of recomputing it too.
+    soft_expire implies lock: the value is fresh for soft_expire seconds and a
+    copy is kept until expire, which is served while one worker refreshes an
+    expired or invalidated key.
+
+    tags are formatted like key_pattern, e.g. ``("category:{self.category_id}",)``,
+    and let :func:`invalidate_tags` drop whole groups of keys without KEYS.
+
+    serializer turns non builtin values into bytes, the default one stores
+    only the column values of mapped instances.
+    """
+
     def deco(f):
         arg_names, varargs, varkw, defaults, *_ = inspect.getfullargspec(f)
         if varargs or varkw:
             raise Exception("do not support varargs")
         gen_key = gen_key_factory(key_pattern, arg_names, defaults)
+        if local_expire and not callable(key_pattern):
+            _local_patterns.add(re.sub(r"{[^}]*}", "*", key_pattern))
+            _local_tag_patterns.update(re.sub(r"{[^}]*}", "*", t) for t in tags)
 
         @functools.wraps(f)
         def _(*a, **kw):
@@ -49,25 +391,41 @@ def cache(key_pattern, expire=None):  # noqa: C901
             if not key:
                 return f(*a, **kw)
             force = kw.pop("force", False)
-            r = rdb.get(key) if not force else None
+            key_tags = [t.format(**args) for t in tags]
+            if local_expire:
+                _ensure_subscriber()
+                r = local_mc.get(key, _missing) if not force else _missing
+                if r is not _missing:
+                    return r
+            tag_keys = [MC_KEY_TAG.format(t) for t in key_tags]
+            r, stale, versions = _read(key, soft_expire, tag_keys)
+            if force:
+                r = None
             if r is None:
-                r = f(*a, **kw)
-                if r is not None:
-                    if not isinstance(r, BUILTIN_TYPES):
-                        r = dumps(r)
-                    rdb.set(key, r, expire)
+                if lock or soft_expire:
+                    r = _recompute(
+                        key,
+                        lambda: f(*a, **kw),
+                        expire,
+                        soft_expire,
+                        stale,
+                        tag_keys,
+                        versions,
+                        serializer,
+                    )
                 else:
-                    r = dumps(empty)
-                    rdb.set(key, r, expire)
-
-            try:
-                r = loads(r)
-            except (TypeError, UnpicklingError):
-                pass
-            if isinstance(r, Empty):
-                r = None
-            if isinstance(r, bytes):
-                r = r.decode()
+                    r = _store(
+                        key,
+                        f(*a, **kw),
+                        expire,
+                        versions=versions,
+                        serializer=serializer,
+                    )
+            r = load_value(r, serializer)
+            if local_expire:
+                local_mc.set(key, r, local_expire)
+                for tag in key_tags:
+                    _local_tag_keys[tag].add(key)
             return r
 
         _.original_function = f
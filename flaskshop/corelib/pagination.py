@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import json
+import math
+from datetime import datetime
+from functools import cached_property
+
+from flask import current_app, request, url_for
+from sqlalchemy import and_, or_
+
+from flaskshop.corelib.local_cache import lc
+from flaskshop.corelib.mc import cache
+
+MC_KEY_APPROX_COUNT = "pagination:count:{}:{}"
+COUNT_EXPIRE = 300
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except ValueError:
+        return None
+    return values if isinstance(values, list) else None
+
+
+@cache(
+    MC_KEY_APPROX_COUNT.format("{table}", "{digest}"), expire=COUNT_EXPIRE, lock=True
+)
+def _approx_count(table, digest, query):
+    return query.order_by(None).count()
+
+
+def _local_approx_count(table, digest, query):
+    # without redis each process keeps its own counts for as long
+    key = MC_KEY_APPROX_COUNT.format(table, digest)
+    count = lc.get(key)
+    if count is None:
+        count = query.order_by(None).count()
+        lc.set(key, count, COUNT_EXPIRE)
+    return count
+
+
+class KeysetPagination:
+    """Pages through a query newest first by its sort column and id instead
+    of OFFSET, so every page is one range scan on the index however deep
+    it is. Pages are addressed by a cursor holding the key of the item
+    before (after) them, and the total is a count cached for COUNT_EXPIRE
+    seconds per filter combination, which is why it is approximate.
+
+    It offers what the dashboard lists need from a flask-sqlalchemy
+    Pagination (items, total, pages) plus prev_url and next_url.
+    """
+
+    keyset = True
+
+    def __init__(self, query, sort_column, per_page=10, after=None, before=None):
+        model = query.column_descriptions[0]["entity"]
+        self.model = model
+        self.query = query
+        self.per_page = per_page
+        self.key_columns = [sort_column]
+        if sort_column is not model.id:
+            self.key_columns.append(model.id)
+
+        key = self._parse(before or after)
+        backwards = key is not None and bool(before)
+        q = query.order_by(
+            *(col.asc() if backwards else col.desc() for col in self.key_columns)
+        )
+        if key is not None:
+            q = q.filter(self._beyond(key, backwards))
+        rows = q.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+        self.items = rows
+        self.has_prev = more if backwards else key is not None
+        self.has_next = key is not None if backwards else more
+
+    @classmethod
+    def from_request(cls, query, sorts, per_page=10):
+        """Read the sort name out of sorts and the cursors from the request
+        args. The first of sorts is the default."""
+        sort = request.args.get("sort")
+        if sort not in sorts:
+            sort = next(iter(sorts))
+        pagination = cls(
+            query,
+            sorts[sort],
+            per_page=per_page,
+            after=request.args.get("after"),
+            before=request.args.get("before"),
+        )
+        pagination.sort = sort
+        pagination.sorts = list(sorts)
+        return pagination
+
+    def _parse(self, cursor):
+        values = cursor and decode_cursor(cursor)
+        if not values or len(values) != len(self.key_columns):
+            return None
+        try:
+            return [
+                datetime.fromisoformat(value)
+                if col.type.python_type is datetime
+                else col.type.python_type(value)
+                for col, value in zip(self.key_columns, values)
+            ]
+        except (TypeError, ValueError):
+            return None
+
+    def _beyond(self, key, backwards):
+        # (a, b) < (x, y) spelled out, which every database can use an index for
+        (col, value), *rest = zip(self.key_columns, key)
+        beyond = col > value if backwards else col < value
+        if not rest:
+            return beyond
+        (id_col, id_value), = rest
+        return or_(
+            beyond,
+            and_(col == value, id_col > id_value if backwards else id_col < id_value),
+        )
+
+    def _cursor(self, item):
+        return encode_cursor([getattr(item, col.key) for col in self.key_columns])
+
+    def _url(self, **kwargs):
+        args = request.args.to_dict()
+        args.pop("after", None)
+        args.pop("before", None)
+        args.update(kwargs)
+        return url_for(request.endpoint, **request.view_args, **args)
+
+    @property
+    def prev_url(self):
+        if self.has_prev and self.items:
+            return self._url(before=self._cursor(self.items[0]))
+
+    @property
+    def next_url(self):
+        if self.has_next and self.items:
+            return self._url(after=self._cursor(self.items[-1]))
+
+    def sort_url(self, sort):
+        return self._url(sort=sort)
+
+    @cached_property
+    def total(self):
+        statement = self.query.statement.compile()
+        digest = hashlib.md5(
+            f"{statement}{sorted(statement.params.items())}".encode()
+        ).hexdigest()
+        table = self.model.__tablename__
+        if not current_app.config["USE_REDIS"]:
+            return _local_approx_count(table, digest, self.query)
+        return int(_approx_count(table, digest, self.query))
+
+    @property
+    def pages(self):
+        return math.ceil(self.total / self.per_page)
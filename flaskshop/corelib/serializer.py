@@ -0,0 +1,102 @@
+"""Serializers used by corelib.mc to store values in redis."""
+import pickle
+
+from sqlalchemy import inspect
+from sqlalchemy.ext import serializer as sa_serializer
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import instance_dict
+
+
+class PickleSerializer:
+    """Pickles whole mapped instances, state included, with
+    sqlalchemy.ext.serializer."""
+
+    def dumps(self, value):
+        return sa_serializer.dumps(value)
+
+    def loads(self, data):
+        return sa_serializer.loads(data)
+
+
+class _Row:
+    """Column values of one mapped instance."""
+
+    __slots__ = ("cls", "keys", "values")
+
+    def __init__(self, cls, keys, values):
+        self.cls = cls
+        self.keys = keys
+        self.values = values
+
+    def __reduce__(self):
+        return _Row, (self.cls, self.keys, self.values)
+
+
+class ModelSerializer:
+    """Stores only the column values of mapped instances and rebuilds them
+    as detached instances through the mapper.
+
+    Lists, tuples and dicts of instances are supported, other values are
+    pickled as is. Data written by another serializer is handed to
+    fallback, so values cached before a switch still load.
+    """
+
+    MAGIC = b"MS1:"
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback or PickleSerializer()
+        self._columns = {}
+
+    def _column_keys(self, cls):
+        keys = self._columns.get(cls)
+        if keys is None:
+            # one tuple per class, so pickle memoizes it across rows
+            keys = self._columns[cls] = tuple(
+                attr.key for attr in inspect(cls).column_attrs
+            )
+        return keys
+
+    def _pack(self, value):
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._pack(v) for v in value)
+        if isinstance(value, dict):
+            return {k: self._pack(v) for k, v in value.items()}
+        if hasattr(value, "__mapper__"):
+            cls = type(value)
+            keys = self._column_keys(cls)
+            values = tuple(self._plain(getattr(value, key)) for key in keys)
+            return _Row(cls, keys, values)
+        return value
+
+    @staticmethod
+    def _plain(value):
+        # e.g. MutableDict of a JSON column, which would drag its parents along
+        if isinstance(value, dict) and type(value) is not dict:
+            return dict(value)
+        return value
+
+    def _unpack(self, value):
+        if isinstance(value, _Row):
+            obj = inspect(value.cls).class_manager.new_instance()
+            # filled like a query result would, then marked as persisted
+            instance_dict(obj).update(zip(value.keys, value.values))
+            make_transient_to_detached(obj)
+            return obj
+        if isinstance(value, (list, tuple)):
+            return type(value)(self._unpack(v) for v in value)
+        if isinstance(value, dict):
+            return {k: self._unpack(v) for k, v in value.items()}
+        return value
+
+    def dumps(self, value):
+        return self.MAGIC + pickle.dumps(
+            self._pack(value), protocol=pickle.HIGHEST_PROTOCOL
+        )
+
+    def loads(self, data):
+        if isinstance(data, bytes) and data.startswith(self.MAGIC):
+            return self._unpack(pickle.loads(data[len(self.MAGIC):]))  # noqa: E203
+        return self.fallback.loads(data)
+
+
+default_serializer = ModelSerializer()
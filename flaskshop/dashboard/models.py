@@ -1,6 +1,7 @@
 from flask import request, url_for
 
-from flaskshop.constant import SettingValueType
+from flaskshop.constant import SettingValueType, SiteDefaultSettings
+from flaskshop.corelib.mc import LocalSnapshot
 from flaskshop.database import Column, Model, db
 
 
@@ -68,6 +69,40 @@ class Setting(Model):
 
             db.session.add(setting)
         db.session.commit()
+        site_settings.bump()
+
+    @classmethod
+    def create_missing(cls):
+        """Store the SiteDefaultSettings items not in the database yet."""
+        keys = list(SiteDefaultSettings)
+        existing = {
+            key for key, in cls.query.with_entities(cls.key).filter(cls.key.in_(keys))
+        }
+        for key in keys:
+            if key not in existing:
+                db.session.add(cls(key=key, **SiteDefaultSettings[key]))
+        db.session.commit()
+
+    @classmethod
+    def get_site_settings(cls):
+        """The SiteDefaultSettings items by key, shared between requests."""
+        return site_settings.get()
 
     def __repr__(self):
         return f"<{self.__class__.__name__} {self.key}>"
+
+
+def _load_site_settings():
+    # copies outside the session, the defaults standing in for missing rows
+    keys = list(SiteDefaultSettings)
+    rows = Setting.query.with_entities(*Setting.__table__.columns).filter(
+        Setting.key.in_(keys)
+    )
+    settings = {row.key: Setting(**row._mapping) for row in rows}
+    for key in keys:
+        if key not in settings:
+            settings[key] = Setting(key=key, **SiteDefaultSettings[key])
+    return settings
+
+
+site_settings = LocalSnapshot("site_settings", _load_site_settings)
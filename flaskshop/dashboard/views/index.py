@@ -5,6 +5,7 @@ from flask import render_template
 
 from flaskshop.account.models import User
 from flaskshop.constant import OrderEvents, OrderStatusKinds
+from flaskshop.corelib.db import prefetch_props
 from flaskshop.extensions import db
 from flaskshop.order.models import Order, OrderEvent, OrderLine
 from flaskshop.product.models import Product
@@ -28,16 +29,18 @@ def index():
         db.session.query(OrderLine.product_id, func.count(OrderLine.product_id))
         .group_by(OrderLine.product_id)
         .order_by(func.count(OrderLine.product_id).desc())
+        .limit(5)
         .all()
     )
     top5_products = []
-    for product_id, order_count in hot_product_ids[:5]:
-        p = Product.get_by_id(product_id)
+    hot_products = Product.get_multi_by_ids(id for id, _ in hot_product_ids)
+    for p, (_, order_count) in zip(hot_products, hot_product_ids):
         # product may deleted
         if not p:
             continue
         p.order_count = order_count
         top5_products.append(p)
+    prefetch_props(top5_products)
 
     activity = OrderEvent.query.order_by(OrderEvent.id.desc()).limit(10)
 
@@ -2,12 +2,12 @@ from flask import render_template, request, flash
 from flask_babel import lazy_gettext
 
 from flaskshop.constant import OrderStatusKinds
+from flaskshop.corelib.pagination import KeysetPagination
 from flaskshop.order.models import Order
 
 
 def orders():
-    page = request.args.get("page", type=int, default=1)
-    query = Order.query.order_by(Order.id.desc())
+    query = Order.query
 
     status = request.args.get("status", type=int)
     if status:
@@ -21,7 +21,9 @@ def orders():
     ended_at = request.args.get("ended_at", type=str)
     if ended_at:
         query = query.filter(Order.created_at <= ended_at)
-    pagination = query.paginate(page=page, per_page=10)
+    pagination = KeysetPagination.from_request(
+        query, {"id": Order.id, "created_at": Order.created_at}
+    )
     props = {
         "id": lazy_gettext("ID"),
         "identity": lazy_gettext("Identity"),
@@ -53,6 +55,8 @@ def send_order(id):
 
 def draft_order(id):
     order = Order.get_by_id(id)
-    order.draft()
-    flash(lazy_gettext("Order is draft."), "success")
+    if order.draft():
+        flash(lazy_gettext("Order is draft."), "success")
+    else:
+        flash(lazy_gettext("Only unpaid orders can be made drafts."), "warning")
     return render_template("order/detail.html", order=order)
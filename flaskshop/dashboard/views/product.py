@@ -1,6 +1,7 @@
 from flask import redirect, render_template, request, url_for, flash
 from flask_babel import lazy_gettext
 
+from flaskshop.corelib.pagination import KeysetPagination
 from flaskshop.dashboard.forms import (
     AttributeForm,
     CategoryForm,
@@ -194,7 +195,6 @@ product_type_del = wrap_partial(item_del, ProductType)
 
 
 def products():
-    page = request.args.get("page", type=int, default=1)
     query = Product.query
 
     on_sale = request.args.get("sale", type=int)
@@ -213,7 +213,9 @@ def products():
     if ended_at:
         query = query.filter(Product.created_at <= ended_at)
 
-    pagination = query.paginate(page=page, per_page=10)
+    pagination = KeysetPagination.from_request(
+        query, {"id": Product.id, "created_at": Product.created_at}
+    )
     props = {
         "id": lazy_gettext("ID"),
         "title": lazy_gettext("Title"),
@@ -217,6 +217,7 @@ def plugin_disable(id):
 
 
 def site_setting():
+    Setting.create_missing()
     settings = Setting.query.all()
     form = generate_settings_form(settings)()
 
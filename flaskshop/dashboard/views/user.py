@@ -4,13 +4,13 @@ from flask_login import current_user
 from sqlalchemy import or_
 
 from flaskshop.account.models import Role, User, UserAddress, UserRole
+from flaskshop.corelib.pagination import KeysetPagination
 from flaskshop.dashboard.forms import UserAddressForm, UserForm
 from flaskshop.dashboard.utils import wrap_partial, item_del
 from flaskshop.order.models import Order
 
 
 def users():
-    page = request.args.get("page", type=int, default=1)
     search_word = request.args.get("keyword")
     query = User.query
     if search_word:
@@ -20,7 +20,9 @@ def users():
                 User.email.like("%" + search_word + "%"),
             )
         )
-    pagination = query.paginate(page=page, per_page=10)
+    pagination = KeysetPagination.from_request(
+        query, {"id": User.id, "created_at": User.created_at}
+    )
     props = {
         "id": lazy_gettext("ID"),
         "username": lazy_gettext("Username"),
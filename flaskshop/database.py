@@ -1,6 +1,8 @@
 import datetime
 
-from flaskshop.corelib.mc import cache, rdb
+from flask import g, has_request_context
+
+from flaskshop.corelib.mc import cache, cache_multi, invalidate
 
 from .extensions import db
 
@@ -8,6 +10,69 @@ Column = db.Column
 MC_KEY_GET_BY_ID = "global:{}:{}"
 
 
+class IdentityMap(dict):
+    """Objects already looked up by get_by_id in the current request,
+    keyed by (class name, id). hits counts the lookups it answered."""
+
+    hits = 0
+
+
+def get_identity_map():
+    if not has_request_context():
+        return None
+    if "identity_map" not in g:
+        g.identity_map = IdentityMap()
+    return g.identity_map
+
+
+def init_identity_map(app):
+    @app.after_request
+    def identity_map_header(response):
+        if app.debug and "identity_map" in g:
+            response.headers["X-Identity-Map-Hits"] = str(g.identity_map.hits)
+        return response
+
+    @app.teardown_request
+    def clear_identity_map(exc=None):
+        g.pop("identity_map", None)
+
+
+class preloadable:
+    """A read-only property whose values Model.preload can fetch for a whole
+    list of objects at once.
+
+    The batch loader is registered like a property setter and is called as
+    ``batch(cls, objs)``, returning one value per object in order. Values
+    are kept on the object for the current request only, objects shared
+    through the caches or living on load them again in the next one.
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.batch_fget = None
+        self.attr = f"_preloaded_{fget.__name__}"
+        self.__doc__ = fget.__doc__
+
+    def batch(self, fget):
+        self.batch_fget = fget
+        return self
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if self.is_loaded(obj):
+            return obj.__dict__[self.attr][1]
+        return self.fget(obj)
+
+    def is_loaded(self, obj):
+        # tagged with the identity map, which goes with the request
+        memo = obj.__dict__.get(self.attr)
+        return memo is not None and memo[0] is get_identity_map()
+
+    def load(self, obj, value):
+        obj.__dict__[self.attr] = (get_identity_map(), value)
+
+
 class CRUDMixin:
     @classmethod
     def create(cls, **kwargs):
@@ -35,19 +100,84 @@ class CRUDMixin:
         db.session.delete(self)
         return commit and db.session.commit()
 
-    @classmethod
-    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{record_id}"))
-    def get_by_id(cls, record_id):
-        """Get record by ID."""
-        if any(
+    @staticmethod
+    def _is_valid_id(record_id):
+        return any(
             (
                 isinstance(record_id, (str, bytes)) and record_id.isdigit(),
                 isinstance(record_id, (int, float)),
             )
-        ):
+        )
+
+    @classmethod
+    def get_by_id(cls, record_id):
+        """Get record by ID."""
+        identity_map = get_identity_map()
+        if identity_map is None or not cls._is_valid_id(record_id):
+            return cls._get_by_id(record_id)
+        key = (cls.__name__, int(record_id))
+        if key in identity_map:
+            identity_map.hits += 1
+            return identity_map[key]
+        obj = identity_map[key] = cls._get_by_id(record_id)
+        return obj
+
+    @classmethod
+    @cache(MC_KEY_GET_BY_ID.format("{cls.__name__}", "{record_id}"))
+    def _get_by_id(cls, record_id):
+        if cls._is_valid_id(record_id):
             return db.session.get(cls, int(record_id))
         return None
 
+    @classmethod
+    def preload(cls, objs, *names):
+        """Fetch the preloadable properties names of all objs with one query
+        each and attach them, e.g. ``Product.preload(products, "images")``."""
+        objs = [obj for obj in objs if obj is not None]
+        for name in names:
+            prop = getattr(cls, name)
+            pending = [obj for obj in objs if not prop.is_loaded(obj)]
+            if not pending:
+                continue
+            for obj, value in zip(pending, prop.batch_fget(cls, pending)):
+                prop.load(obj, value)
+        return objs
+
+    @classmethod
+    def get_multi_by_ids(cls, record_ids):
+        """Get records by IDs with one cache round-trip and at most one query,
+        the result keeps the order of record_ids and holds None for misses."""
+        record_ids = [
+            int(id) if cls._is_valid_id(id) else None for id in record_ids
+        ]
+
+        def fetch_multi(ids):
+            return {
+                obj.id: obj
+                for obj in cls.query.filter(cls.id.in_(ids)).all()
+            }
+
+        identity_map = get_identity_map()
+        if identity_map is None:
+            identity_map = IdentityMap()
+        found = {}
+        for id in record_ids:
+            if (cls.__name__, id) in identity_map:
+                identity_map.hits += 1
+                found[id] = identity_map[(cls.__name__, id)]
+        missing_ids = [id for id in record_ids if id is not None and id not in found]
+        found.update(
+            zip(
+                missing_ids,
+                cache_multi(
+                    MC_KEY_GET_BY_ID.format(cls.__name__, "{}"), missing_ids, fetch_multi
+                ),
+            )
+        )
+        for id in missing_ids:
+            identity_map[(cls.__name__, id)] = found[id]
+        return [found.get(id) for id in record_ids]
+
     @classmethod
     def get_or_create(cls, **kwargs):
         props = cls.get_db_props(kwargs)
@@ -90,16 +220,27 @@ class CRUDMixin:
 
     @classmethod
     def update_db_props(cls, obj, db_props):
-        for prop, value in db_props.items():
-            obj.set_props_item(prop, value)
+        obj.update_props(db_props)
+
+    @classmethod
+    def _forget_identity(cls, target):
+        identity_map = get_identity_map()
+        if identity_map is not None:
+            identity_map.pop((cls.__name__, target.id), None)
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        cls._forget_identity(target)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
-        rdb.delete(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
+        cls._forget_identity(target)
+        invalidate(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
 
     @classmethod
     def __flush_delete_event__(cls, target):
-        rdb.delete(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
+        cls._forget_identity(target)
+        invalidate(MC_KEY_GET_BY_ID.format(cls.__name__, target.id))
 
 
 class Model(CRUDMixin, db.Model):
@@ -3,12 +3,27 @@ import string
 from datetime import datetime
 from decimal import Decimal
 
+from flask import current_app
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import column_property
+
 from flaskshop.constant import DiscountValueTypeKinds, VoucherTypeKinds
-from flaskshop.corelib.mc import rdb
+from flaskshop.corelib.mc import cache, invalidate, rdb
 from flaskshop.database import Column, Model, db
-from flaskshop.product.models import MC_KEY_PRODUCT_DISCOUNT_PRICE, Category, Product
+from flaskshop.product.models import Category, Product
 
 MC_KEY_SALE_PRODUCT_IDS = "discount:sale:{}:product_ids"
+MC_KEY_SALES = "discount:sales"
+# hash of product id -> id of the sale it is priced by, 0 for none
+MC_KEY_PRODUCT_SALES = "discount:product_sales"
+# what sale changes of the current flush affect, resolved to products after it
+PENDING_SALE_PRODUCTS = "discount:pending_products"
+PENDING_SALE_CATEGORIES = "discount:pending_categories"
+PENDING_SALES = "discount:pending_sales"
+# products resolved from them, cleared from the table once the changes commit
+PENDING_PRODUCT_SALES = "discount:pending_product_sales"
+PRODUCT_SALES_EXPIRE = 3600
+CLEAR_BATCH_SIZE = 1000
 
 
 class Voucher(Model):
@@ -137,23 +152,128 @@ class Sale(Model):
     def discount_value_type_label(self):
         return DiscountValueTypeKinds(int(self.discount_value_type)).name
 
+    def get_discount(self, product):
+        if self.discount_value_type == DiscountValueTypeKinds.fixed.value:
+            return self.discount_value
+        elif self.discount_value_type == DiscountValueTypeKinds.percent.value:
+            price = product.basic_price * self.discount_value / 100
+            return Decimal(price).quantize(Decimal("0.00"))
+
+    @classmethod
+    @cache(MC_KEY_SALES, local_expire=60)
+    def get_sales(cls):
+        return {sale.id: sale for sale in cls.query.all()}
+
+    @classmethod
+    def get_product_sale_ids(cls, products):
+        """Id of the sale pricing each product, 0 if there is none.
+
+        Read from the product -> sale table in redis, the missing entries are
+        computed for all products at once and stored.
+        """
+        ids = [p.id for p in products]
+        found = {}
+        if ids and current_app.config["USE_REDIS"]:
+            found = {
+                id: int(sale_id)
+                for id, sale_id in zip(ids, rdb.hmget(MC_KEY_PRODUCT_SALES, ids))
+                if sale_id is not None
+            }
+        missing = [p for p in products if p.id not in found]
+        if missing:
+            computed = cls._find_product_sale_ids(missing)
+            found.update(computed)
+            if current_app.config["USE_REDIS"]:
+                pipe = rdb.pipeline(transaction=False)
+                pipe.hset(MC_KEY_PRODUCT_SALES, mapping=computed)
+                pipe.ttl(MC_KEY_PRODUCT_SALES)
+                _, ttl = pipe.execute()
+                if ttl < 0:
+                    # entries computed from what a commit was about to
+                    # change are only kept until the table expires
+                    rdb.expire(MC_KEY_PRODUCT_SALES, PRODUCT_SALES_EXPIRE)
+        return [found[id] for id in ids]
+
+    @staticmethod
+    def _find_product_sale_ids(products):
+        # a sale of the product itself wins over one of its category
+        product_ids = {p.id for p in products}
+        category_ids = {p.category_id for p in products}
+        by_product = dict(
+            SaleProduct.query.with_entities(SaleProduct.product_id, SaleProduct.sale_id)
+            .filter(SaleProduct.product_id.in_(product_ids))
+            .order_by(SaleProduct.id.desc())
+        )
+        by_category = dict(
+            SaleCategory.query.with_entities(
+                SaleCategory.category_id, SaleCategory.sale_id
+            )
+            .filter(SaleCategory.category_id.in_(category_ids))
+            .order_by(SaleCategory.id.desc())
+        )
+        return {
+            p.id: by_product.get(p.id) or by_category.get(p.category_id, 0)
+            for p in products
+        }
+
+    @classmethod
+    def get_discounted_prices(cls, products):
+        """Discount of each product, priced with two queries at most."""
+        products = list(products)
+        sales = cls.get_sales()
+        prices = []
+        for product, sale_id in zip(products, cls.get_product_sale_ids(products)):
+            sale = sales.get(sale_id)
+            prices.append(sale.get_discount(product) if sale else 0)
+        return prices
+
     @classmethod
     def get_discounted_price(cls, product):
-        sale_product = SaleProduct.query.filter_by(product_id=product.id).first()
-        if sale_product:
-            sale = Sale.get_by_id(sale_product.sale_id)
-        else:
-            sale_category = SaleCategory.query.filter_by(
-                category_id=product.category.id
-            ).first()
-            sale = Sale.get_by_id(sale_category.sale_id) if sale_category else None
-        if sale is None:
-            return 0
-        if sale.discount_value_type == DiscountValueTypeKinds.fixed.value:
-            return sale.discount_value
-        elif sale.discount_value_type == DiscountValueTypeKinds.percent.value:
-            price = product.basic_price * sale.discount_value / 100
-            return Decimal(price).quantize(Decimal("0.00"))
+        return cls.get_discounted_prices([product])[0]
+
+    @staticmethod
+    def clear_product_sales(product_ids):
+        """Drop the entries of product_ids from the product -> sale table."""
+        if not current_app.config["USE_REDIS"] or not product_ids:
+            return
+        product_ids = list(product_ids)
+        pipe = rdb.pipeline(transaction=False)
+        for i in range(0, len(product_ids), CLEAR_BATCH_SIZE):
+            pipe.hdel(MC_KEY_PRODUCT_SALES, *product_ids[i : i + CLEAR_BATCH_SIZE])
+        pipe.execute()
+
+    @staticmethod
+    def find_affected_products(product_ids=(), category_ids=(), sale_ids=()):
+        """Ids of the products whose sale may change with the given products,
+        categories, including their children, and sales."""
+        product_ids = set(product_ids)
+        category_ids = set(category_ids)
+        if sale_ids:
+            product_ids.update(
+                id
+                for id, in SaleProduct.query.with_entities(SaleProduct.product_id)
+                .filter(SaleProduct.sale_id.in_(sale_ids))
+            )
+            category_ids.update(
+                id
+                for id, in SaleCategory.query.with_entities(SaleCategory.category_id)
+                .filter(SaleCategory.sale_id.in_(sale_ids))
+            )
+        parent_ids = category_ids
+        while parent_ids:
+            parent_ids = {
+                id
+                for id, in Category.query.with_entities(Category.id)
+                .filter(Category.parent_id.in_(parent_ids))
+            } - category_ids
+            category_ids |= parent_ids
+        if category_ids:
+            product_ids.update(
+                id
+                for id, in Product.query.with_entities(Product.id)
+                .filter(Product.category_id.in_(category_ids))
+            )
+        return product_ids
 
     @property
     def categories_ids(self):
@@ -219,14 +339,7 @@ class Sale(Model):
 
     @staticmethod
     def clear_mc(target):
-        # when update sales, need to update product discounts
-        # for (id,) in target.products_ids:
-        #     rdb.delete(MC_KEY_PRODUCT_DISCOUNT_PRICE.format(id))
-
-        # need to process so many states, category update etc.. so delete all
-        keys = rdb.keys(MC_KEY_PRODUCT_DISCOUNT_PRICE.format("*"))
-        for key in keys:
-            rdb.delete(key)
+        invalidate(MC_KEY_SALES)
 
     @classmethod
     def __flush_insert_event__(cls, target):
@@ -242,15 +355,101 @@ class Sale(Model):
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
         target.clear_mc(target)
+        _add_pending(PENDING_SALES, target.id)
 
 
 class SaleCategory(Model):
     __tablename__ = "discount_sale_category"
     sale_id = Column(db.Integer())
-    category_id = Column(db.Integer())
+    # loads the old value when set, for clearing the products it had
+    category_id = column_property(Column(db.Integer()), active_history=True)
+
+    @staticmethod
+    def clear_mc(target):
+        _add_pending(PENDING_SALE_CATEGORIES, *_current_and_old(target, "category_id"))
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        super().__flush_after_update_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_delete_event__(cls, target):
+        super().__flush_delete_event__(target)
+        target.clear_mc(target)
 
 
 class SaleProduct(Model):
     __tablename__ = "discount_sale_product"
     sale_id = Column(db.Integer())
-    product_id = Column(db.Integer())
+    product_id = column_property(Column(db.Integer()), active_history=True)
+
+    @staticmethod
+    def clear_mc(target):
+        _add_pending(PENDING_SALE_PRODUCTS, *_current_and_old(target, "product_id"))
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        super().__flush_after_update_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_delete_event__(cls, target):
+        super().__flush_delete_event__(target)
+        target.clear_mc(target)
+
+
+def _current_and_old(target, key):
+    history = inspect(target).attrs[key].history
+    return [getattr(target, key), *history.deleted]
+
+
+def _add_pending(key, *ids):
+    db.session.info.setdefault(key, set()).update(ids)
+
+
+@event.listens_for(db.session, "after_flush_postexec")
+def resolve_pending_product_sales(session, flush_context):
+    """Resolve the sale changes of a flush to the products they affect,
+    which needs queries flush events must not run."""
+    pending = {
+        key: session.info.pop(key, set())
+        for key in (PENDING_SALE_PRODUCTS, PENDING_SALE_CATEGORIES, PENDING_SALES)
+    }
+    if not any(pending.values()) or not current_app.config["USE_REDIS"]:
+        return
+    session.info.setdefault(PENDING_PRODUCT_SALES, set()).update(
+        Sale.find_affected_products(
+            pending[PENDING_SALE_PRODUCTS],
+            pending[PENDING_SALE_CATEGORIES],
+            pending[PENDING_SALES],
+        )
+    )
+
+
+@event.listens_for(db.session, "after_commit")
+def clear_pending_product_sales(session):
+    """Clear the entries once the changes are visible, so a request reading
+    the table in between cannot store them again from the old rows."""
+    Sale.clear_product_sales(session.info.pop(PENDING_PRODUCT_SALES, None))
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_pending_product_sales(session):
+    for key in (
+        PENDING_SALE_PRODUCTS,
+        PENDING_SALE_CATEGORIES,
+        PENDING_SALES,
+        PENDING_PRODUCT_SALES,
+    ):
+        session.info.pop(key, None)
@@ -57,7 +57,7 @@ class BaseModel(PropsMixin, Model):
 
     @classmethod
     def get_multi(cls, ids):
-        return [cls.get(id) for id in ids]
+        return cls.get_multi_by_ids(ids)
 
     def url(self):
         return f"/{self.__class__.__name__.lower()}/{self.id}"
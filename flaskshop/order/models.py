@@ -2,6 +2,9 @@ from uuid import uuid4
 
 from flask import url_for
 from flask_login import current_user
+from sqlalchemy import func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
 
 from flaskshop.account.models import User, UserAddress
 from flaskshop.checkout.models import ShippingMethod
@@ -11,15 +14,22 @@ from flaskshop.constant import (
     PaymentStatusKinds,
     ShipStatusKinds,
 )
-from flaskshop.database import Column, Model, db
+from flaskshop.corelib.mc import invalidate
+from flaskshop.database import MC_KEY_GET_BY_ID, Column, Model, db
 from flaskshop.discount.models import Voucher
-from flaskshop.product.models import ProductVariant
+from flaskshop.outbox import enqueue, outbox_handler
+from flaskshop.product.models import Product, ProductVariant
 
 # from sqlalchemy.dialects.mysql import TINYINT
 
 
 class Order(Model):
     __tablename__ = "order_order"
+    # the dashboard list pages through it by created_at
+    __table_args__ = (
+        db.Index("ix_order_order_created_at", "created_at"),
+        Model.__table_args__,
+    )
     token = Column(db.String(100), unique=True)
     shipping_address = Column(db.String(255))
     user_id = Column(db.Integer())
@@ -38,29 +48,8 @@ class Order(Model):
 
     @classmethod
     def create_whole_order(cls, cart, note=None):
-        # Step1, certify stock, voucher
-        to_update_variants = []
-        to_update_orderlines = []
-        total_net = 0
-        for line in cart.lines:
-            variant = ProductVariant.get_by_id(line.variant.id)
-            result, msg = variant.check_enough_stock(line.quantity)
-            if result is False:
-                return result, msg
-            variant.quantity_allocated += line.quantity
-            to_update_variants.append(variant)
-            orderline = OrderLine(
-                variant_id=variant.id,
-                quantity=line.quantity,
-                product_name=variant.display_product(),
-                product_sku=variant.sku,
-                product_id=variant.sku.split("-")[0],
-                unit_price_net=variant.price,
-                is_shipping_required=variant.is_shipping_required,
-            )
-            to_update_orderlines.append(orderline)
-            total_net += orderline.get_total()
-
+        # Step1, certify voucher
+        lines = cart.lines
         voucher = None
         if cart.voucher_code:
             voucher = Voucher.get_by_code(cart.voucher_code)
@@ -69,7 +58,18 @@ class Order(Model):
             except Exception as e:
                 return False, str(e)
 
-        # Step2, create Order obj
+        # Step2, reserve stock, the database refuses what is not in stock
+        failed = ProductVariant.reserve_stock(
+            (line.variant, line.quantity) for line in lines
+        )
+        if failed:
+            db.session.rollback()
+            return False, "; ".join(
+                f"{variant.display_product()} has not enough stock"
+                for variant in failed
+            )
+
+        # Step3, create Order obj
         try:
             shipping_method_id = None
             shipping_method_title = None
@@ -85,7 +85,7 @@ class Order(Model):
                     cart.shipping_address_id
                 ).full_address
 
-            order = cls.create(
+            order = cls(
                 user_id=current_user.id,
                 token=str(uuid4()),
                 shipping_method_id=shipping_method_id,
@@ -93,12 +93,30 @@ class Order(Model):
                 shipping_price_net=shipping_method_price,
                 shipping_address=shipping_address,
                 status=OrderStatusKinds.unfulfilled.value,
-                total_net=total_net,
+                total_net=sum(line.variant.price * line.quantity for line in lines),
             )
+            db.session.add(order)
+            db.session.flush()
         except Exception as e:
+            db.session.rollback()
             return False, str(e)
 
-        # Step3, process others
+        # Step4, process others
+        # added through the session for their flush events, which still
+        # writes them in one batched INSERT
+        db.session.add_all(
+            OrderLine(
+                order_id=order.id,
+                variant_id=line.variant.id,
+                quantity=line.quantity,
+                product_name=line.variant.display_product(),
+                product_sku=line.variant.sku,
+                product_id=line.variant.product_id,
+                unit_price_net=line.variant.price,
+                is_shipping_required=line.variant.is_shipping_required,
+            )
+            for line in lines
+        )
         if note:
             order_note = OrderNote(
                 order_id=order.id, user_id=current_user.id, content=note
@@ -109,18 +127,13 @@ class Order(Model):
             order.discount_amount = voucher.get_vouchered_price(cart)
             order.discount_name = voucher.title
             voucher.used += 1
-            db.session.add(order)
             db.session.add(voucher)
-        for variant in to_update_variants:
-            db.session.add(variant)
-        for orderline in to_update_orderlines:
-            orderline.order_id = order.id
-            db.session.add(orderline)
-        for line in cart.lines:
+        for line in lines:
             db.session.delete(line)
         db.session.delete(cart)
 
         db.session.commit()
+        ProductVariant.clear_stock_cache(line.variant for line in lines)
         return order, "success"
 
     def get_absolute_url(self):
@@ -168,7 +181,9 @@ class Order(Model):
 
     @property
     def lines(self):
-        return OrderLine.query.filter(OrderLine.order_id == self.id).all()
+        lines = OrderLine.query.filter(OrderLine.order_id == self.id).all()
+        OrderLine.attach_variants(lines)
+        return lines
 
     @property
     def notes(self):
@@ -186,69 +201,138 @@ class Order(Model):
     def payment(self):
         return OrderPayment.query.filter_by(order_id=self.id).first()
 
-    def pay_success(self, payment):
-        self.status = OrderStatusKinds.fulfilled.value
-        # to resolve another instance with key is already present in this session
-        local_obj = db.session.merge(self)
-        db.session.add(local_obj)
-
-        for line in self.lines:
-            variant = line.variant
-            variant.quantity_allocated -= line.quantity
-            variant.quantity -= line.quantity
-            db.session.add(variant)
+    def _set_status(self, status, from_status):
+        """Move the order to status with a conditional UPDATE, so only one
+        of several concurrent callers wins. False if it was not in
+        from_status anymore."""
+        result = db.session.execute(
+            update(Order)
+            .where(Order.id == self.id, Order.status == from_status)
+            .values(status=status)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return False
+        set_committed_value(self, "status", status)
+        return True
+
+    def _settle_stock(self, consume):
+        """Release what the order allocated with one UPDATE over its lines,
+        and take it out of stock too when consume is set."""
+        lines = select(OrderLine.variant_id).where(OrderLine.order_id == self.id)
+        ordered = (
+            select(func.sum(OrderLine.quantity))
+            .where(
+                OrderLine.order_id == self.id,
+                OrderLine.variant_id == ProductVariant.id,
+            )
+            .scalar_subquery()
+        )
+        values = {"quantity_allocated": ProductVariant.quantity_allocated - ordered}
+        if consume:
+            values["quantity"] = ProductVariant.quantity - ordered
+        db.session.execute(
+            update(ProductVariant)
+            .where(ProductVariant.id.in_(lines))
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
 
-        db.session.commit()
+    def _settled(self):
+        Order._forget_identity(self)
+        invalidate(MC_KEY_GET_BY_ID.format("Order", self.id))
+        variants = db.session.execute(
+            select(ProductVariant.id, ProductVariant.product_id).where(
+                ProductVariant.id.in_(
+                    select(OrderLine.variant_id).where(OrderLine.order_id == self.id)
+                )
+            )
+        ).all()
+        ProductVariant.clear_stock_cache(variants)
 
-        OrderEvent.create(
+    def pay_success(self, payment):
+        # a settled or canceled order is left alone, the payment is still kept
+        if not self._set_status(
+            OrderStatusKinds.fulfilled.value, OrderStatusKinds.unfulfilled.value
+        ):
+            db.session.commit()
+            return False
+        self._settle_stock(consume=True)
+        enqueue(
+            "order_event",
             order_id=self.id,
             user_id=self.user_id,
             type_=OrderEvents.payment_captured.value,
         )
-
-    def cancel(self):
-        self.status = OrderStatusKinds.canceled.value
-        db.session.add(self)
-
-        for line in self.lines:
-            variant = line.variant
-            variant.quantity_allocated -= line.quantity
-            db.session.add(variant)
-
         db.session.commit()
+        self._settled()
+        return True
 
-        OrderEvent.create(
+    def cancel(self):
+        """Cancel an unpaid or draft order, releasing the stock it holds.
+
+        Paid, shipped and completed orders are refused, unlike before stock
+        was settled: their stock is consumed and canceling used to release
+        its allocation a second time.
+        """
+        for from_status in (
+            OrderStatusKinds.unfulfilled.value,
+            OrderStatusKinds.draft.value,
+        ):
+            if self._set_status(OrderStatusKinds.canceled.value, from_status):
+                break
+        else:
+            return False
+        # drafts are only made of unpaid orders, both still hold their stock
+        self._settle_stock(consume=False)
+        enqueue(
+            "order_event",
             order_id=self.id,
             user_id=self.user_id,
             type_=OrderEvents.order_canceled.value,
         )
+        db.session.commit()
+        self._settled()
+        return True
 
     def complete(self):
-        self.update(status=OrderStatusKinds.completed.value)
-        OrderEvent.create(
+        enqueue(
+            "order_event",
             order_id=self.id,
             user_id=self.user_id,
             type_=OrderEvents.order_completed.value,
         )
+        self.update(status=OrderStatusKinds.completed.value)
 
     def draft(self):
-        self.update(status=OrderStatusKinds.draft.value)
-        OrderEvent.create(
+        """Turn an unpaid order into a draft, False for any other, as a
+        draft is canceled like an order still holding its stock."""
+        if not self._set_status(
+            OrderStatusKinds.draft.value, OrderStatusKinds.unfulfilled.value
+        ):
+            return False
+        enqueue(
+            "order_event",
             order_id=self.id,
             user_id=self.user_id,
             type_=OrderEvents.draft_created.value,
         )
+        db.session.commit()
+        Order._forget_identity(self)
+        invalidate(MC_KEY_GET_BY_ID.format("Order", self.id))
+        return True
 
     def delivered(self):
-        self.update(
-            status=OrderStatusKinds.shipped.value,
-            ship_status=ShipStatusKinds.delivered.value,
-        )
-        OrderEvent.create(
+        enqueue(
+            "order_event",
             order_id=self.id,
             user_id=self.user_id,
             type_=OrderEvents.order_delivered.value,
         )
+        self.update(
+            status=OrderStatusKinds.shipped.value,
+            ship_status=ShipStatusKinds.delivered.value,
+        )
 
 
 class OrderLine(Model):
@@ -264,7 +348,17 @@ class OrderLine(Model):
 
     @property
     def variant(self):
-        return ProductVariant.get_by_id(self.variant_id)
+        if "_variant" not in self.__dict__:
+            self._variant = ProductVariant.get_by_id(self.variant_id)
+        return self._variant
+
+    @staticmethod
+    def attach_variants(lines):
+        variants = ProductVariant.get_multi_by_ids(line.variant_id for line in lines)
+        for line, variant in zip(lines, variants):
+            line._variant = variant
+        variants = ProductVariant.preload(variants, "product")
+        Product.preload([v.product for v in variants], "images", "discounted_price")
 
     def get_total(self):
         return self.unit_price_net * self.quantity
@@ -292,22 +386,71 @@ class OrderPayment(Model):
     paid_at = Column(db.DateTime())
 
     def pay_success(self, paid_at):
-        # 异步回调和同步主动查询都会去根据结果更改订单状态，所以先查询下是否已经更改过了
-        if self.status == PaymentStatusKinds.confirmed.value:
-            return
-        self.paid_at = paid_at
-        self.status = PaymentStatusKinds.confirmed.value
-        self.save(commit=False)
+        # 异步回调和同步主动查询都会去根据结果更改订单状态，所以用条件更新保证只处理一次
+        result = db.session.execute(
+            update(OrderPayment)
+            .where(
+                OrderPayment.id == self.id,
+                OrderPayment.status != PaymentStatusKinds.confirmed.value,
+            )
+            .values(status=PaymentStatusKinds.confirmed.value, paid_at=paid_at)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return False
+        set_committed_value(self, "status", PaymentStatusKinds.confirmed.value)
+        set_committed_value(self, "paid_at", paid_at)
         order = Order.get_by_id(self.order_id)
-        order.pay_success(payment=self)
+        return order.pay_success(payment=self)
 
     @property
     def status_human(self):
         return PaymentStatusKinds(int(self.status)).name
 
 
+class OrderPaymentNotify(Model):
+    """Alipay notifications already handled, so repeated callbacks for the
+    same trade are answered without doing the work again."""
+
+    __tablename__ = "order_payment_notify"
+    notify_id = Column(db.String(64), unique=True)
+    trade_no = Column(db.String(64), unique=True)
+    payment_no = Column(db.String(255))
+
+    @classmethod
+    def is_handled(cls, notify_id, trade_no):
+        # == None would be IS NULL, matching every notification missing it too
+        matches = [
+            column == value
+            for column, value in ((cls.notify_id, notify_id), (cls.trade_no, trade_no))
+            if value
+        ]
+        if not matches:
+            return False
+        return db.session.query(cls.id).filter(or_(*matches)).first() is not None
+
+    @classmethod
+    def record(cls, notify_id, trade_no, payment_no):
+        """Add the notification to the current transaction, False if a
+        concurrent request recorded the same one first."""
+        db.session.add(
+            cls(notify_id=notify_id, trade_no=trade_no, payment_no=payment_no)
+        )
+        try:
+            db.session.flush()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+
 class OrderEvent(Model):
     __tablename__ = "order_event"
     order_id = Column(db.Integer())
     user_id = Column(db.Integer())
     type_ = Column("type", db.Integer())
+
+
+@outbox_handler("order_event")
+def create_order_event(order_id, user_id, type_):
+    db.session.add(OrderEvent(order_id=order_id, user_id=user_id, type_=type_))
@@ -1,13 +1,17 @@
+import base64
+import binascii
 import json
+from functools import lru_cache
 from pathlib import Path
 
+import rsa
 from alipay.aop.api.AlipayClientConfig import AlipayClientConfig
 from alipay.aop.api.DefaultAlipayClient import DefaultAlipayClient
 from alipay.aop.api.domain.AlipayTradePagePayModel import AlipayTradePagePayModel
 from alipay.aop.api.domain.AlipayTradeQueryModel import AlipayTradeQueryModel
 from alipay.aop.api.request.AlipayTradePagePayRequest import AlipayTradePagePayRequest
 from alipay.aop.api.request.AlipayTradeQueryRequest import AlipayTradeQueryRequest
-from alipay.aop.api.util.SignatureUtils import verify_with_rsa
+from alipay.aop.api.util.SignatureUtils import fill_public_key_marker
 
 """
 支付宝沙盒环境相关配置：
@@ -30,6 +34,7 @@ _amount': '0.02', 'trade_status': 'TRADE_SUCCESS', 'trade_no': '2023032822001479
 """
 
 
+@lru_cache(maxsize=None)
 def get_alipay_string():
     current_dir = Path(__file__).resolve().parent
     app_private_key = current_dir / "app_private_key.pem"
@@ -44,6 +49,15 @@ def get_alipay_string():
     return app_private_key_string, alipay_public_key_string
 
 
+@lru_cache(maxsize=None)
+def get_alipay_public_key():
+    _, alipay_public_key_string = get_alipay_string()
+    return rsa.PublicKey.load_pkcs1_openssl_pem(
+        fill_public_key_marker(alipay_public_key_string)
+    )
+
+
+@lru_cache(maxsize=None)
 def get_payclient():
     app_private_key_string, alipay_public_key_string = get_alipay_string()
     alipay_client_config = AlipayClientConfig()
@@ -79,14 +93,19 @@ def query_order(payment_no):
     return json.loads(response)
 
 
+def get_sign_message(data):
+    return "&".join(f"{key}={value}" for key, value in sorted(data.items())).encode(
+        "UTF-8"
+    )
+
+
 def verify_order(data):
-    _, alipay_public_key_string = get_alipay_string()
-    signature = data.pop("sign")
-    data.pop("sign_type")
-    s_data = dict(sorted(data.items(), key=lambda x: x[0]))
-    msg = ""
-    for key, value in s_data.items():
-        msg = msg + key + "=" + value + "&"
-    message = msg[:-1].encode("UTF-8")
-    result = verify_with_rsa(alipay_public_key_string, message, signature)
-    return result
+    signature = data.pop("sign", "")
+    data.pop("sign_type", None)
+    try:
+        rsa.verify(
+            get_sign_message(data), base64.b64decode(signature), get_alipay_public_key()
+        )
+    except (rsa.VerificationError, binascii.Error):
+        return False
+    return True
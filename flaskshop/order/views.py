@@ -15,12 +15,13 @@ from flask_login import current_user, login_required
 from pluggy import HookimplMarker
 
 from flaskshop.constant import OrderStatusKinds, PaymentStatusKinds, ShipStatusKinds
-from flaskshop.extensions import csrf_protect
+from flaskshop.extensions import csrf_protect, db
 from .payment import zhifubao
 
-from .models import Order, OrderPayment
+from .models import Order, OrderPayment, OrderPaymentNotify
 
 impl = HookimplMarker("flaskshop")
+ALIPAY_PAID_STATUS = ("TRADE_SUCCESS", "TRADE_FINISHED")
 
 
 @login_required
@@ -73,14 +74,25 @@ def ali_pay(token):
 @csrf_protect.exempt
 def ali_notify():
     data = request.form.to_dict()
+    notify_id, trade_no = data.get("notify_id"), data.get("trade_no")
+    # alipay repeats a notification until it gets SUCCESS, answer those cheaply
+    if OrderPaymentNotify.is_handled(notify_id, trade_no):
+        return "SUCCESS"
     success = zhifubao.verify_order(data)
-    if success:
-        order_payment = OrderPayment.query.filter_by(
-            payment_no=data["out_trade_no"]
-        ).first()
-        order_payment.pay_success(paid_at=data["gmt_payment"])
+    if not success:
+        return "ERROR HAPPEND"
+    if data.get("trade_status") not in ALIPAY_PAID_STATUS:
         return "SUCCESS"
-    return "ERROR HAPPEND"
+    order_payment = OrderPayment.query.filter_by(
+        payment_no=data["out_trade_no"]
+    ).first()
+    if order_payment is None:
+        return "ERROR HAPPEND"
+    if OrderPaymentNotify.record(notify_id, trade_no, order_payment.payment_no):
+        paid_at = datetime.strptime(data["gmt_payment"], "%Y-%m-%d %H:%M:%S")
+        order_payment.pay_success(paid_at=paid_at)
+        db.session.commit()
+    return "SUCCESS"
 
 
 @login_required
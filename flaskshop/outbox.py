@@ -0,0 +1,160 @@
+"""Outbox for side effects kept off the request path.
+
+Order events, emails and search index updates are written as outbox
+messages in the same transaction as the change causing them, and are
+carried out afterwards by the ``flask outbox`` worker, with retries.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, select, update
+
+from flaskshop.constant import OutboxStatusKinds
+from flaskshop.database import Column, Model, db
+
+OUTBOX_LEASE = 60  # seconds a claimed message is hidden from other workers
+OUTBOX_MAX_ATTEMPTS = 5
+# messages of the current transaction run once it commits with OUTBOX_EAGER
+EAGER_MESSAGES = "outbox:eager"
+
+handlers = {}
+
+
+def outbox_handler(kind):
+    """Register the function carrying out messages of kind, it is called
+    with the payload as keyword arguments. Database changes it makes are
+    committed together with the removal of the message."""
+
+    def decorator(func):
+        handlers[kind] = func
+        return func
+
+    return decorator
+
+
+class OutboxMessage(Model):
+    __tablename__ = "outbox_message"
+    kind = Column(db.String(50), nullable=False)
+    payload = Column(db.JSON())
+    status = Column(db.Integer(), default=OutboxStatusKinds.pending.value)
+    attempts = Column(db.Integer(), default=0)
+    available_at = Column(db.DateTime(), default=datetime.now, index=True)
+    error = Column(db.Text())
+
+    @property
+    def status_human(self):
+        return OutboxStatusKinds(int(self.status)).name
+
+    @classmethod
+    def claim(cls, message_id):
+        """Take the message for OUTBOX_LEASE seconds, False if another
+        worker was faster. A worker dying meanwhile only delays it."""
+        now = datetime.now()
+        result = db.session.execute(
+            update(cls)
+            .where(
+                cls.id == message_id,
+                cls.status == OutboxStatusKinds.pending.value,
+                cls.available_at <= now,
+            )
+            .values(
+                attempts=cls.attempts + 1,
+                available_at=now + timedelta(seconds=OUTBOX_LEASE),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        return result.rowcount == 1
+
+
+def enqueue(kind, **payload):
+    """Add a message to the current transaction, the caller commits it.
+    With OUTBOX_EAGER set the handler runs in this process once the
+    transaction commits instead, for setups without a worker."""
+    if current_app.config["OUTBOX_EAGER"]:
+        db.session.info.setdefault(EAGER_MESSAGES, []).append((kind, payload))
+    else:
+        db.session.add(OutboxMessage(kind=kind, payload=payload))
+
+
+@event.listens_for(db.session, "after_commit")
+def run_eager_messages(session):
+    """Carry out the messages of the committed transaction. Its session
+    cannot run queries anymore, so each message gets an app context and a
+    session of its own. A failed one is left to the worker."""
+    for kind, payload in session.info.pop(EAGER_MESSAGES, None) or ():
+        with current_app.app_context():
+            try:
+                handlers[kind](**payload)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                current_app.logger.exception("eager outbox message %s failed", kind)
+                db.session.add(OutboxMessage(kind=kind, payload=payload))
+                db.session.commit()
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_eager_messages(session):
+    session.info.pop(EAGER_MESSAGES, None)
+
+
+def process_outbox(limit=100, max_attempts=OUTBOX_MAX_ATTEMPTS):
+    """Carry out up to limit due messages and return how many succeeded.
+
+    A failed message is retried with exponential backoff and marked
+    failed after max_attempts.
+    """
+    message_ids = db.session.scalars(
+        select(OutboxMessage.id)
+        .where(
+            OutboxMessage.status == OutboxStatusKinds.pending.value,
+            OutboxMessage.available_at <= datetime.now(),
+        )
+        .order_by(OutboxMessage.id)
+        .limit(limit)
+    ).all()
+    done = 0
+    for message_id in message_ids:
+        if not OutboxMessage.claim(message_id):
+            continue
+        message = db.session.get(OutboxMessage, message_id)
+        try:
+            handlers[message.kind](**message.payload)
+            db.session.delete(message)
+            db.session.commit()
+            done += 1
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception("outbox message %s failed", message_id)
+            message = db.session.get(OutboxMessage, message_id)
+            if message.attempts >= max_attempts:
+                message.status = OutboxStatusKinds.failed.value
+            else:
+                message.available_at = datetime.now() + timedelta(
+                    seconds=2**message.attempts
+                )
+            message.error = repr(e)
+            db.session.commit()
+    return done
+
+
+def run_worker(app, workers=1, interval=1.0, once=False):
+    """Process the outbox with a pool of worker threads, each polling every
+    interval seconds while idle. With once they return when nothing is
+    due anymore."""
+
+    def work():
+        with app.app_context():
+            while True:
+                if process_outbox():
+                    continue
+                if once:
+                    return
+                time.sleep(interval)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for future in [pool.submit(work) for _ in range(workers)]:
+            future.result()
@@ -1,26 +1,49 @@
 import itertools
+import json
+from collections import Counter, defaultdict
 
 from flask import current_app, request, url_for
-from sqlalchemy import desc
+from sqlalchemy import desc, event, update
 from sqlalchemy.ext.mutable import MutableDict
 
-from flaskshop.corelib.db import PropsItem
-from flaskshop.corelib.mc import cache, rdb
-from flaskshop.database import Column, Model, db
+from flaskshop.corelib.db import PropsItem, prefetch_props
+from flaskshop.corelib.local_cache import lc
+from flaskshop.corelib.mc import (
+    cache,
+    cache_multi,
+    invalidate,
+    invalidate_tags,
+    rdb,
+)
+from flaskshop.database import MC_KEY_GET_BY_ID, Column, Model, db, preloadable
+from flaskshop.outbox import enqueue
 from flaskshop.settings import Config
 
 MC_KEY_FEATURED_PRODUCTS = "product:featured:{}"
 MC_KEY_PRODUCT_IMAGES = "product:product:{}:images"
 MC_KEY_PRODUCT_VARIANT = "product:product:{}:variant"
-MC_KEY_PRODUCT_DISCOUNT_PRICE = "product:product:{}:discount_price"
 MC_KEY_ATTRIBUTE_VALUES = "product:attribute:values:{}"
-MC_KEY_COLLECTION_PRODUCTS = "product:collection:{}:products:{}"
-MC_KEY_CATEGORY_PRODUCTS = "product:category:{}:products:{}"
 MC_KEY_CATEGORY_CHILDREN = "product:category:{}:children"
+MC_KEY_FACETS = "product:facets:{}"
+MC_KEY_PRODUCT_FACETS = "product:facets:product:{}"
+# counts are rebuilt from the database this often, whatever drift they have
+FACETS_EXPIRE = 24 * 3600
+# without redis each process keeps what it built for this long
+FACETS_LOCAL_EXPIRE = 60
+MC_TAG_FEATURED_PRODUCTS = "featured_products"
+PENDING_SEARCH_PRODUCTS = "pending_search_products"
+# owners of facet counts
+FACETS_OWNER_CATEGORY = "category:{}"
+FACETS_OWNER_COLLECTION = "collection:{}"
 
 
 class Product(Model):
     __tablename__ = "product_product"
+    # the dashboard list pages through it by created_at
+    __table_args__ = (
+        db.Index("ix_product_product_created_at", "created_at"),
+        Model.__table_args__,
+    )
     title = Column(db.String(255), nullable=False)
     on_sale = Column(db.Boolean(), default=True)
     rating = Column(db.DECIMAL(8, 2), default=5.0)
@@ -44,11 +67,19 @@ class Product(Model):
     def get_absolute_url(self):
         return url_for("product.show", id=self.id)
 
-    @property
+    @preloadable
     @cache(MC_KEY_PRODUCT_IMAGES.format("{self.id}"))
     def images(self):
         return ProductImage.query.filter(ProductImage.product_id == self.id).all()
 
+    @images.batch
+    def images(cls, products):
+        return cache_multi(
+            MC_KEY_PRODUCT_IMAGES,
+            [p.id for p in products],
+            lambda ids: group_by(ProductImage, "product_id", ids),
+        )
+
     @property
     def first_img(self):
         if self.images:
@@ -59,26 +90,39 @@ class Product(Model):
     def is_in_stock(self):
         return any(variant.is_in_stock for variant in self)
 
-    @property
+    @preloadable
     def category(self):
         return Category.get_by_id(self.category_id)
 
-    @property
+    @category.batch
+    def category(cls, products):
+        return Category.get_multi_by_ids(p.category_id for p in products)
+
+    @preloadable
     def product_type(self):
         return ProductType.get_by_id(self.product_type_id)
 
+    @product_type.batch
+    def product_type(cls, products):
+        return ProductType.get_multi_by_ids(p.product_type_id for p in products)
+
     @property
     def is_discounted(self):
         if float(self.discounted_price) > 0:
             return True
         return False
 
-    @property
-    @cache(MC_KEY_PRODUCT_DISCOUNT_PRICE.format("{self.id}"))
+    @preloadable
     def discounted_price(self):
+        # kept on the instance, price and is_discounted read it repeatedly
+        Product.preload([self], "discounted_price")
+        return self.discounted_price
+
+    @discounted_price.batch
+    def discounted_price(cls, products):
         from flaskshop.discount.models import Sale
 
-        return Sale.get_discounted_price(self)
+        return Sale.get_discounted_prices(products)
 
     @property
     def price(self):
@@ -94,24 +138,44 @@ class Product(Model):
     def on_sale_human(self):
         return "Y" if self.on_sale else "N"
 
-    @property
+    @preloadable
     @cache(MC_KEY_PRODUCT_VARIANT.format("{self.id}"))
     def variant(self):
         return ProductVariant.query.filter(ProductVariant.product_id == self.id).all()
 
+    @variant.batch
+    def variant(cls, products):
+        return cache_multi(
+            MC_KEY_PRODUCT_VARIANT,
+            [p.id for p in products],
+            lambda ids: group_by(ProductVariant, "product_id", ids),
+        )
+
     @property
     def attribute_map(self):
-        items = {
-            ProductAttribute.get_by_id(k): AttributeChoiceValue.get_by_id(v)
-            for k, v in self.attributes.items()
-        }
+        attributes = self.attributes or {}
+        items = dict(
+            zip(
+                ProductAttribute.get_multi_by_ids(attributes.keys()),
+                AttributeChoiceValue.get_multi_by_ids(attributes.values()),
+            )
+        )
         return items
 
     @classmethod
-    @cache(MC_KEY_FEATURED_PRODUCTS.format("{num}"))
-    def get_featured_product(cls, num=8):
+    @cache(
+        MC_KEY_FEATURED_PRODUCTS.format("{num}"),
+        local_expire=60,
+        soft_expire=600,
+        tags=(MC_TAG_FEATURED_PRODUCTS,),
+    )
+    def _get_featured_product(cls, num=8):
         return cls.query.filter_by(is_featured=True).limit(num).all()
 
+    @classmethod
+    def get_featured_product(cls, num=8):
+        return cls.preload(cls._get_featured_product(num), "images", "discounted_price")
+
     def update_images(self, new_images):
         origin_ids = (
             ProductImage.query.with_entities(ProductImage.id)
@@ -160,54 +224,38 @@ class Product(Model):
 
     @staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_PRODUCT_DISCOUNT_PRICE.format(target.id))
-        keys = rdb.keys(MC_KEY_FEATURED_PRODUCTS.format("*"))
-        for key in keys:
-            rdb.delete(key)
+        from flaskshop.discount.models import Sale
+
+        Sale.clear_product_sales([target.id])
+        invalidate_tags(MC_TAG_FEATURED_PRODUCTS)
 
     @staticmethod
-    def clear_category_cache(target):
-        keys = rdb.keys(MC_KEY_CATEGORY_PRODUCTS.format(target.category_id, "*"))
-        for key in keys:
-            rdb.delete(key)
+    def update_search_index(target):
+        db.session.info.setdefault(PENDING_SEARCH_PRODUCTS, set()).add(target.id)
 
     @classmethod
     def __flush_insert_event__(cls, target):
         super().__flush_insert_event__(target)
+        update_product_facets(target, inserted=True)
 
-        if current_app.config["USE_ES"]:
-            from flaskshop.public.search import Item
-
-            Item.add(target)
-
-    @classmethod
-    def __flush_before_update_event__(cls, target):
-
-        super().__flush_before_update_event__(target)
-        target.clear_category_cache(target)
+        target.update_search_index(target)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
 
         super().__flush_after_update_event__(target)
         target.clear_mc(target)
-        target.clear_category_cache(target)
-        if current_app.config["USE_ES"]:
-            from flaskshop.public.search import Item
-
-            Item.update_item(target)
+        update_product_facets(target)
+        target.update_search_index(target)
 
     @classmethod
     def __flush_delete_event__(cls, target):
 
         super().__flush_delete_event__(target)
         target.clear_mc(target)
-        target.clear_category_cache(target)
+        remove_product_facets(target)
 
-        if current_app.config["USE_ES"]:
-            from flaskshop.public.search import Item
-
-            Item.delete(target)
+        target.update_search_index(target)
 
 
 class Category(Model):
@@ -231,22 +279,35 @@ class Category(Model):
         all_category_ids = [child.id for child in self.children] + [self.id]
         return Product.query.filter(Product.category_id.in_(all_category_ids)).all()
 
-    @property
-    @cache(MC_KEY_CATEGORY_CHILDREN.format("{self.id}"))
+    @preloadable
+    @cache(MC_KEY_CATEGORY_CHILDREN.format("{self.id}"), local_expire=60, lock=True)
     def children(self):
         return Category.query.filter(Category.parent_id == self.id).all()
 
-    @property
+    @children.batch
+    def children(cls, categories):
+        return cache_multi(
+            MC_KEY_CATEGORY_CHILDREN,
+            [c.id for c in categories],
+            lambda ids: group_by(Category, "parent_id", ids),
+        )
+
+    @preloadable
     def parent(self):
         return Category.get_by_id(self.parent_id)
 
+    @parent.batch
+    def parent(cls, categories):
+        return Category.get_multi_by_ids(c.parent_id for c in categories)
+
+    @property
+    def facets(self):
+        owners = [FACETS_OWNER_CATEGORY.format(c.id) for c in [self, *self.children]]
+        return get_facets(owners)
+
     @property
     def attr_filter(self):
-        attr_filter = set()
-        for product in self.products:
-            for attr in product.product_type.product_attributes:
-                attr_filter.add(attr)
-        return attr_filter
+        return get_attr_filter(self.facets)
 
     @classmethod
     def get_product_by_category(cls, category_id, page):
@@ -255,6 +316,7 @@ class Category(Model):
         query = Product.query.filter(Product.category_id.in_(all_category_ids))
         ctx, query = get_product_list_context(query, category)
         pagination = query.paginate(page=page, per_page=16)
+        Product.preload(pagination.items, "images", "discounted_price")
         ctx.update(object=category, pagination=pagination, products=pagination.items)
         return ctx
 
@@ -263,7 +325,8 @@ class Category(Model):
         return cls.query.filter(cls.parent_id == 0).all()
 
     def delete(self):
-        for child in self.children:
+        # not self.children, its cached instances are shared by all requests
+        for child in Category.query.filter_by(parent_id=self.id):
             child.parent_id = 0
             db.session.add(child)
         need_update_products = Product.query.filter_by(category_id=self.id).all()
@@ -279,10 +342,15 @@ class Category(Model):
 
     @staticmethod
     def clear_mc(target):
-        rdb.delete(MC_KEY_CATEGORY_CHILDREN.format(target.id))
-        keys = rdb.keys(MC_KEY_CATEGORY_PRODUCTS.format(target.id, "*"))
-        for key in keys:
-            rdb.delete(key)
+        invalidate(
+            MC_KEY_CATEGORY_CHILDREN.format(target.id),
+            MC_KEY_CATEGORY_CHILDREN.format(target.parent_id),
+        )
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        target.clear_mc(target)
 
     @classmethod
     def __flush_after_update_event__(cls, target):
@@ -323,12 +391,35 @@ class ProductType(Model):
         )
         return [id[0] for id in at_ids]
 
-    @property
+    @preloadable
     def product_attributes(self):
         return ProductAttribute.query.filter(
             ProductAttribute.id.in_(self.product_attributes_ids)
         ).all()
 
+    @product_attributes.batch
+    def product_attributes(cls, product_types):
+        type_attrs = group_by(
+            ProductTypeAttributes,
+            "product_type_id",
+            [t.id for t in product_types],
+        )
+        attr_ids = {
+            item.product_attribute_id for items in type_attrs.values() for item in items
+        }
+        attrs = {
+            attr.id: attr
+            for attr in ProductAttribute.query.filter(ProductAttribute.id.in_(attr_ids))
+        }
+        return [
+            [
+                attrs[item.product_attribute_id]
+                for item in type_attrs[t.id]
+                if item.product_attribute_id in attrs
+            ]
+            for t in product_types
+        ]
+
     def update_product_attr(self, new_attrs):
         origin_ids = (
             ProductTypeAttributes.query.with_entities(
@@ -409,10 +500,14 @@ class ProductVariant(Model):
     def price(self):
         return self.price_override or self.product.price
 
-    @property
+    @preloadable
     def product(self):
         return Product.get_by_id(self.product_id)
 
+    @product.batch
+    def product(cls, variants):
+        return Product.get_multi_by_ids(v.product_id for v in variants)
+
     def get_absolute_url(self):
         return url_for("product.show", id=self.product.id)
 
@@ -421,6 +516,46 @@ class ProductVariant(Model):
             return False, f"{self.display_product()} has not enough stock"
         return True, "success"
 
+    @classmethod
+    def reserve_stock(cls, items):
+        """Allocate stock for (variant, quantity) pairs in the current
+        transaction and return the variants that have not enough of it.
+
+        Each variant gets one conditional UPDATE, so the database decides
+        under its row lock and concurrent checkouts cannot oversell. Rows
+        are updated in id order to keep lock order stable. The caller rolls
+        back when anything failed.
+        """
+        variants = {}
+        quantities = Counter()
+        for variant, quantity in items:
+            variants[variant.id] = variant
+            quantities[variant.id] += quantity
+        failed = []
+        for variant_id in sorted(quantities):
+            quantity = quantities[variant_id]
+            result = db.session.execute(
+                update(cls)
+                .where(
+                    cls.id == variant_id,
+                    cls.quantity - cls.quantity_allocated >= quantity,
+                )
+                .values(quantity_allocated=cls.quantity_allocated + quantity)
+                .execution_options(synchronize_session=False)
+            )
+            if result.rowcount != 1:
+                failed.append(variants[variant_id])
+        return failed
+
+    @classmethod
+    def clear_stock_cache(cls, variants):
+        """Drop cached copies of variants whose stock was changed by an
+        UPDATE statement, which skips the flush events."""
+        for variant in variants:
+            cls._forget_identity(variant)
+            invalidate(MC_KEY_GET_BY_ID.format(cls.__name__, variant.id))
+            cls.clear_mc(variant)
+
     @staticmethod
     def clear_mc(target):
         rdb.delete(MC_KEY_PRODUCT_VARIANT.format(target.product_id))
@@ -609,13 +744,13 @@ class Collection(Model):
     def products(self):
         return Product.query.filter(Product.id.in_(self.products_ids)).all()
 
+    @property
+    def facets(self):
+        return get_facets([FACETS_OWNER_COLLECTION.format(self.id)])
+
     @property
     def attr_filter(self):
-        attr_filter = set()
-        for product in self.products:
-            for attr in product.product_type.product_attributes:
-                attr_filter.add(attr)
-        return attr_filter
+        return get_attr_filter(self.facets)
 
     def update_products(self, new_products):
         origin_ids = (
@@ -664,28 +799,268 @@ class ProductCollection(Model):
         query = Product.query.filter(Product.id.in_(id for id, in at_ids))
         ctx, query = get_product_list_context(query, collection)
         pagination = query.paginate(page=page, per_page=16)
+        Product.preload(pagination.items, "images", "discounted_price")
         ctx.update(object=collection, pagination=pagination, products=pagination.items)
         return ctx
 
-    @staticmethod
-    def clear_mc(target):
-        keys = rdb.keys(MC_KEY_COLLECTION_PRODUCTS.format(target.collection_id, "*"))
-        for key in keys:
-            rdb.delete(key)
-
     @classmethod
     def __flush_insert_event__(cls, target):
-        target.clear_mc(target)
-
-    @classmethod
-    def __flush_after_update_event__(cls, target):
-        super().__flush_after_update_event__(target)
-        target.clear_mc(target)
+        super().__flush_insert_event__(target)
+        move_product_facets(target.product_id, added=target.collection_id)
 
     @classmethod
     def __flush_delete_event__(cls, target):
         super().__flush_delete_event__(target)
-        target.clear_mc(target)
+        move_product_facets(target.product_id, removed=target.collection_id)
+
+
+@event.listens_for(db.session, "before_commit")
+def enqueue_search_updates(session):
+    """Send the products changed by the transaction to the search index,
+    each product once. Flush events only collect the ids as they must not
+    add to the session. The index, Elasticsearch or the local one, gets one
+    message carried out once the transaction is committed."""
+    session.flush()
+    product_ids = session.info.pop(PENDING_SEARCH_PRODUCTS, None)
+    if not product_ids:
+        return
+    if not current_app.config["USE_ES"]:
+        from flaskshop.public.search import LocalItem
+
+        if not LocalItem.get_index(build=False).refresh():
+            return  # building it reads the products anyway
+    enqueue("search_index", product_ids=sorted(product_ids))
+
+
+@event.listens_for(db.session, "after_rollback")
+def discard_search_updates(session):
+    session.info.pop(PENDING_SEARCH_PRODUCTS, None)
+
+
+def iter_product_batches(batch_size=500, product_ids=None):
+    """Yield all products, or those in product_ids, in id order, batch_size
+    at a time, with what the search index reads loaded per batch. Only one
+    batch is kept in memory."""
+    query = Product.query
+    if product_ids is not None:
+        query = query.filter(Product.id.in_(product_ids))
+    last_id = 0
+    while True:
+        batch = (
+            query.filter(Product.id > last_id)
+            .order_by(Product.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not batch:
+            return
+        prefetch_props(batch)
+        Product.preload(batch, "images", "discounted_price")
+        yield batch
+        last_id = batch[-1].id
+
+
+def group_by(model, column, ids):
+    """Rows of model whose column is in ids with one query, as
+    ``{id: [rows]}`` with an empty list for ids without rows."""
+    groups = {id: [] for id in ids}
+    if not groups:
+        return groups
+    field = getattr(model, column)
+    for obj in model.query.filter(field.in_(groups)).order_by(model.id):
+        groups[getattr(obj, column)].append(obj)
+    return groups
+
+
+def product_facet_fields(product):
+    """What product adds to the facet index of a category or collection:
+    ``t:<product type id>`` and ``v:<attribute id>:<value id>`` per value."""
+    fields = [f"t:{product.product_type_id}"]
+    attributes = product.attributes or {}
+    fields.extend(f"v:{attr}:{value}" for attr, value in attributes.items() if value)
+    return fields
+
+
+def build_facets(owner):
+    """Count the facets of a category or collection from the database.
+
+    With redis the counts are stored, together with what each product was
+    counted as, so product and collection flush events can keep them
+    current without another scan.
+    """
+    kind, owner_id = owner.split(":")
+    query = db.session.query(
+        Product.id, Product.category_id, Product.product_type_id, Product.attributes
+    )
+    if kind == "category":
+        query = query.filter(Product.category_id == owner_id)
+    else:
+        query = query.join(
+            ProductCollection, ProductCollection.product_id == Product.id
+        ).filter(ProductCollection.collection_id == owner_id)
+    products = query.all()
+    counts = Counter(f for p in products for f in product_facet_fields(p))
+    if not current_app.config["USE_REDIS"]:
+        return counts
+
+    collections = group_by(ProductCollection, "product_id", [p.id for p in products])
+    pipe = rdb.pipeline()
+    pipe.delete(MC_KEY_FACETS.format(owner))
+    pipe.hset(MC_KEY_FACETS.format(owner), mapping={**counts, "built": 1})
+    pipe.expire(MC_KEY_FACETS.format(owner), FACETS_EXPIRE)
+    for p in products:
+        owners = [FACETS_OWNER_CATEGORY.format(p.category_id)]
+        owners.extend(
+            FACETS_OWNER_COLLECTION.format(c.collection_id) for c in collections[p.id]
+        )
+        record = {"owners": owners, "fields": product_facet_fields(p)}
+        pipe.set(
+            MC_KEY_PRODUCT_FACETS.format(p.id), json.dumps(record), ex=FACETS_EXPIRE
+        )
+    pipe.execute()
+    return counts
+
+
+def get_facets(owners):
+    """Facet counts summed over owners, e.g. a category and its children."""
+    facets = Counter()
+    if not current_app.config["USE_REDIS"]:
+        for owner in owners:
+            counts = lc.get(MC_KEY_FACETS.format(owner))
+            if counts is None:
+                counts = build_facets(owner)
+                lc.set(MC_KEY_FACETS.format(owner), counts, FACETS_LOCAL_EXPIRE)
+            facets.update(counts)
+        return facets
+
+    pipe = rdb.pipeline(transaction=False)
+    for owner in owners:
+        pipe.hgetall(MC_KEY_FACETS.format(owner))
+    for owner, counts in zip(owners, pipe.execute()):
+        if b"built" not in counts:
+            facets.update(build_facets(owner))
+            continue
+        counts.pop(b"built")
+        facets.update({k.decode(): int(v) for k, v in counts.items()})
+    return facets
+
+
+def _change_facets(product_id, change):
+    """Move what product_id is counted as to what change makes of it.
+
+    change gets the stored record, None if there is none, and returns the
+    new record, None to forget it, and the owners whose counts are out of
+    step and dropped instead. The record is watched while the counts are
+    moved in one MULTI, so concurrent edits of the product take turns
+    instead of moving the counts from the same old record.
+    """
+    key = MC_KEY_PRODUCT_FACETS.format(product_id)
+
+    def apply(pipe):
+        old = pipe.get(key)
+        old = json.loads(old) if old else None
+        new, drop = change(old)
+        pipe.multi()
+        if drop:
+            # rebuilt from the database when they are read next time
+            pipe.delete(*[MC_KEY_FACETS.format(owner) for owner in drop])
+            return
+        delta = Counter()
+        if new:
+            delta.update((o, f) for o in new["owners"] for f in new["fields"])
+        if old:
+            delta.subtract((o, f) for o in old["owners"] for f in old["fields"])
+        for (owner, field), amount in delta.items():
+            if amount:
+                pipe.hincrby(MC_KEY_FACETS.format(owner), field, amount)
+        if new:
+            pipe.set(key, json.dumps(new), ex=FACETS_EXPIRE)
+        else:
+            pipe.delete(key)
+
+    rdb.transaction(apply, key)
+
+
+def _forget_local_facets(*owners):
+    # the other processes build them again after FACETS_LOCAL_EXPIRE
+    lc.delete_multi([MC_KEY_FACETS.format(owner) for owner in owners])
+
+
+def update_product_facets(product, inserted=False):
+    """Move what product was counted as to what it is now."""
+    category = FACETS_OWNER_CATEGORY.format(product.category_id)
+    if not current_app.config["USE_REDIS"]:
+        _forget_local_facets(category)
+        return
+    fields = product_facet_fields(product)
+
+    def change(record):
+        if record is None:
+            if not inserted:
+                return None, [category]
+            record = {"owners": [], "fields": []}
+        collections = [o for o in record["owners"] if o.startswith("collection:")]
+        return {"owners": [category] + collections, "fields": fields}, None
+
+    _change_facets(product.id, change)
+
+
+def remove_product_facets(product):
+    category = FACETS_OWNER_CATEGORY.format(product.category_id)
+    if not current_app.config["USE_REDIS"]:
+        _forget_local_facets(category)
+        return
+    _change_facets(product.id, lambda record: (None, None if record else [category]))
+
+
+def move_product_facets(product_id, added=None, removed=None):
+    """Count product in or out of a collection it was added to or removed from."""
+    owner = FACETS_OWNER_COLLECTION.format(added or removed)
+    if not current_app.config["USE_REDIS"]:
+        _forget_local_facets(owner)
+        return
+
+    def change(record):
+        if record is None or (owner in record["owners"]) == bool(added):
+            return None, [owner]
+        owners = [o for o in record["owners"] if o != owner]
+        if added:
+            owners.append(owner)
+        return {**record, "owners": owners}, None
+
+    _change_facets(product_id, change)
+
+
+def get_attr_filter(facets):
+    """Attributes to filter a list by, as ``[(attribute, [(value, count)])]``
+    for the values that products of the list have."""
+    type_ids = [int(f[2:]) for f, n in facets.items() if f.startswith("t:") and n > 0]
+    product_types = [t for t in ProductType.get_multi_by_ids(type_ids) if t]
+    ProductType.preload(product_types, "product_attributes")
+    attrs = {attr.id: attr for t in product_types for attr in t.product_attributes}
+
+    value_counts = defaultdict(dict)
+    for field, n in facets.items():
+        if field.startswith("v:") and n > 0:
+            _, attr_id, value_id = field.split(":")
+            if attr_id.isdigit() and value_id.isdigit():
+                value_counts[int(attr_id)][int(value_id)] = n
+    value_ids = [id for counts in value_counts.values() for id in counts]
+    values = {
+        v.id: v for v in AttributeChoiceValue.get_multi_by_ids(value_ids) if v
+    }
+    return [
+        (
+            attrs[attr_id],
+            [
+                (values[id], n)
+                for id, n in sorted(value_counts[attr_id].items())
+                if id in values
+            ],
+        )
+        for attr_id in sorted(attrs)
+        if value_counts[attr_id]
+    ]
 
 
 def get_product_list_context(query, obj):
@@ -721,7 +1096,7 @@ def get_product_list_context(query, obj):
 
     args_dict.update(default_attr={})
     attr_filter = obj.attr_filter
-    for attr in attr_filter:
+    for attr, _ in attr_filter:
         value = request.args.get(attr.title)
         if value:
             query = query.filter(Product.attributes.__getitem__(str(attr.id)) == value)
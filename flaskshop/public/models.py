@@ -1,8 +1,10 @@
+import itertools
+
 from flask import url_for
 
 from flaskshop.corelib.db import PropsItem
-from flaskshop.corelib.mc import cache, rdb
-from flaskshop.database import Column, Model, db
+from flaskshop.corelib.mc import LocalSnapshot, cache, cache_multi, rdb
+from flaskshop.database import Column, Model, db, preloadable
 from flaskshop.settings import Config
 
 MC_KEY_MENU_ITEMS = "public:site:{}:{}"
@@ -28,13 +30,24 @@ class MenuItem(Model):
     def parent(self):
         return MenuItem.get_by_id(self.parent_id)
 
-    @property
+    @preloadable
     @cache(MC_KEY_MENU_ITEM_CHILDREN.format("{self.id}"))
     def children(self):
         return (
             MenuItem.query.filter(MenuItem.parent_id == self.id).order_by("order").all()
         )
 
+    @children.batch
+    def children(cls, items):
+        def fetch_multi(ids):
+            children = {id: [] for id in ids}
+            query = MenuItem.query.filter(MenuItem.parent_id.in_(ids))
+            for child in query.order_by("order"):
+                children[child.parent_id].append(child)
+            return children
+
+        return cache_multi(MC_KEY_MENU_ITEM_CHILDREN, [i.id for i in items], fetch_multi)
+
     @property
     def linked_object_url(self):
         if self.page_id:
@@ -52,6 +65,35 @@ class MenuItem(Model):
     def first_level_items(cls):
         return cls.query.filter(cls.parent_id == 0).order_by("order").all()
 
+    @classmethod
+    def get_site_menus(cls):
+        """The top and bottom menus as (item, children) pairs, shared between
+        requests."""
+        return site_menus.get()
+
+    @staticmethod
+    def clear_mc(target):
+        rdb.delete(
+            MC_KEY_MENU_ITEM_CHILDREN.format(target.id),
+            MC_KEY_MENU_ITEM_CHILDREN.format(target.parent_id),
+        )
+        site_menus.bump()
+
+    @classmethod
+    def __flush_insert_event__(cls, target):
+        super().__flush_insert_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_after_update_event__(cls, target):
+        super().__flush_after_update_event__(target)
+        target.clear_mc(target)
+
+    @classmethod
+    def __flush_delete_event__(cls, target):
+        super().__flush_delete_event__(target)
+        target.clear_mc(target)
+
 
 class Page(Model):
     __tablename__ = "public_page"
@@ -87,3 +129,30 @@ class Page(Model):
         super().__flush_after_update_event__(target)
         rdb.delete(MC_KEY_PAGE_ID.format(target.id))
         rdb.delete(MC_KEY_PAGE_ID.format(target.slug))
+
+
+def _load_site_menus():
+    # children are kept as plain lists in the snapshot, as preloaded values
+    # only last for the request loading them
+    items = (
+        MenuItem.query.filter(MenuItem.position.in_((1, 2)))
+        .filter(MenuItem.parent_id == 0)
+        .order_by(MenuItem.order)
+        .all()
+    )
+    children = {item.id: [] for item in items}
+    if children:
+        query = MenuItem.query.filter(MenuItem.parent_id.in_(children))
+        for child in query.order_by(MenuItem.order):
+            children[child.parent_id].append(child)
+    for item in itertools.chain(items, *children.values()):
+        db.session.expunge(item)
+    return {
+        "top_menu": [(item, children[item.id]) for item in items if item.position == 1],
+        "bottom_menu": [
+            (item, children[item.id]) for item in items if item.position == 2
+        ],
+    }
+
+
+site_menus = LocalSnapshot("site_menus", _load_site_menus)
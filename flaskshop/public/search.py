@@ -1,16 +1,61 @@
+from functools import lru_cache
+
 from elasticsearch.exceptions import ConflictError, NotFoundError
 from elasticsearch.helpers import parallel_bulk
-from elasticsearch_dsl import Boolean, Date, Document, Float, Integer, Text
+from elasticsearch_dsl import (
+    Boolean,
+    Date,
+    Document,
+    Float,
+    Integer,
+    Keyword,
+    Text,
+    analyzer,
+    tokenizer,
+)
 from elasticsearch_dsl.connections import connections
+from flask import current_app, url_for
 from flask_sqlalchemy.pagination import Pagination
+from sqlalchemy import select
 
+from flaskshop.corelib.fulltext import FullTextIndex, PrefixIndex, tokenize
+from flaskshop.database import db
+from flaskshop.outbox import outbox_handler
 from flaskshop.settings import Config
-from flaskshop.product.models import ProductImage
+from flaskshop.product.models import (
+    Category,
+    Collection,
+    Product,
+    iter_product_batches,
+)
 
 if Config.USE_ES:
     connections.create_connection(hosts=Config.ES_HOSTS)
 
 SERACH_FIELDS = ["title^10", "description^5"]
+# what products/_items.html shows, the rest of _source is never sent
+SEARCH_SOURCE_FIELDS = ["title", "first_img", "price", "is_discounted"]
+# fields of the local index and their boosts, in the ratio of SERACH_FIELDS
+LOCAL_SEARCH_FIELDS = {"title": 2.0, "description": 1.0}
+# what is suggested while typing, in the order they are listed
+SUGGEST_KINDS = {
+    "category": (Category, "product.show_category"),
+    "collection": (Collection, "product.show_collection"),
+    "product": (Product, "product.show"),
+}
+SUGGEST_LIMIT = 10
+
+edge_ngram = analyzer(
+    "edge_ngram",
+    tokenizer=tokenizer(
+        "edge_ngram",
+        "edge_ngram",
+        min_gram=1,
+        max_gram=20,
+        token_chars=["letter", "digit"],
+    ),
+    filter=["lowercase"],
+)
 
 
 def get_item_data(item):
@@ -26,7 +71,80 @@ def get_item_data(item):
     }
 
 
-class Item(Document):
+class AliasedIndex:
+    """Documents searched and written through an alias named after their
+    index, so a rebuild can fill <alias>_v<n> while searches go on and
+    then swap the alias over."""
+
+    @classmethod
+    def create_next_index(cls):
+        """Create an empty <alias>_v<n+1> next to what the alias points at,
+        tuned for bulk loading until swap_alias."""
+        es = cls.get_es()
+        alias = cls._index._name
+        versions = [
+            int(name.rsplit("_v", 1)[1])
+            for name in es.indices.get(index=f"{alias}_v*")
+            if name.rsplit("_v", 1)[1].isdigit()
+        ]
+        name = f"{alias}_v{max(versions, default=1) + 1}"
+        index = cls._index.clone(name)
+        index.settings(refresh_interval="-1", number_of_replicas=0)
+        es.indices.create(index=name, **index.to_dict())
+        return name
+
+    @classmethod
+    def swap_alias(cls, name):
+        """Point the alias at index name in one atomic call and drop the
+        indices it pointed at before."""
+        es = cls.get_es()
+        alias = cls._index._name
+        es.indices.put_settings(
+            index=name, settings={"refresh_interval": None, "number_of_replicas": None}
+        )
+        es.indices.refresh(index=name)
+        if es.indices.exists_alias(name=alias):
+            old = list(es.indices.get_alias(name=alias))
+        else:
+            old = []
+            # a plain index from before aliases were used, replaced once
+            es.indices.delete(index=alias, ignore_unavailable=True)
+        es.indices.update_aliases(
+            actions=[{"remove": {"index": i, "alias": alias}} for i in old]
+            + [{"add": {"index": name, "alias": alias}}]
+        )
+        for i in old:
+            if i != name:
+                es.indices.delete(index=i)
+        return old
+
+    @classmethod
+    def recreate_index(cls):
+        """Drop the index behind the alias and create it empty under the
+        same name and alias, return that name. Searches find nothing until
+        it is filled again."""
+        es = cls.get_es()
+        alias = cls._index._name
+        if not es.indices.exists_alias(name=alias):
+            # a plain index from before aliases were used, or none yet
+            es.indices.delete(index=alias, ignore_unavailable=True)
+            cls.init()
+            return alias
+        # the alias itself cannot be deleted, only the indices it points at
+        names = list(es.indices.get_alias(name=alias))
+        for name in names:
+            es.indices.delete(index=name)
+        index = cls._index.clone(names[0])
+        index.aliases(**{alias: {}})
+        es.indices.create(index=names[0], **index.to_dict())
+        return names[0]
+
+    @classmethod
+    def get_es(cls):
+        return connections.get_connection()
+
+
+class Item(AliasedIndex, Document):
     id = Integer()
     title = Text()
     description = Text()
@@ -63,56 +181,310 @@ class Item(Document):
 
     @classmethod
     def delete(cls, item):
-        rs = cls.get(item.id)
-        if rs:
-            super(cls, rs).delete()
-            return True
-        return False
-
-    @classmethod
-    def bulk_update(cls, items, chunk_size=5000, op_type="update", **kwargs):
-        index = cls._index._name
-        _type = cls._doc_type.name
-        obj = [
-            {
-                "_op_type": op_type,
-                "_id": f"{doc.id}",
-                "_index": index,
-                "_type": _type,
-                "_source": get_item_data(doc),
-            }
-            for doc in items
-        ]
-        client = cls.get_es()
-        rs = list(parallel_bulk(client, obj, chunk_size=chunk_size, **kwargs))
-        return rs
+        try:
+            rs = cls.get(item.id)
+        except NotFoundError:
+            return False
+        super(cls, rs).delete()
+        return True
 
     @classmethod
-    def get_es(cls):
-        return connections.get_connection()
+    def bulk_update(
+        cls,
+        items,
+        chunk_size=500,
+        op_type="index",
+        index=None,
+        thread_count=4,
+        delete_ids=(),
+    ):
+        """Send items to the index with parallel_bulk, along with deletes of
+        the documents in delete_ids, return how many documents were written
+        or deleted."""
+        index = index or cls._index._name
+        actions = []
+        for doc in items:
+            source = get_item_data(doc)
+            del source["meta"]
+            action = {"_op_type": op_type, "_id": f"{doc.id}", "_index": index}
+            if op_type == "update":
+                action.update(doc=source, doc_as_upsert=True)
+            else:
+                action["_source"] = source
+            actions.append(action)
+        actions.extend(
+            {"_op_type": "delete", "_id": f"{id}", "_index": index}
+            for id in delete_ids
+        )
+        return sum(
+            ok
+            for ok, _ in parallel_bulk(
+                cls.get_es(),
+                actions,
+                thread_count=thread_count,
+                chunk_size=chunk_size,
+                ignore_status=(404,),
+            )
+        )
 
     @classmethod
-    def new_search(cls, query, page, order_by=None, per_page=16):
+    def new_search(cls, query, page, order_by=None, per_page=16, hydrate=False):
+        """Search products and render the hits straight from the index. With
+        hydrate the hits are only ids and the products are loaded in one
+        batch, for fields the index does not hold or must be current."""
         s = cls.search()
         s = s.query("multi_match", query=query, fields=SERACH_FIELDS)
+        s = s.source(False if hydrate else SEARCH_SOURCE_FIELDS)
         start = (page - 1) * per_page
         s = s.extra(**{"from": start, "size": per_page})
         s = s if order_by is None else s.sort(order_by)
         rs = s.execute()
-        return CustomPagination(page, per_page, rs=rs, query=query)
+        return CustomPagination(page, per_page, rs=rs, query=query, hydrate=hydrate)
+
+
+@outbox_handler("search_index")
+def update_search_index(product_ids=None, product_id=None):
+    """Index the current state of the products in bulk requests, deleting
+    the ones gone from the database, or in the local indexes while
+    Elasticsearch is disabled. product_id is what messages queued one
+    product at a time carry."""
+    product_ids = list(product_ids or ())
+    if product_id is not None:
+        product_ids.append(product_id)
+    if not current_app.config["USE_ES"]:
+        return LocalItem.update(product_ids)
+    products = [
+        product
+        for batch in iter_product_batches(product_ids=product_ids)
+        for product in batch
+    ]
+    gone = set(product_ids) - {product.id for product in products}
+    Suggestion.bulk_update(
+        [(("product", product.id), product.title) for product in products],
+        delete_keys=[("product", id) for id in sorted(gone)],
+    )
+    return Item.bulk_update(products, delete_ids=sorted(gone))
+
+
+class Suggestion(AliasedIndex, Document):
+    """Titles of categories, collections and products, with their words cut
+    into prefixes when indexed so a match query completes them."""
+
+    kind = Keyword()
+    title = Text(analyzer=edge_ngram, search_analyzer="standard")
+
+    class Index:
+        name = "flaskshop_suggest"
+
+    @classmethod
+    def rebuild(cls, entries):
+        """Index entries into a new index and swap the alias over to it,
+        suggestions are served from the old one until then."""
+        index = cls.create_next_index()
+        done = cls.bulk_update(entries, index=index)
+        cls.swap_alias(index)
+        return done
+
+    @classmethod
+    def bulk_update(cls, entries, delete_keys=(), index=None):
+        """Index entries, pairs of a (kind, id) key and a title, and delete
+        the ones of delete_keys."""
+        index = index or cls._index._name
+        actions = [
+            {
+                "_op_type": "index",
+                "_index": index,
+                "_id": f"{kind}-{id}",
+                "_source": {"kind": kind, "title": title},
+            }
+            for (kind, id), title in entries
+        ]
+        actions.extend(
+            {"_op_type": "delete", "_index": index, "_id": f"{kind}-{id}"}
+            for kind, id in delete_keys
+        )
+        if not actions:
+            return 0
+        return sum(
+            ok
+            for ok, _ in parallel_bulk(cls.get_es(), actions, ignore_status=(404,))
+        )
+
+    @classmethod
+    def suggest(cls, text, limit=SUGGEST_LIMIT):
+        s = cls.search()
+        s = s.query("match", title={"query": text, "operator": "and"})
+        s = s.extra(size=limit)
+        return [
+            ((hit.kind, int(hit.meta.id.rsplit("-", 1)[1])), hit.title)
+            for hit in s.execute()
+        ]
+
+
+def iter_suggestion_titles():
+    """The (kind, id) key and title of every category, collection and
+    product."""
+    for kind, (model, _) in SUGGEST_KINDS.items():
+        for id, title in db.session.execute(select(model.id, model.title)):
+            yield (kind, id), title
+
+
+def get_suggestion_data(key, title):
+    kind, id = key
+    return {
+        "type": kind,
+        "title": title,
+        "url": url_for(SUGGEST_KINDS[kind][1], id=id),
+    }
+
+
+@lru_cache
+def get_local_index(path):
+    return FullTextIndex(LOCAL_SEARCH_FIELDS, path)
+
+
+@lru_cache
+def get_local_suggestions(path):
+    return PrefixIndex(path and f"{path}.suggest")
+
+
+class LocalItem:
+    """Product search without Elasticsearch, with the same new_search as
+    Item, over a FullTextIndex kept in SEARCH_INDEX_PATH, and suggestions
+    from a PrefixIndex next to it. They are built on first use or by
+    reindex, and kept current by the search_index outbox messages."""
+
+    @classmethod
+    def get_index(cls, build=True):
+        index = get_local_index(current_app.config["SEARCH_INDEX_PATH"])
+        if build:
+            cls._ensure_built(index, cls._rebuild_index)
+        return index
+
+    @classmethod
+    def get_suggestions(cls, build=True):
+        suggestions = get_local_suggestions(current_app.config["SEARCH_INDEX_PATH"])
+        if build:
+            cls._ensure_built(suggestions, cls._rebuild_suggestions)
+        return suggestions
+
+    @staticmethod
+    def _ensure_built(index, rebuild):
+        if index.refresh():
+            return
+        with index.locked():
+            # the requests waiting meanwhile load what the first one built
+            if not index.refresh():
+                rebuild()
+
+    @classmethod
+    def rebuild(cls, batch_size=500):
+        """Build both indexes from the database, return their sizes."""
+        return cls._rebuild_index(batch_size), cls._rebuild_suggestions()
+
+    @classmethod
+    def _rebuild_index(cls, batch_size=500):
+        index = cls.get_index(build=False)
+        index.rebuild(
+            (product.id, get_local_texts(product))
+            for batch in iter_product_batches(batch_size)
+            for product in batch
+        )
+        return len(index)
+
+    @classmethod
+    def _rebuild_suggestions(cls):
+        suggestions = cls.get_suggestions(build=False)
+        suggestions.rebuild(iter_suggestion_titles())
+        return len(suggestions)
+
+    @classmethod
+    def update(cls, product_ids):
+        """Index the current state of the products, removing the ones gone
+        from the database, return how many there were. Indexes not built
+        yet are left alone, building them reads the products anyway."""
+        products = Product.query.filter(Product.id.in_(product_ids)).all()
+        texts = {product.id: get_local_texts(product) for product in products}
+        gone = set(product_ids) - set(texts)
+
+        index = cls.get_index(build=False)
+        with index.locked():
+            if index.refresh():
+                for product_id, product_texts in texts.items():
+                    index.add(product_id, **product_texts)
+                for product_id in gone:
+                    index.remove(product_id)
+                index.save()
+
+        suggestions = cls.get_suggestions(build=False)
+        with suggestions.locked():
+            if suggestions.refresh():
+                for product_id, product_texts in texts.items():
+                    suggestions.add(("product", product_id), product_texts["title"])
+                for product_id in gone:
+                    suggestions.remove(("product", product_id))
+                suggestions.save()
+        return len(texts) + len(gone)
+
+    @classmethod
+    def new_search(cls, query, page, per_page=16):
+        """A query without any term lists all the products, like the title
+        filter this replaced did."""
+        offset = (page - 1) * per_page
+        if not tokenize(query):
+            ids = db.session.scalars(
+                select(Product.id).order_by(Product.id).offset(offset).limit(per_page)
+            ).all()
+            total = db.session.scalar(select(db.func.count(Product.id)))
+        else:
+            total, ids = cls.get_index().search(query, offset=offset, limit=per_page)
+        return LocalPagination(page, per_page, ids=ids, total=total)
+
+    @classmethod
+    def suggest(cls, text, limit=SUGGEST_LIMIT):
+        kinds = list(SUGGEST_KINDS)
+        return cls.get_suggestions().suggest(
+            text, limit, rank=lambda key: kinds.index(key[0])
+        )
+
+
+def get_local_texts(product):
+    return {field: getattr(product, field) for field in LOCAL_SEARCH_FIELDS}
+
+
+def load_products(ids):
+    products = [product for product in Product.get_multi_by_ids(ids) if product]
+    Product.preload(products, "images", "discounted_price")
+    return products
 
 
 class CustomPagination(Pagination):
     def __init__(self, page, per_page, **kwargs):
         self.rs = kwargs.get('rs')
         self.query = kwargs.get('query')
+        self.hydrate = kwargs.get('hydrate', False)
         super().__init__(page, per_page, **kwargs)
 
     def _query_items(self):
-        for item in self.rs:
+        if self.hydrate:
+            return load_products(item.meta.id for item in self.rs)
+        items = list(self.rs)
+        for item in items:
             item.id = item.meta.id
-            item.first_img = ProductImage.query.filter(ProductImage.product_id == item.id).first()
-        return self.rs
+        return items
+
+    def _query_count(self):
+        return self.rs.hits.total.value
+
+
+class LocalPagination(Pagination):
+    def __init__(self, page, per_page, **kwargs):
+        self.ids = kwargs.get("ids")
+        self.hits = kwargs.get("total")
+        super().__init__(page, per_page, **kwargs)
+
+    def _query_items(self):
+        return load_products(self.ids)
 
     def _query_count(self):
-        return self.rs.hits.total.value
\ No newline at end of file
+        return self.hits
@@ -1,6 +1,13 @@
 # -*- coding: utf-8 -*-
 """Public section, including homepage and signup."""
-from flask import Blueprint, current_app, render_template, request, send_from_directory
+from flask import (
+    Blueprint,
+    current_app,
+    jsonify,
+    render_template,
+    request,
+    send_from_directory,
+)
 from pluggy import HookimplMarker
 
 from flaskshop.account.models import User
@@ -8,7 +15,7 @@ from flaskshop.extensions import login_manager
 from flaskshop.product.models import Product
 
 from .models import Page
-from .search import Item
+from .search import Item, LocalItem, Suggestion, get_suggestion_data
 
 impl = HookimplMarker("flaskshop")
 
@@ -36,11 +43,11 @@ def search():
     query = request.args.get("q", "")
     page = request.args.get("page", default=1, type=int)
     if current_app.config["USE_ES"]:
-        pagination = Item.new_search(query, page)
-    else:
-        pagination = Product.query.filter(Product.title.ilike(f"%{query}%")).paginate(
-            page=page, per_page=10
+        pagination = Item.new_search(
+            query, page, hydrate=current_app.config["ES_HYDRATE_RESULTS"]
         )
+    else:
+        pagination = LocalItem.new_search(query, page)
     return render_template(
         "public/search_result.html",
         products=pagination.items,
@@ -49,6 +56,17 @@ def search():
     )
 
 
+def suggest():
+    query = request.args.get("q", "")
+    if current_app.config["USE_ES"]:
+        suggestions = Suggestion.suggest(query)
+    else:
+        suggestions = LocalItem.suggest(query)
+    return jsonify(
+        {"suggestions": [get_suggestion_data(*entry) for entry in suggestions]}
+    )
+
+
 def show_page(identity):
     page = Page.get_by_identity(identity)
     return render_template("public/page.html", page=page)
@@ -61,5 +79,6 @@ def flaskshop_load_blueprints(app):
     bp.add_url_rule("/style", view_func=style)
     bp.add_url_rule("/favicon.ico", view_func=favicon)
     bp.add_url_rule("/search", view_func=search)
+    bp.add_url_rule("/search/suggest", view_func=suggest)
     bp.add_url_rule("/page/<identity>", view_func=show_page)
     app.register_blueprint(bp)
@@ -43,6 +43,16 @@ class Config:
     ES_HOSTS = [
         os.getenv("ESEARCH_URI", DBConfig.esearch_uri),
     ]
+    # search results are the products loaded from the database by the ids
+    # of the hits, set ES_HYDRATE_RESULTS=0 to render them from the index
+    # instead, whose prices miss sale changes until the products are reindexed
+    ES_HYDRATE_RESULTS = os.getenv("ES_HYDRATE_RESULTS", "1") != "0"
+
+    # Outbox
+    # order events, emails and search index updates run in the request once
+    # it commits, set OUTBOX_EAGER=0 to leave them to the `flask outbox`
+    # worker instead, messages pile up unprocessed without one
+    OUTBOX_EAGER = os.getenv("OUTBOX_EAGER", "1") != "0"
 
     # SQLALCHEMY
     SQLALCHEMY_DATABASE_URI = os.getenv("DB_URI", DBConfig.db_uri)
@@ -58,6 +68,9 @@ class Config:
     UPLOAD_DIR = STATIC_DIR / UPLOAD_FOLDER
     DASHBOARD_TEMPLATE_FOLDER = APP_DIR / "templates" / "dashboard"
     UPLOAD_FOLDER = os.getenv("UPLOAD_FOLDER", "static/placeholders")
+    # the search index used while elasticsearch is disabled, shared with the
+    # outbox worker updating it, set it empty to keep the index in memory only
+    SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", PROJECT_ROOT / "search_index")
 
     PURCHASE_URI = os.getenv("PURCHASE_URI", "")
 
@@ -7,9 +7,9 @@ from urllib.parse import urlencode
 
 from flask import current_app, flash, request
 from flask_sqlalchemy.record_queries import get_recorded_queries
+from werkzeug.local import LocalProxy
 
 from flaskshop.checkout.models import Cart
-from flaskshop.constant import SiteDefaultSettings
 from flaskshop.dashboard.models import Setting
 from flaskshop.plugin.utils import template_hook
 from flaskshop.public.models import MenuItem
@@ -51,34 +51,26 @@ def jinja_global_varibles(app):
 
     @app.context_processor
     def inject_cart():
-        current_user_cart = Cart.get_current_user_cart()
-        return dict(current_user_cart=current_user_cart)
+        # every page shows the summary, only checkout pages load the cart
+        loaded = []
+
+        def get_current_user_cart():
+            if not loaded:
+                loaded.append(Cart.get_current_user_cart())
+            return loaded[0]
+
+        return dict(
+            cart_summary=Cart.get_current_user_cart_summary(),
+            current_user_cart=LocalProxy(get_current_user_cart),
+        )
 
     @app.context_processor
     def inject_menus():
-        top_menu = (
-            MenuItem.query.filter(MenuItem.position == 1)
-            .filter(MenuItem.parent_id == 0)
-            .order_by(MenuItem.order)
-            .all()
-        )
-        bottom_menu = (
-            MenuItem.query.filter(MenuItem.position == 2)
-            .filter(MenuItem.parent_id == 0)
-            .order_by(MenuItem.order)
-            .all()
-        )
-        return dict(top_menu=top_menu, bottom_menu=bottom_menu)
+        return dict(MenuItem.get_site_menus())
 
     @app.context_processor
     def inject_site_setting():
-        settings = {}
-        for key, value in SiteDefaultSettings.items():
-            obj = Setting.query.filter_by(key=key).first()
-            if not obj:
-                obj = Setting.create(key=key, **value)
-            settings[key] = obj
-        return dict(settings=settings)
+        return dict(settings=Setting.get_site_settings())
 
     def get_sort_by_url(field, descending=False):
         request_get = request.args.copy()
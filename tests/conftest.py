@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 """Defines fixtures available to all tests."""
+import sys
 from pathlib import Path
 
 import pytest
 
 from flaskshop.app import create_app
+from flaskshop.corelib import db as corelib_db
 from flaskshop.database import db as _db
 from flaskshop.random_data import create_menus, create_products_by_schema
 from flaskshop.utils import jinja_global_varibles
@@ -28,6 +30,21 @@ def client(app):
     return app.test_client()
 
 
+@pytest.fixture
+def redis(app, monkeypatch):
+    """A fake redis in place of the one the modules imported."""
+    fakeredis = pytest.importorskip("fakeredis")
+    # clients made with server=client.connection_pool.connection_kwargs["server"]
+    # stand for other workers
+    client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    rdb = corelib_db.rdb
+    for name, module in list(sys.modules.items()):
+        if name.startswith("flaskshop") and getattr(module, "rdb", None) is rdb:
+            monkeypatch.setattr(module, "rdb", client)
+    monkeypatch.setitem(app.config, "USE_REDIS", True)
+    return client
+
+
 @pytest.fixture
 def db(app):
     """A database for the tests."""
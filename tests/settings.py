@@ -14,4 +14,6 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 WTF_CSRF_ENABLED = False  # Allows form testing
 USE_REDIS = False
 USE_ES = False
+OUTBOX_EAGER = False
+SEARCH_INDEX_PATH = None
 DATABASE_QUERY_TIMEOUT = 1000
@@ -0,0 +1,335 @@
+"""Cache unit tests."""
+import json
+import threading
+import time
+
+import pytest
+from flask import g
+from sqlalchemy import event, inspect
+
+from flaskshop.corelib.local_cache import LocalCache, LRUCache
+from flaskshop.corelib import mc
+from flaskshop.corelib.mc import (
+    MC_CHANNEL_INVALIDATE,
+    LocalSnapshot,
+    cache,
+    invalidate_tags,
+    local_mc,
+)
+from flaskshop.corelib.serializer import ModelSerializer, PickleSerializer
+from flaskshop.dashboard.models import Setting
+from flaskshop.database import db
+from flaskshop.product.models import Product
+from flaskshop.random_data import create_menus
+
+
+class TestLRUCache:
+    """LRUCache tests."""
+
+    def test_evicts_least_recently_used(self):
+        """Test the oldest untouched entry is evicted when full."""
+        cache = LRUCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        assert cache.get("a") == 1
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.get("c") == 3
+
+    def test_expire(self, monkeypatch):
+        """Test an entry is gone after its expire time."""
+        cache = LRUCache()
+        cache.set("a", 1, time=10)
+        now = time.monotonic()
+        monkeypatch.setattr(
+            "flaskshop.corelib.local_cache._monotonic", lambda: now + 11
+        )
+        assert cache.get("a") is None
+
+    def test_stats(self):
+        """Test hits and misses are counted."""
+        cache = LRUCache()
+        cache.set("a", None)
+        missing = object()
+        assert cache.get("a", missing) is None
+        assert cache.get("b", missing) is missing
+        assert cache.stats() == {
+            "hits": 1,
+            "misses": 1,
+            "evictions": 0,
+            "size": 1,
+            "bytes": 0,
+        }
+
+    def test_max_bytes(self):
+        """Test entries are evicted to stay within the byte budget."""
+        cache = LRUCache(size=100, max_bytes=1000)
+        for i in range(10):
+            cache.set(i, "x" * 200)
+        assert cache.nbytes <= 1000
+        assert cache.get(9) is not None
+        assert cache.get(0) is None
+        assert cache.evictions == 10 - len(cache)
+
+
+class TestLocalCache:
+    """LocalCache tests."""
+
+    def test_does_not_clear_everything_when_full(self):
+        """Test a full cache only evicts the oldest entry."""
+        cache = LocalCache(size=3)
+        for key in "abcd":
+            cache.set(key, {"description": key})
+        assert cache.get_multi(["a", "b", "c", "d"]) == {
+            "a": None,
+            "b": {"description": "b"},
+            "c": {"description": "c"},
+            "d": {"description": "d"},
+        }
+
+    def test_delete(self):
+        """Test delete and delete_multi."""
+        cache = LocalCache()
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("c", 3)
+        cache.delete("a")
+        cache.delete_multi(["b", "c"])
+        assert cache.get_list(["a", "b", "c"]) == [None, None, None]
+
+
+@pytest.mark.usefixtures("app")
+class TestLocalSnapshot:
+    """LocalSnapshot tests."""
+
+    def test_rebuilt_after_bump(self):
+        """Test the value is built once and again only after a bump."""
+        builds = []
+        snapshot = LocalSnapshot("test", lambda: builds.append(1) or len(builds))
+        assert snapshot.get() == 1
+        assert snapshot.get() == 1
+        snapshot.bump()
+        assert snapshot.get() == 2
+        assert len(builds) == 2
+
+    def test_expires_without_redis(self, app, monkeypatch):
+        """Test the value is rebuilt once old when bumps cannot be shared."""
+        monkeypatch.setitem(app.config, "USE_REDIS", False)
+        now = [100.0]
+        monkeypatch.setattr(time, "monotonic", lambda: now[0])
+        builds = []
+        snapshot = LocalSnapshot(
+            "test", lambda: builds.append(1) or len(builds), local_expire=10
+        )
+        assert snapshot.get() == 1
+        now[0] += 10
+        assert snapshot.get() == 1
+        now[0] += 1
+        assert snapshot.get() == 2
+
+
+@pytest.mark.usefixtures("redis")
+class TestCacheLock:
+    """cache(..., lock=True) and soft_expire tests."""
+
+    def test_stale_served_while_recomputing(self, redis):
+        """Test callers get the stale copy while another worker holds the lock."""
+        calls = []
+
+        @cache("test:stale", expire=60, soft_expire=10)
+        def load():
+            calls.append(1)
+            return f"value {len(calls)}"
+
+        assert load() == "value 1"
+        redis.delete("test:stale")
+        redis.set("lock:test:stale", "other")
+        assert load() == "value 1"
+        assert len(calls) == 1
+
+    def test_concurrent_caller_waits(self, app):
+        """Test a miss is computed once and the other caller gets its result."""
+        started, proceed = threading.Event(), threading.Event()
+        calls, results = [], []
+
+        @cache("test:wait", lock=True)
+        def load():
+            calls.append(1)
+            started.set()
+            proceed.wait(5)
+            return "value"
+
+        def call():
+            with app.app_context():
+                results.append(load())
+
+        first = threading.Thread(target=call)
+        first.start()
+        assert started.wait(5)
+        second = threading.Thread(target=call)
+        second.start()
+        time.sleep(0.1)
+        proceed.set()
+        first.join(5)
+        second.join(5)
+        assert results == ["value", "value"]
+        assert len(calls) == 1
+
+    def test_lock_released_when_loader_raises(self, redis):
+        """Test a failing loader does not keep the lock until the lease ends."""
+
+        @cache("test:error", lock=True)
+        def load():
+            raise ValueError
+
+        with pytest.raises(ValueError):
+            load()
+        assert not redis.exists("lock:test:error")
+
+
+@pytest.mark.usefixtures("redis")
+class TestCacheTags:
+    """invalidate_tags tests."""
+
+    def test_bump_misses_only_tagged_keys(self):
+        """Test keys with the tag are recomputed and the others still hit."""
+        calls = []
+
+        @cache("test:tagged:{id}", tags=("group:{id}",))
+        def tagged(id):
+            calls.append(("tagged", id))
+            return f"tagged {id}"
+
+        @cache("test:untagged:{id}")
+        def untagged(id):
+            calls.append(("untagged", id))
+            return f"untagged {id}"
+
+        for id in (1, 2):
+            tagged(id)
+            untagged(id)
+        del calls[:]
+        invalidate_tags("group:1")
+        assert tagged(1) == "tagged 1"
+        assert tagged(2) == "tagged 2"
+        assert untagged(1) == "untagged 1"
+        assert calls == [("tagged", 1)]
+        tagged(1)
+        assert calls == [("tagged", 1)]
+
+    def test_bump_drops_local_tier(self):
+        """Test a bump also drops the copies kept in this process."""
+        calls = []
+
+        @cache("test:local:{id}", local_expire=60, tags=("local:{id}",))
+        def load(id):
+            calls.append(id)
+            return f"value {id}"
+
+        load(1)
+        load(1)
+        assert calls == [1]
+        invalidate_tags("local:1")
+        assert load(1) == "value 1"
+        assert calls == [1, 1]
+
+
+@pytest.mark.usefixtures("redis")
+class TestLocalTier:
+    """cache(..., local_expire=n) tests."""
+
+    def test_other_workers_drop_local_copies(self, redis, monkeypatch):
+        """Test an invalidation published by another worker drops the copy
+        this one keeps, for keys and for tags."""
+        fakeredis = pytest.importorskip("fakeredis")
+        # subscribe this worker to the fake server of the test
+        monkeypatch.setattr(mc, "_subscriber_pid", None)
+
+        @cache("test:worker:{id}", local_expire=60, tags=("worker:{id}",))
+        def load(id):
+            return f"value {id}"
+
+        load(1)
+        load(2)
+        assert local_mc.get("test:worker:1") == "value 1"
+        other = fakeredis.FakeRedis(
+            server=redis.connection_pool.connection_kwargs["server"]
+        )
+        # what invalidate() and invalidate_tags() publish in that worker
+        other.publish(
+            MC_CHANNEL_INVALIDATE, json.dumps({"keys": ["test:worker:1"], "tags": []})
+        )
+        other.publish(
+            MC_CHANNEL_INVALIDATE, json.dumps({"keys": [], "tags": ["worker:2"]})
+        )
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and (
+            local_mc.get("test:worker:1") or local_mc.get("test:worker:2")
+        ):
+            time.sleep(0.01)
+        assert local_mc.get("test:worker:1") is None
+        assert local_mc.get("test:worker:2") is None
+
+
+@pytest.mark.usefixtures("db")
+class TestSiteSettings:
+    """Site settings snapshot tests."""
+
+    def test_loading_writes_nothing(self):
+        """Test the settings are copies and missing ones are not stored."""
+        stored = Setting.query.count()
+        settings = Setting.get_site_settings()
+        assert settings
+        assert all(inspect(s).transient for s in settings.values())
+        assert Setting.query.count() == stored
+
+        Setting.create_missing()
+        Setting.update({"project_title": "Shop"})
+        settings = Setting.get_site_settings()
+        assert settings["project_title"].value == "Shop"
+        assert inspect(settings["project_title"]).transient
+
+
+@pytest.mark.usefixtures("db")
+class TestModelSerializer:
+    """ModelSerializer tests."""
+
+    def test_round_trip(self):
+        """Test instances come back detached with their column values."""
+        serializer = ModelSerializer()
+        products = Product.query.all()
+        loaded = serializer.loads(serializer.dumps(products))
+        assert [p.id for p in loaded] == [p.id for p in products]
+        assert [p.title for p in loaded] == [p.title for p in products]
+        assert loaded[0].attributes == products[0].attributes
+        assert inspect(loaded[0]).detached
+
+    def test_reads_pickled_values(self):
+        """Test values written by the old serializer still load."""
+        product = Product.query.first()
+        data = PickleSerializer().dumps(product)
+        assert ModelSerializer().loads(data).title == product.title
+
+
+@pytest.mark.usefixtures("db")
+class TestSiteMenus:
+    """Site menus snapshot tests."""
+
+    def test_later_requests_query_no_menus(self, client):
+        """Test the menus and their children are only loaded once."""
+        list(create_menus())
+        assert client.get("/").status_code == 200
+        # the client shares the app context of the test, g with it
+        g.pop("identity_map", None)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert client.get("/").status_code == 200
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        assert not [s for s in statements if "public_menuitem" in s]
@@ -17,3 +17,8 @@ def test_dev_config():
     app = create_app(Config)
     assert app.config["ENV"] == "dev"
     # assert app.config["FLASK_DEBUG"] is True
+
+
+def test_outbox_eager_by_default():
+    """Outbox messages run in the request unless a worker takes them."""
+    assert Config.OUTBOX_EAGER is True
@@ -1,10 +1,68 @@
 """Database unit tests."""
+import json
+import threading
+from datetime import datetime, timedelta
+from decimal import Decimal
+
 import pytest
-from flask_login import UserMixin
+from elasticsearch_dsl.response import Response
+from flask import g
+from flask_login import UserMixin, login_user
+from sqlalchemy import event
 from sqlalchemy.orm.exc import ObjectDeletedError
 from sqlalchemy.sql import text
 
-from flaskshop.database import Column, Model, db
+from flaskshop.account.models import User
+from flaskshop.checkout.models import (
+    MC_KEY_CART_BY_USER,
+    MC_KEY_CART_SUMMARY_BY_USER,
+    Cart,
+    CartLine,
+)
+from flaskshop.constant import (
+    DiscountValueTypeKinds,
+    OrderEvents,
+    OrderStatusKinds,
+    OutboxStatusKinds,
+    PaymentStatusKinds,
+)
+from flaskshop.corelib.db import prefetch_props
+from flaskshop.corelib.fulltext import FullTextIndex, PersistentIndex, PrefixIndex
+from flaskshop.corelib import local_cache
+from flaskshop.corelib.local_cache import lc
+from flaskshop.corelib.pagination import COUNT_EXPIRE, KeysetPagination
+from flaskshop.database import Column, Model, db, get_identity_map
+from flaskshop.discount.models import (
+    MC_KEY_PRODUCT_SALES,
+    Sale,
+    SaleCategory,
+    SaleProduct,
+)
+from flaskshop.order.models import (
+    Order,
+    OrderEvent,
+    OrderLine,
+    OrderPayment,
+    OrderPaymentNotify,
+)
+from flaskshop.outbox import (
+    OutboxMessage,
+    enqueue,
+    handlers,
+    outbox_handler,
+    process_outbox,
+)
+from flaskshop.product import models as product_models
+from flaskshop.product.models import (
+    Category,
+    Product,
+    ProductVariant,
+    get_attr_filter,
+    get_facets,
+    iter_product_batches,
+)
+from flaskshop.public import search
+from flaskshop.public.search import CustomPagination, Item, LocalItem, Suggestion
 
 
 class ExampleUserModel(UserMixin, Model):
@@ -49,6 +107,25 @@ class TestCRUDMixin:
         with pytest.raises(ObjectDeletedError):
             ExampleUserModel.get_by_id(user.id)
 
+    def test_get_multi_by_ids(self):
+        """Test get_multi_by_ids keeps input order and returns None for misses."""
+        foo = ExampleUserModel.create(username="foo", email="foo@bar.com")
+        bar = ExampleUserModel.create(username="bar", email="bar@bar.com")
+        users = ExampleUserModel.get_multi_by_ids([bar.id, "xyz", foo.id, 999, bar.id])
+        assert [u and u.username for u in users] == ["bar", None, "foo", None, "bar"]
+
+    def test_get_by_id_identity_map(self):
+        """Test repeated lookups in a request return the same object."""
+        user = ExampleUserModel.create(username="foo", email="foo@bar.com")
+        identity_map = get_identity_map()
+        hits = identity_map.hits
+        first = ExampleUserModel.get_by_id(user.id)
+        assert ExampleUserModel.get_by_id(str(user.id)) is first
+        assert ExampleUserModel.get_multi_by_ids([user.id]) == [first]
+        assert identity_map.hits == hits + 2
+        user.update(username="bar")
+        assert ExampleUserModel.get_by_id(user.id).username == "bar"
+
     @pytest.mark.parametrize("commit,expected", [(True, "bar"), (False, "foo")])
     def test_update(self, commit, expected, db):
         """Test CRUD update with and without commit."""
@@ -66,3 +143,935 @@ class TestPkModel:
     def test_get_by_id_wrong_type(self):
         """Test get_by_id returns None for non-numeric argument."""
         assert ExampleUserModel.get_by_id("xyz") is None
+
+
+@pytest.mark.usefixtures("db")
+class TestProps:
+    """Props hash tests."""
+
+    def test_blob_migrates_to_hash(self, redis):
+        """Test props saved as one json blob are read and moved to a hash."""
+        product = Product.query.first()
+        key = product._props_db_key
+        redis.set(key, json.dumps({"note": "old", "views": 1}))
+        lc.delete(product._props_name)
+        assert product.get_props_item("note") == "old"
+        assert redis.type(key) == b"hash"
+        assert product.incr_props_item("views") == 2
+        product.delete_props_item("note")
+        product.set_props_item("tags", ["a"])
+        assert product.props == {"views": 2, "tags": ["a"]}
+
+    def test_writes_migrate_blob(self, redis):
+        """Test a write to a blob keeps the other items."""
+        product = Product.query.first()
+        key = product._props_db_key
+        redis.set(key, json.dumps({"note": "old", "views": 1}))
+        assert product.decr_props_item("views") == 0
+        assert product.decr_props_item("views") == 0
+        assert product.props == {"note": "old", "views": 0}
+
+    def test_prefetch_in_one_round_trip(self, redis, monkeypatch):
+        """Test prefetch_props reads every object with one pipeline."""
+        products = Product.query.limit(3).all()
+        assert len(products) > 1
+        for product in products:
+            product.set_props_item("note", f"about {product.id}")
+        pipelines = []
+        pipeline = redis.pipeline
+        monkeypatch.setattr(
+            redis, "pipeline", lambda **kw: pipelines.append(1) or pipeline(**kw)
+        )
+        prefetch_props(products)
+        monkeypatch.setattr(redis, "hgetall", None)
+        assert [p.get_props_item("note") for p in products] == [
+            f"about {p.id}" for p in products
+        ]
+        assert len(pipelines) == 1
+
+
+@pytest.mark.usefixtures("db")
+class TestPreload:
+    """Model.preload tests."""
+
+    def test_preload_matches_properties(self):
+        """Test preloaded values are the ones the properties would return."""
+        products = Product.query.all()
+        expected = [([i.id for i in p.images], p.category.id) for p in products]
+        Product.preload(products, "images", "variant", "category")
+        for product in products:
+            assert "_preloaded_images" in product.__dict__
+        assert [([i.id for i in p.images], p.category.id) for p in products] == (
+            expected
+        )
+        assert [len(p.variant) for p in products] == [
+            len(ProductVariant.query.filter_by(product_id=p.id).all())
+            for p in products
+        ]
+
+    def test_preloaded_values_last_the_request(self, monkeypatch):
+        """Test a preloaded value is loaded again in the next request."""
+        product = Product.query.first()
+        Product.preload([product], "discounted_price")
+        prices = []
+        monkeypatch.setattr(
+            Sale,
+            "get_discounted_prices",
+            classmethod(lambda cls, ps: prices.append(1) or [Decimal(1)] * len(ps)),
+        )
+        product.discounted_price
+        assert prices == []
+
+        g.pop("identity_map")
+        assert product.discounted_price == 1
+        assert product.price == product.basic_price - 1
+        assert prices == [1]
+
+
+@pytest.mark.usefixtures("db")
+class TestFacets:
+    """Attribute facet tests."""
+
+    def test_facets_count_products(self):
+        """Test facet counts match the products of a category."""
+        product = Product.query.filter(Product.attributes.isnot(None)).first()
+        category = Category.get_by_id(product.category_id)
+        products = Product.query.filter_by(category_id=category.id).all()
+        facets = get_facets([f"category:{category.id}"])
+        assert facets[f"t:{product.product_type_id}"] == len(
+            [p for p in products if p.product_type_id == product.product_type_id]
+        )
+        for attr_id, value_id in product.attributes.items():
+            assert facets[f"v:{attr_id}:{value_id}"] >= 1
+
+        for attr, values in get_attr_filter(facets):
+            assert attr.id in {a.id for a in product.product_type.product_attributes}
+            assert all(count > 0 for _, count in values)
+
+    def test_local_counts_are_kept(self, app, monkeypatch):
+        """Test without redis the counts are built once until a product of
+        the category changes."""
+        monkeypatch.setitem(app.config, "USE_REDIS", False)
+        product = Product.query.first()
+        owner = f"category:{product.category_id}"
+        builds = []
+        build = product_models.build_facets
+        monkeypatch.setattr(
+            product_models, "build_facets", lambda o: builds.append(o) or build(o)
+        )
+        get_facets([owner])
+        get_facets([owner])
+        assert builds == [owner]
+        product.update(title="renamed")
+        get_facets([owner])
+        assert builds == [owner, owner]
+
+    def test_redis_counts_follow_edits(self, redis):
+        """Test stored counts are moved by product edits."""
+        product = Product.query.first()
+        owner = f"category:{product.category_id}"
+        old_type = f"t:{product.product_type_id}"
+        before = get_facets([owner])
+
+        with db.session.no_autoflush:
+            product.product_type_id = 999
+            product_models.update_product_facets(product)
+            after = get_facets([owner])
+            assert after[old_type] == before[old_type] - 1
+            assert after["t:999"] == 1
+
+            product_models.remove_product_facets(product)
+            assert get_facets([owner])["t:999"] == 0
+        db.session.rollback()
+
+    def test_redis_concurrent_changes_take_turns(self, redis):
+        """Test a change landing between the read and the write of another
+        is not counted over."""
+        product = Product.query.first()
+        owner = f"category:{product.category_id}"
+        old_type = f"t:{product.product_type_id}"
+        before = get_facets([owner])
+        calls = []
+
+        def change(record):
+            if not calls:
+                # another worker moves the product in the meantime
+                product_models._change_facets(
+                    product.id, lambda record: ({**record, "fields": ["t:777"]}, None)
+                )
+            calls.append(record["fields"])
+            return {**record, "fields": ["t:888"]}, None
+
+        product_models._change_facets(product.id, change)
+        assert calls[-1] == ["t:777"]
+        facets = get_facets([owner])
+        assert facets[old_type] == before[old_type] - 1
+        assert facets["t:777"] == 0
+        assert facets["t:888"] == 1
+
+
+@pytest.mark.usefixtures("db")
+class TestSalePricing:
+    """Sale pricing tests."""
+
+    def test_get_discounted_prices(self):
+        """Test product sales win over category sales and others pay full."""
+        products = Product.query.order_by(Product.id).limit(3).all()
+        on_product, on_category, full_price = products
+        fixed = Sale.create(
+            title="fixed",
+            discount_value_type=DiscountValueTypeKinds.fixed.value,
+            discount_value=Decimal("3.00"),
+        )
+        percent = Sale.create(
+            title="percent",
+            discount_value_type=DiscountValueTypeKinds.percent.value,
+            discount_value=Decimal("10.00"),
+        )
+        SaleProduct.create(sale_id=fixed.id, product_id=on_product.id)
+        SaleCategory.create(sale_id=percent.id, category_id=on_category.category_id)
+        Product.query.filter_by(id=full_price.id).update({"category_id": 0})
+
+        prices = Sale.get_discounted_prices(products)
+        assert prices[0] == Decimal("3.00")
+        assert prices[1] == (on_category.basic_price / 10).quantize(Decimal("0.00"))
+        assert prices[2] == 0
+        assert Sale.get_discounted_price(on_product) == prices[0]
+
+    def _sale(self, title="sale"):
+        return Sale.create(
+            title=title,
+            discount_value_type=DiscountValueTypeKinds.fixed.value,
+            discount_value=Decimal("3.00"),
+        )
+
+    def test_find_affected_products(self):
+        """Test sales resolve to the products of their products and categories."""
+        on_product, on_category = Product.query.order_by(Product.id).limit(2)
+        sale = self._sale()
+        SaleProduct.create(sale_id=sale.id, product_id=on_product.id)
+        SaleCategory.create(sale_id=sale.id, category_id=on_category.category_id)
+        in_category = {
+            p.id for p in Product.query.filter_by(category_id=on_category.category_id)
+        }
+        assert Sale.find_affected_products(sale_ids=[sale.id]) == in_category | {
+            on_product.id
+        }
+        assert Sale.find_affected_products(product_ids=[on_product.id]) == {
+            on_product.id
+        }
+
+    def test_sale_edits_clear_product_sales_on_commit(self, redis):
+        """Test creating, editing and deleting sales clears the products they
+        price once committed, and not before."""
+        first, second = Product.query.order_by(Product.id).limit(2)
+        second.update(category_id=0)
+        assert Sale.get_product_sale_ids([first, second]) == [0, 0]
+        assert redis.ttl(MC_KEY_PRODUCT_SALES) > 0
+
+        sale = self._sale()
+        line = SaleProduct(sale_id=sale.id, product_id=first.id)
+        db.session.add(line)
+        db.session.flush()
+        assert redis.hget(MC_KEY_PRODUCT_SALES, first.id) == b"0"
+        db.session.commit()
+        assert redis.hget(MC_KEY_PRODUCT_SALES, first.id) is None
+        assert Sale.get_product_sale_ids([first, second]) == [sale.id, 0]
+
+        line.update(product_id=second.id)
+        assert redis.hmget(MC_KEY_PRODUCT_SALES, first.id, second.id) == [None, None]
+        assert Sale.get_product_sale_ids([first, second]) == [0, sale.id]
+
+        line.delete()
+        assert redis.hget(MC_KEY_PRODUCT_SALES, second.id) is None
+        assert Sale.get_product_sale_ids([first, second]) == [0, 0]
+
+        SaleCategory.create(sale_id=sale.id, category_id=first.category_id)
+        assert Sale.get_product_sale_ids([first]) == [sale.id]
+        sale.delete()
+        assert redis.hget(MC_KEY_PRODUCT_SALES, first.id) is None
+
+    def test_rolled_back_sale_edits_keep_product_sales(self, redis):
+        """Test sale changes rolled back leave the table alone."""
+        product = Product.query.first()
+        assert Sale.get_product_sale_ids([product]) == [0]
+        sale = self._sale()
+        db.session.add(SaleProduct(sale_id=sale.id, product_id=product.id))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        assert redis.hget(MC_KEY_PRODUCT_SALES, product.id) == b"0"
+
+
+@pytest.mark.usefixtures("db")
+class TestCartCache:
+    """Cart cache tests."""
+
+    def test_changes_clear_the_owner_caches(self, redis):
+        """Test cart changes clear the caches of the cart owner, whoever
+        makes them."""
+        variant = ProductVariant.query.first()
+        cart = Cart.create(user_id=42, quantity=1)
+        keys = [
+            MC_KEY_CART_BY_USER.format(cart.user_id),
+            MC_KEY_CART_SUMMARY_BY_USER.format(cart.user_id),
+        ]
+        redis.mset(dict.fromkeys(keys, "cached"))
+        line = CartLine.create(cart_id=cart.id, variant_id=variant.id, quantity=1)
+        assert redis.exists(*keys) == 1
+        assert not redis.exists(keys[1])
+
+        redis.mset(dict.fromkeys(keys, "cached"))
+        line.update(quantity=2)
+        assert redis.exists(*keys) == 1
+        cart.update(quantity=2)
+        assert not redis.exists(*keys)
+
+    def test_line_changes_clear_the_summary(self, redis):
+        """Test the summary follows the lines while the cart stays cached."""
+        variant = ProductVariant.query.first()
+        cart = Cart.create(user_id=42, quantity=1)
+        line = CartLine.create(cart_id=cart.id, variant_id=variant.id, quantity=1)
+        summary = Cart.get_cart_summary_by_user_id(cart.user_id)
+        assert summary["lines"][0]["quantity"] == 1
+
+        line.update(quantity=2)
+        assert redis.exists(MC_KEY_CART_BY_USER.format(cart.user_id))
+        summary = Cart.get_cart_summary_by_user_id(cart.user_id)
+        assert summary["lines"][0]["quantity"] == 2
+
+        line.delete()
+        assert Cart.get_cart_summary_by_user_id(cart.user_id)["line_count"] == 0
+
+    def test_snapshot_loaded_once_per_request(self):
+        """Test the cart totals share one load of the lines until they change."""
+        first, second = ProductVariant.query.limit(2).all()
+        cart = Cart.create(user_id=42, quantity=2)
+        CartLine.create(cart_id=cart.id, variant_id=first.id, quantity=2)
+        g.pop("identity_map", None)
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            if statement.startswith("SELECT") and "FROM checkout_cartline" in statement:
+                statements.append(statement)
+
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            assert cart.total == cart.subtotal == first.price * 2
+            assert len(cart) == len(cart.lines) == 1
+            assert cart.is_shipping_required == first.is_shipping_required
+            assert len(statements) == 1
+
+            CartLine.create(cart_id=cart.id, variant_id=second.id, quantity=1)
+            assert len(cart) == 2
+            assert cart.total == first.price * 2 + second.price
+            assert len(statements) == 2
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+
+
+@pytest.mark.usefixtures("db")
+class TestStockReservation:
+    """Stock reservation tests."""
+
+    def test_reserve_reports_failed_variants(self):
+        """Test only the variants without enough stock are reported."""
+        first, second = ProductVariant.query.order_by(ProductVariant.id).limit(2)
+        first.update(quantity=3, quantity_allocated=0)
+        second.update(quantity=1, quantity_allocated=0)
+
+        failed = ProductVariant.reserve_stock([(first, 2), (second, 1), (first, 2)])
+        assert failed == [first]
+
+    def test_parallel_reservations_do_not_oversell(self, app):
+        """Test concurrent checkouts never allocate more than the stock."""
+        variant = ProductVariant.query.first()
+        variant.update(quantity=7, quantity_allocated=0)
+        workers = 20
+        barrier = threading.Barrier(workers)
+        results = []
+
+        def checkout():
+            with app.app_context():
+                barrier.wait()
+                failed = ProductVariant.reserve_stock([(variant, 1)])
+                if failed:
+                    db.session.rollback()
+                else:
+                    db.session.commit()
+                results.append(not failed)
+
+        threads = [threading.Thread(target=checkout) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        db.session.expire_all()
+        assert results.count(True) == 7
+        assert db.session.get(ProductVariant, variant.id).quantity_allocated == 7
+
+    def test_order_lines_fire_flush_events(self, monkeypatch):
+        """Test the lines of a new order go through the flush events."""
+        user = User.create(username="buyer", email="buyer@example.com", password="x")
+        login_user(user, force=True)
+        variants = ProductVariant.query.order_by(ProductVariant.id).limit(2).all()
+        for variant in variants:
+            variant.update(quantity=5, quantity_allocated=0)
+        cart = Cart.create(user_id=user.id, quantity=2)
+        for variant in variants:
+            CartLine.create(cart_id=cart.id, variant_id=variant.id, quantity=1)
+        inserted = []
+        monkeypatch.setattr(
+            OrderLine,
+            "__flush_insert_event__",
+            classmethod(lambda cls, target: inserted.append(target)),
+        )
+
+        order, _ = Order.create_whole_order(cart)
+        assert sorted(line.variant_id for line in inserted) == [v.id for v in variants]
+        assert [line.product_id for line in order.lines] == [
+            v.product_id for v in variants
+        ]
+
+
+@pytest.mark.usefixtures("db")
+class TestStockSettlement:
+    """Order stock settlement tests."""
+
+    def create_order(self, variant, quantity, token="settle"):
+        variant.update(quantity=10, quantity_allocated=quantity)
+        order = Order.create(
+            token=token, user_id=1, status=OrderStatusKinds.unfulfilled.value
+        )
+        OrderLine.create(order_id=order.id, variant_id=variant.id, quantity=quantity)
+        return order
+
+    def stock(self, variant):
+        db.session.expire_all()
+        variant = db.session.get(ProductVariant, variant.id)
+        return variant.quantity, variant.quantity_allocated
+
+    def test_repeated_payment_settles_once(self):
+        """Test stock is consumed once however often payment succeeds."""
+        variant = ProductVariant.query.first()
+        order = self.create_order(variant, 3)
+        payment = OrderPayment.create(
+            order_id=order.id, status=PaymentStatusKinds.waiting.value
+        )
+
+        assert payment.pay_success(paid_at=None) is True
+        assert payment.pay_success(paid_at=None) is False
+        assert order.pay_success(payment) is False
+        assert self.stock(variant) == (7, 0)
+        assert order.status == OrderStatusKinds.fulfilled.value
+        assert order.cancel() is False
+        assert self.stock(variant) == (7, 0)
+
+    def test_cancel_releases_allocation(self):
+        """Test canceling releases the allocation only once."""
+        variant = ProductVariant.query.first()
+        order = self.create_order(variant, 3)
+
+        assert order.cancel() is True
+        assert order.cancel() is False
+        assert self.stock(variant) == (10, 0)
+
+    def test_cancel_drafts(self):
+        """Test drafts can be canceled, releasing their stock once."""
+        variant = ProductVariant.query.first()
+        order = self.create_order(variant, 3)
+        assert order.draft() is True
+        assert order.cancel() is True
+        assert self.stock(variant) == (10, 0)
+
+        assert order.draft() is False
+        assert order.cancel() is False
+        assert self.stock(variant) == (10, 0)
+
+    def test_paid_orders_are_not_drafted(self):
+        """Test a paid order cannot become a draft to be canceled."""
+        variant = ProductVariant.query.first()
+        order = self.create_order(variant, 3)
+        payment = OrderPayment.create(
+            order_id=order.id, status=PaymentStatusKinds.waiting.value
+        )
+        payment.pay_success(paid_at=None)
+        assert order.draft() is False
+        assert order.cancel() is False
+        assert self.stock(variant) == (7, 0)
+
+
+@pytest.mark.usefixtures("db")
+class TestPaymentNotify:
+    """Payment notification tests."""
+
+    def test_missing_ids_match_nothing(self):
+        """Test notifications are only matched on the ids they carry."""
+        assert OrderPaymentNotify.record("N1", None, "1")
+        assert OrderPaymentNotify.record(None, "T2", "2")
+        assert OrderPaymentNotify.is_handled("N1", None)
+        assert OrderPaymentNotify.is_handled(None, "T2")
+        assert OrderPaymentNotify.is_handled("N2", "T2")
+        assert not OrderPaymentNotify.is_handled("N3", None)
+        assert not OrderPaymentNotify.is_handled(None, "T3")
+        assert not OrderPaymentNotify.is_handled(None, None)
+
+
+@pytest.mark.usefixtures("db")
+class TestOutbox:
+    """Outbox tests."""
+
+    def test_order_event_written_by_worker(self):
+        """Test order events wait in the outbox until processed."""
+        order = Order.create(token="outbox", user_id=1)
+        order.complete()
+        assert OrderEvent.query.count() == 0
+
+        assert process_outbox() == 1
+        event = OrderEvent.query.one()
+        assert event.order_id == order.id
+        assert event.type_ == OrderEvents.order_completed.value
+        assert OutboxMessage.query.count() == 0
+
+    def test_failed_message_is_retried_then_given_up(self):
+        """Test failures back off and end up marked failed."""
+        calls = []
+
+        @outbox_handler("flaky")
+        def flaky(n):
+            calls.append(n)
+            raise ValueError(n)
+
+        try:
+            enqueue("flaky", n=1)
+            db.session.commit()
+            assert process_outbox(max_attempts=2) == 0
+            message = OutboxMessage.query.one()
+            assert message.attempts == 1
+            assert message.status == OutboxStatusKinds.pending.value
+            assert process_outbox(max_attempts=2) == 0
+            assert calls == [1]
+
+            message.update(available_at=datetime.now())
+            process_outbox(max_attempts=2)
+            db.session.expire_all()
+            message = OutboxMessage.query.one()
+            assert calls == [1, 1]
+            assert message.status == OutboxStatusKinds.failed.value
+            assert "ValueError" in message.error
+        finally:
+            handlers.pop("flaky")
+
+    def test_eager_messages_run_after_commit(self, app, monkeypatch):
+        """Test eager handlers see the committed changes, and are dropped
+        with a rollback."""
+        monkeypatch.setitem(app.config, "OUTBOX_EAGER", True)
+        order = Order.create(token="eager", user_id=1)
+        enqueue("order_event", order_id=order.id, user_id=1, type_=1)
+        db.session.rollback()
+        assert OrderEvent.query.count() == 0
+
+        order.complete()
+        event = OrderEvent.query.one()
+        assert event.type_ == OrderEvents.order_completed.value
+        assert OutboxMessage.query.count() == 0
+
+    def test_failed_eager_message_is_queued(self, app, monkeypatch):
+        """Test an eager handler failing leaves its message to the worker."""
+        monkeypatch.setitem(app.config, "OUTBOX_EAGER", True)
+
+        @outbox_handler("flaky")
+        def flaky(n):
+            raise ValueError(n)
+
+        try:
+            enqueue("flaky", n=1)
+            db.session.commit()
+            message = OutboxMessage.query.one()
+            assert (message.kind, message.payload) == ("flaky", {"n": 1})
+        finally:
+            handlers.pop("flaky")
+
+
+@pytest.mark.usefixtures("db")
+class TestKeysetPagination:
+    """Keyset pagination tests."""
+
+    @pytest.mark.parametrize("sort", ["id", "created_at"])
+    def test_walk_forward_and_back(self, sort):
+        """Test the pages cover every row once and going back returns the
+        previous page."""
+        for i in range(25):
+            Order.create(
+                token=f"keyset{i}",
+                created_at=datetime(2024, 1, 1) + timedelta(hours=i % 7),
+            )
+        column = getattr(Order, sort)
+        pages = [KeysetPagination(Order.query, column)]
+        while pages[-1].has_next:
+            cursor = pages[-1]._cursor(pages[-1].items[-1])
+            pages.append(KeysetPagination(Order.query, column, after=cursor))
+        ids = [order.id for page in pages for order in page.items]
+        assert len(ids) == len(set(ids)) == 25
+        assert len(pages) == pages[0].pages == 3
+
+        cursor = pages[-1]._cursor(pages[-1].items[0])
+        back = KeysetPagination(Order.query, column, before=cursor)
+        assert back.items == pages[-2].items
+        assert back.has_prev and back.has_next
+
+    def test_local_counts_are_kept(self, app, monkeypatch):
+        """Test without redis the total is counted once per COUNT_EXPIRE."""
+        monkeypatch.setitem(app.config, "USE_REDIS", False)
+        now = [100.0]
+        monkeypatch.setattr(local_cache, "_monotonic", lambda: now[0])
+        query = Order.query.filter(Order.token.like("counted%"))
+        Order.create(token="counted0")
+        assert KeysetPagination(query, Order.id).total == 1
+        Order.create(token="counted1")
+        assert KeysetPagination(query, Order.id).total == 1
+        now[0] += COUNT_EXPIRE + 1
+        assert KeysetPagination(query, Order.id).total == 2
+
+
+@pytest.mark.usefixtures("db")
+class TestSearchResults:
+    """Search result pagination tests."""
+
+    def response(self, ids, source=None):
+        hits = [{"_id": str(id), "_source": source or {}} for id in ids]
+        return Response(Item.search(), {"hits": {"total": {"value": 40}, "hits": hits}})
+
+    def test_items_come_from_the_index(self):
+        """Test hits are shown as indexed without loading products."""
+        source = {"title": "Shirt", "first_img": "shirt.png", "price": 9.5}
+        pagination = CustomPagination(1, 16, rs=self.response([7], source))
+        assert pagination.total == 40
+        assert pagination.items[0].id == "7"
+        assert pagination.items[0].first_img == "shirt.png"
+
+    def test_hydrate_loads_products_in_order(self):
+        """Test hydrated hits are the products, in hit order."""
+        ids = [p.id for p in Product.query.order_by(Product.id.desc()).limit(3)]
+        pagination = CustomPagination(1, 16, rs=self.response(ids), hydrate=True)
+        assert [product.id for product in pagination.items] == ids
+
+
+@pytest.mark.usefixtures("db")
+class TestReindex:
+    """Reindex tests."""
+
+    def test_batches_cover_all_products(self):
+        """Test every product is yielded once in batches of batch_size."""
+        batches = list(iter_product_batches(batch_size=2))
+        ids = [product.id for batch in batches for product in batch]
+        assert ids == sorted(p.id for p in Product.query)
+        assert all(len(batch) <= 2 for batch in batches)
+
+    def test_bulk_update_actions(self, monkeypatch):
+        """Test documents are sent without the meta field to index."""
+        sent = []
+
+        def parallel_bulk(client, actions, **kwargs):
+            sent.extend(actions)
+            return [(True, {}) for _ in actions]
+
+        monkeypatch.setattr(search, "parallel_bulk", parallel_bulk)
+        monkeypatch.setattr(Item, "get_es", classmethod(lambda cls: None))
+        products = Product.query.limit(2).all()
+
+        assert Item.bulk_update(products, op_type="create", index="flaskshop_v2") == 2
+        assert sent[0]["_index"] == "flaskshop_v2"
+        assert sent[0]["_source"]["title"] == products[0].title
+        assert "meta" not in sent[0]["_source"]
+
+    def test_recreate_index_behind_alias(self, monkeypatch):
+        """Test rebuilding in place drops the index the alias points at."""
+        calls = []
+
+        class Indices:
+            def exists_alias(self, name):
+                return True
+
+            def get_alias(self, name):
+                return {"flaskshop_v3": {"aliases": {name: {}}}}
+
+            def delete(self, index):
+                calls.append(("delete", index))
+
+            def create(self, index, **body):
+                calls.append(("create", index, body["aliases"]))
+
+        class Client:
+            indices = Indices()
+
+        monkeypatch.setattr(Item, "get_es", classmethod(lambda cls: Client()))
+        assert Item.recreate_index() == "flaskshop_v3"
+        assert calls == [
+            ("delete", "flaskshop_v3"),
+            ("create", "flaskshop_v3", {"flaskshop": {}}),
+        ]
+
+    def test_suggestions_rebuilt_behind_alias(self, monkeypatch):
+        """Test suggestions are built into a new index the alias then moves
+        to, the old one being dropped only after."""
+        calls = []
+
+        class Indices:
+            def get(self, index):
+                return {"flaskshop_suggest_v2": {}}
+
+            def create(self, index, **body):
+                calls.append(("create", index))
+
+            def put_settings(self, index, settings):
+                pass
+
+            def refresh(self, index):
+                pass
+
+            def exists_alias(self, name):
+                return True
+
+            def get_alias(self, name):
+                return {"flaskshop_suggest_v2": {}}
+
+            def update_aliases(self, actions):
+                calls.append(("alias", actions))
+
+            def delete(self, index):
+                calls.append(("delete", index))
+
+        class Client:
+            indices = Indices()
+
+        def parallel_bulk(client, actions, **kwargs):
+            calls.extend(("index", action["_index"]) for action in actions)
+            return [(True, {}) for _ in actions]
+
+        monkeypatch.setattr(search, "parallel_bulk", parallel_bulk)
+        monkeypatch.setattr(Suggestion, "get_es", classmethod(lambda cls: Client()))
+        assert Suggestion.rebuild([(("product", 1), "Red shirt")]) == 1
+        assert calls == [
+            ("create", "flaskshop_suggest_v3"),
+            ("index", "flaskshop_suggest_v3"),
+            (
+                "alias",
+                [
+                    {
+                        "remove": {
+                            "index": "flaskshop_suggest_v2",
+                            "alias": "flaskshop_suggest",
+                        }
+                    },
+                    {
+                        "add": {
+                            "index": "flaskshop_suggest_v3",
+                            "alias": "flaskshop_suggest",
+                        }
+                    },
+                ],
+            ),
+            ("delete", "flaskshop_suggest_v2"),
+        ]
+
+
+@pytest.mark.usefixtures("db")
+class TestSearchUpdates:
+    """Search index update tests."""
+
+    @pytest.fixture(autouse=True)
+    def use_es(self, app, db, monkeypatch):
+        monkeypatch.setitem(app.config, "USE_ES", True)
+
+    def test_one_message_per_transaction(self):
+        """Test products changed over several flushes are sent once each."""
+        first, second = Product.query.order_by(Product.id).limit(2).all()
+        first.title = "renamed"
+        db.session.flush()
+        first.basic_price = 12
+        second.title = "renamed too"
+        db.session.flush()
+        db.session.commit()
+
+        message = OutboxMessage.query.one()
+        assert message.kind == "search_index"
+        assert message.payload == {"product_ids": [first.id, second.id]}
+
+    def test_rollback_discards_changes(self):
+        """Test products changed by a rolled back transaction are not sent."""
+        Product.query.first().title = "renamed"
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        assert OutboxMessage.query.count() == 0
+
+    def test_bulk_request(self, monkeypatch):
+        """Test the handler indexes existing products and deletes the rest,
+        from messages of either form."""
+        sent = []
+
+        def parallel_bulk(client, actions, **kwargs):
+            sent.extend(actions)
+            return [(True, {}) for _ in actions]
+
+        monkeypatch.setattr(search, "parallel_bulk", parallel_bulk)
+        monkeypatch.setattr(Item, "get_es", classmethod(lambda cls: None))
+        monkeypatch.setattr(Suggestion, "get_es", classmethod(lambda cls: None))
+        product = Product.query.first()
+
+        assert search.update_search_index(product_ids=[product.id], product_id=0) == 2
+        assert [(a["_index"], a["_op_type"], a["_id"]) for a in sent] == [
+            ("flaskshop_suggest", "index", f"product-{product.id}"),
+            ("flaskshop_suggest", "delete", "product-0"),
+            ("flaskshop", "index", str(product.id)),
+            ("flaskshop", "delete", "0"),
+        ]
+
+
+class TestFullTextIndex:
+    """Local full-text index tests."""
+
+    def test_state_methods_are_required(self):
+        """Test an index saving nothing cannot be created."""
+
+        class Incomplete(PersistentIndex):
+            def _dump(self):
+                return None
+
+        with pytest.raises(TypeError):
+            Incomplete()
+
+    def index(self, path=None):
+        index = FullTextIndex({"title": 2.0, "description": 1.0}, path)
+        index.add(1, title="Red shirt", description="A shirt in red")
+        index.add(2, title="Blue jeans", description="Goes with a red shirt")
+        index.add(3, title="Red red socks", description="")
+        return index
+
+    def test_ranking(self):
+        """Test title matches rank first and every match is counted."""
+        index = self.index()
+        assert index.search("shirt") == (2, [1, 2])
+        total, ranked = index.search("RED shirt")
+        assert total == 3 and ranked[0] == 1
+        assert index.search("red shirt", offset=1, limit=1) == (3, ranked[1:2])
+        assert index.search("hat") == (0, [])
+
+    def test_add_replaces_and_remove(self):
+        """Test documents are reindexed and removed without leftovers."""
+        index = self.index()
+        index.add(1, title="Green hat", description="")
+        assert index.search("shirt") == (1, [2])
+        assert index.remove(2) is True
+        assert index.remove(2) is False
+        assert "shirt" not in index.postings["title"]
+        assert index.search("hat") == (1, [1])
+
+    def test_saved_index_is_read_by_others(self, tmp_path):
+        """Test a saved index is loaded, and reloaded after another save."""
+        path = tmp_path / "index"
+        writer = self.index(path)
+        writer.save()
+        reader = FullTextIndex(writer.fields, path)
+        assert reader.refresh() is True
+        assert reader.search("socks") == (1, [3])
+
+        writer.remove(3)
+        writer.save()
+        reader.refresh()
+        assert reader.search("socks") == (0, [])
+
+    def test_writers_take_turns(self, tmp_path):
+        """Test writers holding the lock never save over each other."""
+        path = tmp_path / "index"
+        FullTextIndex({"title": 1.0}, path).save()
+
+        def write(start):
+            index = FullTextIndex({"title": 1.0}, path)
+            for doc_id in range(start, start + 20):
+                with index.locked():
+                    index.refresh()
+                    index.add(doc_id, title="shirt")
+                    index.save()
+
+        threads = [threading.Thread(target=write, args=(n * 20,)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        reader = FullTextIndex({"title": 1.0}, path)
+        reader.refresh()
+        assert len(reader) == 80
+
+
+class TestPrefixIndex:
+    """Suggestion trie tests."""
+
+    def test_suggest(self):
+        """Test titles are completed from the start of any of their words."""
+        index = PrefixIndex()
+        index.add(("product", 1), "Red Shirt")
+        index.add(("category", 2), "Shirts")
+        index.add(("product", 3), "Red socks")
+        assert index.suggest("sh") == [
+            (("category", 2), "Shirts"),
+            (("product", 1), "Red Shirt"),
+        ]
+        assert index.suggest("so RE") == [(("product", 3), "Red socks")]
+        assert index.suggest("sh", rank=lambda key: key[0] != "product") == [
+            (("product", 1), "Red Shirt"),
+            (("category", 2), "Shirts"),
+        ]
+        assert index.suggest("hat") == []
+
+    def test_remove_prunes(self):
+        """Test removed titles leave no nodes behind."""
+        index = PrefixIndex()
+        index.add(1, "Red shirt shirts")
+        index.add(2, "Red socks")
+        index.remove(1)
+        assert index.suggest("sh") == []
+        assert "h" not in index.root["s"]
+        index.remove(2)
+        assert index.root == {}
+
+
+@pytest.mark.usefixtures("db")
+class TestLocalSearch:
+    """Local search backend tests."""
+
+    def test_search_loads_products(self):
+        """Test hits are loaded as products, matched on the title."""
+        LocalItem.rebuild()
+        product = Product.query.first()
+        pagination = LocalItem.new_search(product.title, 1)
+        assert product.id in [item.id for item in pagination.items]
+        assert pagination.total >= 1
+
+    @pytest.mark.parametrize("query", ["", "  ", "!?"])
+    def test_queries_without_terms_list_products(self, query):
+        """Test a query without any term lists all the products."""
+        ids = [product.id for product in Product.query.order_by(Product.id)]
+        pagination = LocalItem.new_search(query, 1, per_page=2)
+        assert [item.id for item in pagination.items] == ids[:2]
+        assert pagination.total == len(ids)
+
+    def test_index_follows_commits(self, app, monkeypatch):
+        """Test committed product changes reach the index."""
+        monkeypatch.setitem(app.config, "OUTBOX_EAGER", True)
+        LocalItem.rebuild()
+        product = Product.query.first()
+        product.update(title="Zebra print")
+        assert [item.id for item in LocalItem.new_search("zebra", 1).items] == [
+            product.id
+        ]
+
+        assert LocalItem.suggest("zeb") == [(("product", product.id), "Zebra print")]
+
+        product.title = "Tiger print"
+        db.session.flush()
+        db.session.rollback()
+        assert LocalItem.new_search("tiger", 1).items == []
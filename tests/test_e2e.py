@@ -1,4 +1,13 @@
+import base64
+
 import pytest
+import rsa
+
+from flaskshop.constant import OrderStatusKinds, PaymentStatusKinds
+from flaskshop.order.models import Order, OrderPayment, OrderPaymentNotify
+from flaskshop.order.payment import zhifubao
+from flaskshop.product.models import Category
+from flaskshop.public.search import LocalItem
 
 
 def is_success_res(client, path):
@@ -29,3 +38,57 @@ class TestBasicPageCanView:
 
     def test_signup_page(self, client):
         is_success_res(client, "/account/signup")
+
+    def test_search_suggest(self, client):
+        LocalItem.rebuild()
+        category = Category.query.first()
+        rv = client.get(f"/search/suggest?q={category.title[:3]}")
+        assert rv.status_code == 200
+        assert {
+            "type": "category",
+            "title": category.title,
+            "url": f"/products/category/{category.id}",
+        } in rv.json["suggestions"]
+
+
+@pytest.mark.usefixtures("db")
+class TestAlipayNotify:
+    @pytest.fixture
+    def gateway_key(self, monkeypatch):
+        public_key, private_key = rsa.newkeys(512)
+        monkeypatch.setattr(zhifubao, "get_alipay_public_key", lambda: public_key)
+        return private_key
+
+    def notify(self, client, private_key, **data):
+        signature = rsa.sign(zhifubao.get_sign_message(data), private_key, "SHA-256")
+        data.update(sign=base64.b64encode(signature).decode(), sign_type="RSA2")
+        return client.post("/orders/alipay/notify", data=data).data
+
+    def test_repeated_notify_pays_once(self, client, gateway_key):
+        order = Order.create(
+            token="notify", user_id=1, status=OrderStatusKinds.unfulfilled.value
+        )
+        OrderPayment.create(
+            order_id=order.id,
+            payment_no="20230328",
+            status=PaymentStatusKinds.waiting.value,
+        )
+        data = dict(
+            notify_id="N1",
+            trade_no="T1",
+            out_trade_no="20230328",
+            trade_status="TRADE_SUCCESS",
+            gmt_payment="2023-03-28 15:09:44",
+        )
+
+        assert self.notify(client, gateway_key, **data) == b"SUCCESS"
+        assert self.notify(client, gateway_key, **data) == b"SUCCESS"
+        assert OrderPaymentNotify.query.count() == 1
+        assert Order.query.one().status == OrderStatusKinds.fulfilled.value
+        assert OrderPayment.query.one().status == PaymentStatusKinds.confirmed.value
+
+    def test_bad_signature_is_refused(self, client, gateway_key):
+        _, other_key = rsa.newkeys(512)
+        data = dict(notify_id="N2", trade_no="T2", out_trade_no="1")
+        assert self.notify(client, other_key, **data) == b"ERROR HAPPEND"
+        assert OrderPaymentNotify.query.count() == 0